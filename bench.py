@@ -0,0 +1,1148 @@
+'''
+@file bench.py
+@authors Sam Lee and Dima Kyle
+Benchmark file for the firmware. It times the calls in the control loop so
+the cost of the different ways of doing them can be compared. It runs on
+the board from the REPL:
+
+@code
+import bench
+bench.io()
+@endcode
+
+and on the host computer against the simulator, where the times are those
+of CPython and only the ratios between the two ways mean anything:
+
+@code
+python bench.py io
+@endcode
+
+The task arrangements of main.py are compared by running a job through the
+simulated firmware (host only):
+
+@code
+python bench.py tasks job.txt
+python bench.py command dense.txt
+python bench.py arrival dense.txt
+python bench.py pen dense.txt
+python bench.py fifo dense.txt
+python bench.py printing dense.txt
+@endcode
+
+A job streamed over a pseudo terminal by stream_job.py is compared with the
+same job read from a file, at pace times real time and optionally with the
+streamer restarted part way (host only):
+
+@code
+python bench.py stream dense.txt 10 2
+@endcode
+
+and the sustained rate of the stream, with the job read as fast as it
+comes, is measured with stream_rate() (host only):
+
+@code
+python bench.py stream_rate dense.txt 20
+@endcode
+
+A plot stopped part way is carried on from the checkpoint main.py saves,
+compared with plotting it again, with resume() (host only):
+
+@code
+python bench.py resume dense.txt 60
+@endcode
+
+The dispatch policies of job_server.py are compared by plotting a batch of
+jobs on a fleet of simulated plotters (host only):
+
+@code
+python bench.py fleet 3 dense.txt job.txt a.txt b.txt
+@endcode
+
+A dense job to compare them on can be made with dense_job(). A single
+stroke of any length is plotted in the same memory, which long_stroke()
+checks by running a 100000 point stroke within a heap budget (host only):
+
+@code
+python bench.py long_stroke 100000
+@endcode
+
+The transfer rate through a task_share.Queue, one item at a time or in
+bulk, is compared with queue() on the board or the host, and binary
+telemetry records with printing text with telemetry():
+
+@code
+python bench.py queue
+python bench.py telemetry
+@endcode
+
+Telemetry records are checked to come back unchanged through the ring and
+both host decoders with telemetry_check() (host only):
+
+@code
+python bench.py telemetry_check
+@endcode
+
+A task_share.StructShare written part way through a read is checked with
+struct_share(), which also times its calls and the memory they allocate:
+
+@code
+python bench.py struct_share
+@endcode
+
+The decoding of the job file itself, and the memory it allocates, is
+compared with parse() on the board or the host. It first checks with
+check_parse() that jobreader.JobReader decodes every line of the job, and
+of a dense job, the same as the string splits it replaced:
+
+@code
+python bench.py parse dense.txt
+python bench.py check_parse job.txt
+@endcode
+'''
+
+import sys
+
+try:
+    import utime
+except ImportError:
+    # On the host computer the firmware runs against the simulator
+    import simulator
+    simulator.install()
+    import utime
+
+if hasattr(sys.modules['pyb'], 'SIMULATED'):
+    # The simulated clock doesn't move on its own, so the host clock is used
+    import time
+
+    def _now_us():
+        return int(time.perf_counter()*1000000)
+else:
+    _now_us = utime.ticks_us
+
+
+def timeit(func, arg=None, count=1000):
+    '''
+    Times a function of zero or one arguments.
+    @param func The function to time
+    @param arg The argument passed to func, None for no argument
+    @param count Number of calls
+    @return Average time per call [us]
+    '''
+    if arg is None:
+        start = _now_us()
+        for _ in range(count):
+            func()
+        stop = _now_us()
+    else:
+        start = _now_us()
+        for _ in range(count):
+            func(arg)
+        stop = _now_us()
+    # Taking off the cost of the loop itself
+    empty = _now_us()
+    for _ in range(count):
+        pass
+    empty = utime.ticks_diff(_now_us(), empty)
+    return (utime.ticks_diff(stop, start) - empty)/count
+
+
+def io(count=1000):
+    '''
+    Compares the encoder reads and duty cycle writes through pyb.Timer with
+    the direct register access of fastio.py, for one encoder and motor and
+    for the latched read of both encoders.
+    @param count Number of calls per measurement
+    @return Dictionary of (normal, fast) times per call [us]
+    '''
+    import encoder
+    import motor_sam_dima
+    results = {}
+    encoders = {}
+    motors = {}
+    for fast in (False, True):
+        encoders[fast] = (encoder.Encoder(8,'PC6','PC7',fast),
+                          encoder.Encoder(4,'PB6','PB7',fast))
+        motors[fast] = motor_sam_dima.MotorDriver(3,'PA10','PB4','PB5',fast)
+    for fast in (False, True):
+        group = encoder.AxisGroup(*encoders[fast])
+        times = (timeit(encoders[fast][0].read, None, count),
+                 timeit(group.read, None, count),
+                 timeit(motors[fast].set_duty_cycle, 37, count))
+        for name, t in zip(('Encoder.read', 'AxisGroup.read',
+                            'MotorDriver.set_duty_cycle'), times):
+            results.setdefault(name, [0, 0])[fast] = t
+    motors[True].set_duty_cycle(0)
+    print('{:28s}{:>10s}{:>10s}'.format('call [us]', 'pyb', 'fastio'))
+    for name in results:
+        print('{:28s}{:10.2f}{:10.2f}'.format(name, results[name][0],
+                                              results[name][1]))
+    return results
+
+
+def compare(job_file, configs, plant_file=None, timeout_s=600):
+    '''
+    Runs a job through the simulated firmware once per configuration of
+    main.py and prints the throughput of each (host only).
+    @param job_file The job file
+    @param configs List of (label, dictionary of main.py globals)
+    @param plant_file Plant json from sysid.py, None for the default plants
+    @return Dictionary of label to simulator results
+    '''
+    import os
+    import contextlib
+    import simulator
+    plants = simulator.load_plants(plant_file) if plant_file else None
+    results = {}
+    for label, config in configs:
+        sim = simulator.SimPlotter(plants, config=config)
+        with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+            results[label] = sim.run_job(job_file, timeout_s)
+    print('{:20s}{:>10s}{:>12s}{:>14s}{:>11s}{:>9s}{:>10s}'.format('',
+          'plot [s]', 'dispatches', 'dispatch/s', 'path err', 'bad/pen',
+          'host [s]'))
+    for label, r in results.items():
+        print('{:20s}{:10.3f}{:12d}{:14.1f}{:11.2f}{:>9s}{:10.2f}'.format(
+              label, r['plot_time'], r['dispatches'],
+              r['dispatches']/r['plot_time'], r['path_error'],
+              '{:d}/{:d}'.format(r['bad_touchdowns'], r['touchdowns']),
+              r['host_time']))
+    return results
+
+
+def tasks(job_file, plant_file=None):
+    '''
+    Compares one control task per motor with both control loops merged in
+    a motor_task.AxisPair task.
+    '''
+    return compare(job_file, [('two tasks', {'merge_axes': False}),
+                              ('AxisPair', {'merge_axes': True})],
+                   plant_file)
+
+
+def command(job_file, plant_file=None):
+    '''
+    Compares the command task polled every 50 ms with the event driven
+    command task woken on arrival.
+    '''
+    return compare(job_file, [('polled', {'event_command': False}),
+                              ('event driven', {'event_command': True})],
+                   plant_file)
+
+
+def arrival(job_file, plant_file=None):
+    '''
+    Compares one arrival tolerance for every move with the arrival profiles
+    in main.py.
+    '''
+    uniform = {name: (None, None, 1)
+               for name in ('travel', 'first', 'point')}
+    return compare(job_file, [('one tolerance',
+                               {'arrival_profiles': uniform}),
+                              ('profiles', {})], plant_file)
+
+
+def pen(job_file, plant_file=None):
+    '''
+    Compares moving the pen after arrival with starting the pen moves on
+    the final approach.
+    '''
+    return compare(job_file, [('after arrival', {'pen_overlap': False}),
+                              ('overlapped', {'pen_overlap': True})],
+                   plant_file)
+
+
+def fifo(job_file, plant_file=None):
+    '''
+    Compares handing the points of a stroke to the motors one at a time
+    with the setpoint queue at a few depths, and prints the times the
+    motors waited for the decoder (underflows).
+    '''
+    configs = [('one at a time', {'setpoint_fifo': False})]
+    for depth, low in ((2, 0), (8, 2), (32, 8)):
+        configs.append(('queue {:d}/{:d}'.format(depth, low),
+                        {'setpoint_fifo': True, 'fifo_depth': depth,
+                         'fifo_low': low}))
+    results = compare(job_file, configs, plant_file)
+    for label, r in results.items():
+        print('{:20s}{:10d} underflows'.format(label, r['underflows']))
+    return results
+
+
+def printing(job_file, line_ms=10, plant_file=None, timeout_s=600):
+    '''
+    Compares the print task sending one character per run with the chunked
+    print task, while a job runs and a status line is printed every
+    line_ms (host only). The console throughput and characters lost are
+    printed with the lateness of the motor task.
+    @param job_file The job file
+    @param line_ms Time between status lines [ms]
+    @param plant_file Plant json from sysid.py, None for the default plants
+    @return Dictionary of label to results
+    '''
+    import contextlib
+    import cotask
+    import simulator
+    import print_task
+    line_ms = int(line_ms)
+    line = 'Motors 0: 1234 1240  1: -567 -560  pen D\n'
+    plants = simulator.load_plants(plant_file) if plant_file else None
+    results = {}
+
+    def status():
+        while True:
+            print_task.put(line)
+            yield 0
+
+    for label, chunked in (('one per run', False), ('chunked', True)):
+        # A dispatch time that doesn't divide the task periods, so the
+        # motor task's lateness shows
+        sim = simulator.SimPlotter(plants, dispatch_us = 190)
+        with open(job_file, 'rb') as file, \
+                contextlib.redirect_stdout(_Discard()):
+            sim.setup(file)
+            task = print_task.make_task(chunked)
+            cotask.task_list.append(cotask.Task(status, name = 'Status',
+                                                priority = 1,
+                                                period = line_ms))
+            motors = [t for pri in sim.task_list.pri_list for t in pri[2:]
+                      if t.name == 'Motors'][0]
+            r = sim.run(timeout_s)
+        r['written'] = print_task.written
+        r['dropped'] = print_task.dropped
+        r['print_runs'] = task._runs
+        r['late_avg'] = motors._late_sum/max(1, motors._runs)
+        r['late_max'] = motors._latest
+        results[label] = r
+    print('{:14s}{:>10s}{:>10s}{:>10s}{:>10s}{:>12s}{:>12s}'.format('',
+          'plot [s]', 'chars/s', 'lost', 'runs', 'late [us]',
+          'latest [us]'))
+    for label, r in results.items():
+        print('{:14s}{:10.3f}{:10.0f}{:10d}{:10d}{:12.1f}{:12d}'.format(
+              label, r['plot_time'], r['written']/r['plot_time'],
+              r['dropped'], r['print_runs'], r['late_avg'], r['late_max']))
+    return results
+
+
+def stream(job_file, pace=10, restart_s=0, ring=4096, plant_file=None,
+           timeout_s=600):
+    '''
+    Plots a job sent by stream_job.py, run as its own program on a pseudo
+    terminal linked to the simulated USB VCP, and compares it with the job
+    read from a file (host only). The simulated clock is kept to pace times
+    the host clock, so the streamer has to keep up with pace times the real
+    plot. With restart_s the streamer is stopped after that many seconds
+    and started again, so the job has to resume.
+    @param job_file The job file
+    @param pace Simulated seconds per host second
+    @param restart_s Host time before the streamer is restarted [s], 0 not
+    to restart it
+    @param ring Bytes of the job held on the board
+    @param plant_file Plant json from sysid.py, None for the default plants
+    @return Dictionary of label to results
+    '''
+    import os
+    import pty
+    import tty
+    import threading
+    import subprocess
+    import contextlib
+    import simulator
+    import jobstream
+    pace = float(pace)
+    restart_s = float(restart_s)
+    ring = int(ring)
+    plants = simulator.load_plants(plant_file) if plant_file else None
+    results = {}
+    with contextlib.redirect_stdout(_Discard()):
+        results['file'] = simulator.SimPlotter(plants).run_job(job_file,
+                                                               timeout_s)
+    sim = simulator.SimPlotter(plants, pace = pace)
+    file = jobstream.JobStream(ring)
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    command = [sys.executable, os.path.join(os.path.dirname(
+               os.path.abspath(__file__)), 'stream_job.py'),
+               os.ttyname(slave), job_file, '--quiet']
+    hosts = [subprocess.Popen(command, stdout = subprocess.PIPE)]
+
+    def restart():
+        hosts[0].kill()
+        hosts[0].wait()
+        hosts.append(subprocess.Popen(command, stdout = subprocess.PIPE))
+
+    timer = threading.Timer(restart_s, restart) if restart_s else None
+    try:
+        with contextlib.redirect_stdout(_Discard()):
+            sim.setup(file)
+            simulator.link_vcp(master)
+            if timer is not None:
+                timer.start()
+            r = sim.run(timeout_s)
+        if timer is not None:
+            timer.cancel()
+        report = hosts[-1].communicate(timeout = 10)[0].decode().strip()
+    finally:
+        simulator.link_vcp(None)
+        for host in hosts:
+            host.kill()
+        os.close(master)
+        os.close(slave)
+    r['stream'] = file
+    results['stream'] = r
+    print('{:8s}{:>10s}{:>10s}{:>11s}{:>13s}{:>10s}{:>8s}'.format('',
+          'plot [s]', 'finished', 'underruns', 'starved [s]', 'rejected',
+          'hellos'))
+    print('{:8s}{:10.3f}{:>10s}'.format('file', results['file']['plot_time'],
+                                        str(results['file']['finished'])))
+    print('{:8s}{:10.3f}{:>10s}{:11d}{:13.3f}{:10d}{:8d}'.format('stream',
+          r['plot_time'], str(r['finished']), file.underruns,
+          file.starved_us*1e-6, file.rejected, file.hellos))
+    print(report)
+    return results
+
+
+def stream_rate(job_file, copies=20, ring=4096, period=10, timeout_s=120):
+    '''
+    Measures the sustained rate a job is streamed at when it is read as
+    fast as it comes instead of being plotted (host only). stream_job.py
+    sends copies of the job one after another through a pseudo terminal to
+    a jobstream.JobStream, drained by a jobreader.JobReader in a task woken
+    by the stream. The simulated clock follows the host clock.
+    @param job_file The job file
+    @param copies Copies of the job sent
+    @param ring Bytes of the job held on the board
+    @param period Period of the receiver task [ms]
+    @param timeout_s Host time limit [s]
+    @return The JobStream, with the statistics
+    '''
+    import os
+    import pty
+    import tty
+    import time
+    import tempfile
+    import subprocess
+    import cotask
+    import simulator
+    import jobreader
+    import jobstream
+    copies = int(copies)
+    ring = int(ring)
+    period = int(period)
+    with open(job_file, 'rb') as file:
+        job = file.read()*copies
+    with tempfile.NamedTemporaryFile(suffix = '.txt', delete = False) as temp:
+        temp.write(job)
+    hw = simulator.reset()
+    cotask.task_list = cotask.TaskList()
+    file = jobstream.JobStream(ring)
+    reader = jobreader.JobReader(file)
+    finished = [False]
+
+    def drain():
+        while True:
+            code = reader.next()
+            while reader.waiting:
+                yield 0
+                code = reader.next()
+            if code == jobreader.NONE:
+                finished[0] = True
+                yield 0
+                continue
+            while reader.more() or reader.waiting:
+                if reader.waiting:
+                    yield 0
+
+    drainer = cotask.Task(drain, name = 'Drain', priority = 2)
+    file.set_task(drainer)
+    drainer.go()
+    cotask.task_list.append(drainer)
+    cotask.task_list.append(cotask.Task(file.run, name = 'Job Stream',
+                                        priority = 1, period = period))
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    simulator.link_vcp(master)
+    host = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(
+                             os.path.abspath(__file__)), 'stream_job.py'),
+                             os.ttyname(slave), temp.name, '--quiet'],
+                            stdout = subprocess.PIPE)
+    start = time.perf_counter()
+    first = None
+    try:
+        while not finished[0] and time.perf_counter() - start < timeout_s:
+            hw.clock.now_us = int((time.perf_counter() - start)*1e6)
+            cotask.task_list.pri_sched()
+            if first is None and file.received:
+                first = time.perf_counter()
+            time.sleep(0.0002)
+        seconds = time.perf_counter() - (first or start)
+        report = host.communicate(timeout = 10)[0].decode().strip()
+    finally:
+        simulator.link_vcp(None)
+        host.kill()
+        os.close(master)
+        os.close(slave)
+        os.remove(temp.name)
+    print('{:d} bytes in {:.2f} s from the first byte: {:.1f} kB/s, '
+          '{:d} lines'.format(file.consumed, seconds,
+                              file.consumed/seconds*1e-3, reader.lines))
+    print(file)
+    print(report)
+    return file
+
+
+def resume(job_file, stop_s=30, period_ms=5000, plant_file=None,
+           timeout_s=600):
+    '''
+    Stops a plot part way, as a reset or the power going off would, and
+    carries it on from the checkpoint main.py saved, compared with plotting
+    the job again from its first line (host only). The checkpoint file is a
+    temporary file on the host.
+    @param job_file The job file
+    @param stop_s Simulated time the plot is stopped at [s]
+    @param period_ms Shortest time between saves of the checkpoint [ms]
+    @param plant_file Plant json from sysid.py, None for the default plants
+    @param timeout_s Virtual time limit [s]
+    @return Dictionary of label to results
+    '''
+    import os
+    import tempfile
+    import contextlib
+    import simulator
+    import checkpoint
+    stop_s = float(stop_s)
+    period_ms = int(period_ms)
+    plants = simulator.load_plants(plant_file) if plant_file else None
+    with open(job_file, 'rb') as file:
+        length = len(file.read())
+    handle, name = tempfile.mkstemp(suffix = '.bin')
+    os.close(handle)
+    os.remove(name)
+    results = {}
+    try:
+        with contextlib.redirect_stdout(_Discard()):
+            results['whole'] = simulator.SimPlotter(plants).run_job(
+                job_file, timeout_s)
+            for label, limit_s in (('stopped', stop_s),
+                                   ('resumed', timeout_s)):
+                sim = simulator.SimPlotter(plants)
+                with open(job_file, 'rb') as file:
+                    main = sim.setup(file)
+                    saved = checkpoint.Checkpoint(name,
+                                                  period_ms = period_ms)
+                    main.job_checkpoint = saved
+                    start = saved.load(job_file, length)
+                    if start:
+                        main.start_at(start)
+                    results[label] = sim.run(limit_s)
+                    results[label]['start'] = start
+                    saved.close()
+    finally:
+        if os.path.exists(name):
+            os.remove(name)
+    whole = results['whole']['plot_time']
+    again = results['resumed']['plot_time']
+    print('whole plot {:.2f} s, stopped at {:.2f} s, carried on from byte '
+          '{:d} of {:d} in {:.2f} s ({:s})'.format(
+              whole, stop_s, results['resumed']['start'], length, again,
+              'finished' if results['resumed']['finished'] else
+              'not finished'))
+    print('{:.2f} s in all instead of {:.2f} s plotting it again, {:.2f} s '
+          'plotted twice'.format(stop_s + again, stop_s + whole,
+                                 stop_s + again - whole))
+    return results
+
+
+def fleet(plotters, *job_files, pace=10):
+    '''
+    Plots jobs on a fleet of simulated plotters through job_server.py with
+    each dispatch policy and compares the time the whole batch took and
+    the utilisation of the fleet (host only).
+    @param plotters Number of simulated plotters
+    @param job_files The job files
+    @param pace Simulated seconds per host second
+    @return Dictionary of policy to the metrics of job_server.JobServer
+    '''
+    import asyncio
+    import contextlib
+    import job_server
+    results = {}
+    processes, ports = job_server.simulate(int(plotters), pace)
+
+    async def run(policy):
+        server = job_server.JobServer(
+            [job_server.Plotter('p{:d}'.format(n), port)
+             for n, port in enumerate(ports)], policy, report_s=0)
+        for name in job_files:
+            server.submit(name)
+        await server.run(until_done = True)
+        return server.metrics()
+
+    try:
+        for policy in ('fifo', 'lpt'):
+            results[policy] = asyncio.run(run(policy))
+    finally:
+        for process in processes:
+            process.terminate()
+    print('{:8s}{:>10s}{:>8s}{:>10s}{:>14s}'.format('', 'batch [s]', 'done',
+          'jobs/h', 'utilisation'))
+    for policy, metrics in results.items():
+        print('{:8s}{:10.2f}{:8d}{:10.1f}{:13.0f}%'.format(policy,
+              metrics['elapsed_s'], metrics['done'], metrics['jobs_per_h'],
+              100*metrics['utilisation']))
+    return results
+
+
+def telemetry(count=1000):
+    '''
+    Compares making one binary telemetry record (packing, CRC and COBS
+    framing into the ring) with formatting and printing the same values as
+    text, by time and by memory allocated per call. On the host the text
+    goes nowhere, so only the memory means much there.
+    @param count Number of calls
+    @return Dictionary of way to (time [us], bytes allocated) per call
+    '''
+    import motor_task
+    import telemetry as telemetry_
+    count = int(count)
+    task_0 = motor_task.Motor_control_task(0)
+    task_1 = motor_task.Motor_control_task(1)
+    task_0.actuation = 37
+    task_1.actuation = -12
+    stream = telemetry_.Telemetry(task_0, task_1, 1)
+
+    def text():
+        print('0', str(task_0.position), str(task_0.control.setpoint),
+              str(task_0.actuation))
+        print('1', str(task_1.position), str(task_1.control.setpoint),
+              str(task_1.actuation))
+
+    def record():
+        stream.sample()
+        # Emptying the ring as the writer task would
+        stream.ring.consume(stream.ring.num_in())
+
+    def repeat(func):
+        for _ in range(count):
+            func()
+
+    results = {}
+    for name, func in (('text print', text), ('telemetry record', record)):
+        if hasattr(sys.modules['pyb'], 'SIMULATED'):
+            import contextlib
+            with contextlib.redirect_stdout(_Discard()):
+                results[name] = (timeit(func, None, count),
+                                 _heap(repeat, func)/count)
+        else:
+            results[name] = (timeit(func, None, count),
+                             _heap(repeat, func)/count)
+    print('{:20s}{:>10s}{:>12s}'.format('per call', 'time [us]',
+                                        'alloc [B]'))
+    for name, (t, used) in results.items():
+        print('{:20s}{:10.2f}{:12.1f}'.format(name, t, used))
+    return results
+
+
+def telemetry_check(count=500, ring_size=None):
+    '''
+    Checks that telemetry records come back unchanged (host only). Records
+    of extreme positions, setpoints, actuations and job offsets, full of
+    zero bytes for COBS to encode, are packed into a ring whose size isn't
+    a whole number of frames and drained in the slices peek() gives, as
+    the writer task does, so frames are split across the wrap of the ring.
+    decode() and decode_numpy() must both give every record, with no bad
+    frames.
+    @param count Number of records
+    @param ring_size Bytes of the ring, default two and a half frames
+    @return The number of records checked
+    '''
+    import struct
+    import motor_task
+    import telemetry as telemetry_
+    count = int(count)
+    size = telemetry_.FRAME_SIZE
+    ring_size = int(ring_size) if ring_size else size*5//2
+    task_0 = motor_task.Motor_control_task(0)
+    task_1 = motor_task.Motor_control_task(1)
+    stream = telemetry_.Telemetry(task_0, task_1, 1, ring_size = ring_size)
+
+    class Job:
+        '''
+        Stands in for the job reader with a set offset.
+        '''
+        offset_value = 0
+
+        def offset(self):
+            return self.offset_value
+
+    job = Job()
+    stream.set_job(job)
+    ints = (0, 1, -1, 256, -256, 0x7FFFFFFF, -0x80000000, 0x00FF0000)
+    shorts = (0, 1, -1, 256, 0x7FFF, -0x8000)
+    offsets = (0, 256, 0x00010000, 0xFFFFFFFF)
+    expected = []
+    data = bytearray()
+    for n in range(count):
+        task_0.position = ints[n % len(ints)]
+        task_1.position = ints[(n + 3) % len(ints)]
+        task_0.control.setpoint = ints[(n + 5) % len(ints)]
+        task_1.control.setpoint = ints[(n + 6) % len(ints)]
+        task_0.actuation = shorts[n % len(shorts)]
+        task_1.actuation = shorts[(n + 1) % len(shorts)]
+        job.offset_value = offsets[n % len(offsets)]
+        expected.append((task_0.position, task_1.position,
+                         task_0.control.setpoint, task_1.control.setpoint,
+                         task_0.actuation, task_1.actuation,
+                         job.offset_value))
+        stream.sample()
+        if stream.ring.room() < size or n == count - 1:
+            # Draining the full ring as the writer task does, a slice at a
+            # time
+            while stream.ring.any():
+                chunk = stream.ring.peek(64)
+                data += chunk
+                stream.ring.consume(len(chunk))
+    assert stream.drops == 0, 'frames dropped'
+    assert stream.ring.gets > ring_size, 'the ring never wrapped'
+    records, bad, rest = telemetry_.decode(data)
+    assert bad == 0 and not rest, 'decode: {:d} bad frames'.format(bad)
+    array_records, bad, rest = telemetry_.decode_numpy(bytes(data))
+    assert bad == 0 and not rest, 'decode_numpy: {:d} bad frames'.format(bad)
+    assert len(records) == count and len(array_records) == count, \
+        'records lost'
+    fields = telemetry_.FIELDS
+    for n, record in enumerate(records):
+        assert tuple(int(value) for value in array_records[n]) == record, \
+            'record {:d}: decode and decode_numpy differ'.format(n)
+        assert record[fields.index('seq')] == n & 0xFFFF, \
+            'record {:d}: sequence'.format(n)
+        got = tuple(record[fields.index(name)] for name in (
+            'position_0', 'position_1', 'setpoint_0', 'setpoint_1',
+            'actuation_0', 'actuation_1', 'job_offset'))
+        assert got == expected[n], 'record {:d}: {} != {}'.format(
+            n, got, expected[n])
+    print('{:d} records through a {:d} byte ring, {:d} bytes with {:d} zero '
+          'bytes in the records: decode and decode_numpy agree'.format(
+              count, ring_size, len(data),
+              sum(struct.pack(telemetry_.RECORD, *record).count(0)
+                  for record in records)))
+    return count
+
+
+def queue(items=20000, sizes=(16, 64, 256)):
+    '''
+    Compares moving items through a task_share.Queue one at a time with
+    put() and get() (interrupts disabled for each), one at a time with the
+    lock-free single producer try_put() and try_get(), and in bulk with
+    put_many() and get_many(). The queue is filled and emptied in turn.
+    @param items Number of items moved through each queue
+    @param sizes Queue sizes to compare
+    @return Dictionary of (way, size) to items/s
+    '''
+    import array
+    import task_share
+    items = int(items)
+    results = {}
+
+    def single(q, n):
+        moved = 0
+        while moved < n:
+            while not q.full():
+                q.put(moved)
+            while q.any():
+                q.get()
+                moved += 1
+
+    def spsc(q, n):
+        moved = 0
+        while moved < n:
+            while q.try_put(moved):
+                pass
+            while q.try_get() is not None:
+                moved += 1
+
+    def bulk(q, n, block):
+        moved = 0
+        while moved < n:
+            q.put_many(block)
+            moved += q.get_many(block)
+
+    ways = ('put/get', 'try_put/try_get', 'put_many/get_many')
+    for size in sizes:
+        block = array.array('i', range(size))
+        for way in ways:
+            q = task_share.Queue('i', size, spsc = way != 'put/get',
+                                 name = 'Bench')
+            start = _now_us()
+            if way == 'put/get':
+                single(q, items)
+            elif way == 'try_put/try_get':
+                spsc(q, items)
+            else:
+                bulk(q, items, block)
+            t = utime.ticks_diff(_now_us(), start)
+            results[(way, size)] = items*1000000/t if t > 0 else 0
+            task_share.share_list.remove(q)
+    print('{:20s}'.format('items/s') + ''.join('{:>12d}'.format(size)
+                                               for size in sizes))
+    for way in ways:
+        print('{:20s}'.format(way) + ''.join(
+              '{:12.0f}'.format(results[(way, size)]) for size in sizes))
+    return results
+
+
+def struct_share(count=1000, size=6):
+    '''
+    Checks that a task_share.StructShare read while it is being written is
+    never torn, then times put() and get_into() and measures the memory
+    they allocate, which must be none for an ISR to call them. The writer
+    is interleaved with the reader by hand: part way through a write made
+    with begin() and set(), where an ISR reader must give up, and part way
+    through a task reader's copy, which must try again and end with the
+    whole new record.
+    @param count Number of calls timed
+    @param size Number of items in the record
+    @return Dictionary of call to (time [us], bytes allocated) per call
+    '''
+    import array
+    import task_share
+    count = int(count)
+    size = int(size)
+    share = task_share.StructShare('i', size, name = 'Bench')
+    old = array.array('i', [1]*size)
+    new = array.array('i', [2]*size)
+    copy = array.array('i', [0]*size)
+    share.put(old)
+
+    # A write cut off half way by an ISR reader
+    share.begin()
+    for index in range(size//2):
+        share.set(index, 2)
+    assert not share.get_into(copy, in_ISR = True), 'read a torn record'
+    for index in range(size//2, size):
+        share.set(index, 2)
+    share.commit()
+    assert share.get_into(copy) and copy == new, 'lost the record'
+
+    class Interrupted:
+        '''
+        Destination of a copy which the writer interrupts half way, as an
+        ISR would.
+        '''
+        def __init__(self):
+            self.items = array.array('i', [0]*size)
+            self.writes = 0
+
+        def __setitem__(self, index, value):
+            self.items[index] = value
+            self.writes += 1
+            if self.writes == size//2 + 1:
+                share.put(old, in_ISR = True)
+
+    share.put(new)
+    retries = share.retries
+    dest = Interrupted()
+    assert share.get_into(dest), 'gave up'
+    assert dest.items == old, 'read a torn record'
+    assert share.retries == retries + 1, 'did not try again'
+    print('interleaved writes: no torn reads, {:d} retry'.format(
+          share.retries - retries))
+
+    def puts(n):
+        for _ in range(n):
+            share.put(new)
+
+    def gets(n):
+        for _ in range(n):
+            share.get_into(copy)
+
+    results = {}
+    for name, func in (('put', puts), ('get_into', gets)):
+        start = _now_us()
+        func(count)
+        t = utime.ticks_diff(_now_us(), start)/count
+        results[name] = (t, _heap(func, count)/count)
+    task_share.share_list.remove(share)
+    print('{:20s}{:>10s}{:>12s}'.format('per call', 'time [us]',
+                                        'alloc [B]'))
+    for name, (t, used) in results.items():
+        print('{:20s}{:10.2f}{:12.1f}'.format(name, t, used))
+    return results
+
+
+def _split_line(line):
+    '''
+    Parses a job line the way main.py did before jobreader.py, by splitting
+    strings.
+    @param line A line of the job file
+    @return List of the command and the ticks, or for AR the command, the
+    profile name and its tolerance, speed and dwell
+    '''
+    line = line[1:-1]
+    command_list = line.split(';')
+    com = command_list[0][1:]
+    if com == 'AR':
+        return [com, command_list[1], int(command_list[2]),
+                int(command_list[3]), int(command_list[4].rstrip("']"))]
+    if com != 'PU' and com != 'PD':
+        return [com]
+    points = command_list[2][4:-2].replace("'", "")
+    return [com] + [int(x) for pair in points.split(',')
+                    for x in pair.split('x')]
+
+
+def _reader_line(reader):
+    '''
+    Turns the line a JobReader has just decoded with next() into the list
+    _split_line makes, reading all of its windows of points with more().
+    @param reader The jobreader.JobReader
+    @return List of the command and the ticks, or for AR the command, the
+    profile name and its numbers
+    '''
+    import jobreader
+    name = jobreader.NAMES[reader.command]
+    if reader.command == jobreader.AR:
+        return [name, reader.name_str()] + list(
+            reader.args[:reader.n_args])
+    if reader.command != jobreader.PU and reader.command != jobreader.PD:
+        return [name]
+    line = [name]
+    while reader.n_points:
+        line.extend(reader.points[:2*reader.n_points])
+        reader.more()
+    return line
+
+
+def check_parse(job_file=None, max_points=8):
+    '''
+    Checks that jobreader.JobReader decodes the same commands, AR profiles
+    and ticks as the string splits main.py used before it, line by line,
+    for a job file and for a dense job written by dense_job(). The window
+    is kept small so long strokes are read in many windows.
+    @param job_file The job file, None to check only the dense job
+    @param max_points Points in a window of the reader
+    @return The number of lines checked
+    '''
+    import os
+    import jobreader
+    dense = 'check_parse.txt'
+    dense_job(dense, strokes=3, points=5*int(max_points) + 3)
+    lines = 0
+    try:
+        for name in ((job_file, dense) if job_file else (dense,)):
+            with open(name, 'r') as text, open(name, 'rb') as binary:
+                reader = jobreader.JobReader(binary,
+                                             max_points=int(max_points))
+                for number, line in enumerate(text):
+                    if not line.strip():
+                        continue
+                    # The string splits expect the newline readline() keeps
+                    expected = _split_line(line.rstrip('\r\n') + '\n')
+                    reader.next()
+                    got = _reader_line(reader)
+                    assert got == expected, '{:s} line {:d}: {} != {}'.format(
+                        name, number + 1, got, expected)
+                    lines += 1
+                assert reader.next() == jobreader.NONE, \
+                    '{:s}: lines after the end'.format(name)
+    finally:
+        os.remove(dense)
+    print('JobReader matches the string splits on {:d} lines'.format(lines))
+    return lines
+
+
+def _heap(func, arg):
+    '''
+    Measures the memory allocated by a function: gc.mem_alloc() deltas with
+    the garbage collector off on the board, the peak of tracemalloc on the
+    host.
+    @param func The function to measure
+    @param arg The argument passed to func
+    @return Bytes allocated
+    '''
+    import gc
+    if hasattr(gc, 'mem_alloc'):
+        gc.collect()
+        gc.disable()
+        start = gc.mem_alloc()
+        func(arg)
+        used = gc.mem_alloc() - start
+        gc.enable()
+        return used
+    import tracemalloc
+    tracemalloc.start()
+    func(arg)
+    used = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return used
+
+
+def parse(job_file):
+    '''
+    Compares decoding a job file line by line with string splits against
+    jobreader.JobReader, by time and memory allocated over the whole job.
+    @param job_file The job file
+    @return Dictionary of (time [us], bytes allocated, lines) per way
+    '''
+    import jobreader
+    check_parse(job_file)
+
+    def split(file):
+        lines = 0
+        line = file.readline()
+        while line:
+            _split_line(line)
+            lines += 1
+            line = file.readline()
+        return lines
+
+    def decode(job):
+        while job.next() != jobreader.NONE:
+            pass
+        return job.lines
+
+    results = {}
+    for name, func in (('split', split), ('JobReader', decode)):
+        # Opening the file and making the reader aren't measured, only the
+        # decoding of the lines
+        for measure in ('time', 'heap'):
+            if name == 'split':
+                file = open(job_file, 'r')
+                arg = file
+            else:
+                file = open(job_file, 'rb')
+                arg = jobreader.JobReader(file, max_points=1024)
+            if measure == 'time':
+                start = _now_us()
+                lines = func(arg)
+                t = utime.ticks_diff(_now_us(), start)
+            else:
+                used = _heap(func, arg)
+            file.close()
+        results[name] = (t, used, lines)
+    print('{:12s}{:>8s}{:>12s}{:>14s}'.format('', 'lines', 'time [ms]',
+                                              'alloc [B]'))
+    for name, (t, used, lines) in results.items():
+        print('{:12s}{:8d}{:12.2f}{:14d}'.format(name, lines, t/1000, used))
+    return results
+
+
+class _Discard:
+    '''
+    Output that throws away what is written to it, without buffering it
+    like a file would.
+    '''
+    def write(self, text):
+        return len(text)
+
+
+def long_stroke(points=100000, budget_kb=16, plant_file=None,
+                file_name='long_stroke.txt'):
+    '''
+    Plots one pen down stroke of many points through the simulated
+    firmware and measures the memory it allocates while plotting with
+    tracemalloc (host only). The stroke is a circle wound round until it
+    has the points, about a tick apart.
+    @param points Number of points in the stroke
+    @param budget_kb Most memory the plot may allocate [kB]
+    @param plant_file Plant json from sysid.py, None for the default plants
+    @param file_name The job text file to write
+    @return The simulator results, with the peak allocated [B] as heap
+    '''
+    import os
+    import math
+    import contextlib
+    import tracemalloc
+    import simulator
+    points = int(points)
+    budget_kb = float(budget_kb)
+    radius = 200
+    centre = (800, 0)
+    turn = int(2*math.pi*radius)
+    with open(file_name, 'w') as file:
+        file.write(str(['IN;1; 0x0']) + '\n')
+        file.write(str(['PU;1;', '{:d}x{:d}'.format(centre[0] + radius,
+                                                    centre[1])]) + '\n')
+        # Written a point at a time, the line would not fit in memory here
+        # either
+        file.write("['PD;{:d};'".format(points))
+        for n in range(points):
+            file.write(", '{:d}x{:d}'".format(
+                int(round(centre[0] + radius*math.cos(2*math.pi*n/turn))),
+                int(round(centre[1] + radius*math.sin(2*math.pi*n/turn)))))
+        file.write(']\n')
+        file.write(str(['PU;1;', '{:d}x{:d}'.format(*centre)]) + '\n')
+    plants = simulator.load_plants(plant_file) if plant_file else None
+    sim = simulator.SimPlotter(plants)
+    traced = [0]
+    with open(file_name, 'rb') as file, \
+            contextlib.redirect_stdout(_Discard()):
+        main = sim.setup(file)
+        more = main.reader.more
+
+        def counted():
+            # Counting the points of the stroke read through the window
+            n = more()
+            traced[0] = max(traced[0], main.reader.start + n)
+            return n
+        main.reader.more = counted
+        tracemalloc.start()
+        result = sim.run(timeout_s=100*points)
+        result['heap'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    os.remove(file_name)
+    last = traced[0]
+    print('{:d} points: {:s} in {:.1f} s ({:.1f} s on the host), {:d} '
+          'points read, {:.1f} kB allocated'.format(points,
+          'finished' if result['finished'] else 'not finished',
+          result['plot_time'], result['host_time'], last,
+          result['heap']/1024))
+    if (not result['finished'] or last != points
+            or result['heap'] > budget_kb*1024):
+        raise AssertionError('The stroke did not plot within '
+                             + str(budget_kb) + ' kB: '
+                             + str(result['error']))
+    return result
+
+
+def dense_job(file_name, strokes=4, points=100, radius=200, centre=(800, 0)):
+    '''
+    Writes a job of dense pen down strokes in the format of
+    parse_hpgl.output_text: circles in tick space with many close points.
+    @param file_name The job text file to write
+    @param strokes Number of circles
+    @param points Number of points per circle
+    @param radius Radius of the circles [ticks]
+    @param centre Centre of the first circle [ticks]
+    '''
+    import math
+    with open(file_name, 'w') as file:
+        file.write(str(['IN;1; 0x0']) + '\n')
+        for stroke in range(strokes):
+            x0 = centre[0] + stroke*radius//2
+            y0 = centre[1] + stroke*radius//2
+            ticks = ['{:d}x{:d}'.format(
+                int(round(x0 + radius*math.cos(2*math.pi*n/points))),
+                int(round(y0 + radius*math.sin(2*math.pi*n/points))))
+                for n in range(points + 1)]
+            file.write(str(['PU;1;', ticks[0]]) + '\n')
+            file.write(str(['PD;{:d};'.format(len(ticks))] + ticks) + '\n')
+        file.write(str(['PU;1;', '{:d}x{:d}'.format(*centre)]) + '\n')
+        file.write(str(['IN;1; 0x0']) + '\n')
+
+
+if __name__ == '__main__':
+    benches = {'io': io, 'tasks': tasks, 'command': command,
+               'arrival': arrival, 'pen': pen, 'fifo': fifo,
+               'printing': printing, 'stream': stream,
+               'stream_rate': stream_rate, 'fleet': fleet,
+               'resume': resume,
+               'telemetry': telemetry,
+               'telemetry_check': telemetry_check, 'queue': queue,
+               'struct_share': struct_share,
+               'parse': parse, 'check_parse': check_parse,
+               'long_stroke': long_stroke,
+               'dense_job': dense_job}
+    if len(sys.argv) < 2:
+        io()
+    else:
+        benches[sys.argv[1]](*sys.argv[2:])
@@ -0,0 +1,307 @@
+'''
+@file capture.py
+@authors Sam Lee and Dima Kyle
+Response capture python file. It has the class ResponseCapture which records
+the time, position, error and actuation of a controller into preallocated
+arrays so step responses can be recorded at the full control rate without
+growing the heap.
+
+The capture keeps a pre-trigger window running as a ring buffer. When the
+capture is triggered (by hand or by a new setpoint) a fixed number of
+post-trigger samples are recorded and the capture stops. The recorded data
+can then be printed as text or sent as one binary block over the USB VCP.
+
+Ex:
+@code
+cap = capture.ResponseCapture(size=256, pre=32, decimate=1)
+motor_1_task.control.set_capture(cap)
+cap.arm()
+motor_1_task.control.set_setpoint(4000)    # Triggers the capture
+...
+if cap.done:
+    cap.export(pyb.USB_VCP())
+@endcode
+'''
+
+import array
+import struct
+
+## Magic bytes at the start of an exported capture
+MAGIC = b'CAP1'
+## Header layout: magic, axis, number of samples, trigger index, decimation,
+## setpoint at the trigger
+HEADER = '<4sHHHHi'
+## Size in bytes of the header
+HEADER_SIZE = struct.calcsize(HEADER)
+
+## Capture is not recording
+IDLE = 0
+## Capture is filling the pre-trigger ring and waiting for a trigger
+ARMED = 1
+## Capture has been triggered and is recording the post-trigger window
+TRIGGERED = 2
+## Capture has finished and the data can be read out
+DONE = 3
+
+
+class ResponseCapture:
+    '''
+    This class records controller samples into preallocated arrays. Time is
+    kept in microseconds relative to the moment the capture was armed in an
+    array('i'), position in an array('i'), and the error and actuation in
+    array('h'). The error is clipped to the range of a signed short and the
+    actuation is stored in hundredths of a percent.
+
+    Class methods are:
+    arm(), trigger(), sample(), get(), get_arrays(), export(), print_csv()
+
+    The following are not parameters of the constructor but are attributes
+    that are useful to know about.
+    @param state One of IDLE, ARMED, TRIGGERED or DONE
+    @param done True when the post-trigger window has been recorded
+    @param trig_setpoint The setpoint at the time of the trigger
+    '''
+    def __init__(self, size=256, pre=32, decimate=1, axis=0,
+                 trigger_on_setpoint=True):
+        '''
+        Constructor which allocates the capture buffers. Nothing else is
+        allocated while recording.
+        @param size Total number of samples held by the capture
+        @param pre Number of samples kept from before the trigger
+        @param decimate Only every decimate-th sample is recorded
+        @param axis The axis (motor number) the capture belongs to
+        @param trigger_on_setpoint If True, a new setpoint triggers the
+        capture when it is armed.
+        '''
+        if not 0 <= pre < size:
+            raise ValueError('pre must be between 0 and size-1')
+        ## Number of samples the capture can hold
+        self.size = size
+        ## Number of pre-trigger samples kept
+        self.pre = pre
+        ## Number of post-trigger samples recorded
+        self.post = size - pre
+        ## Record one sample of every decimate samples
+        self.decimate = max(1, int(decimate))
+        ## Axis number written into the export header
+        self.axis = axis
+        ## Whether set_setpoint should trigger the capture
+        self.trigger_on_setpoint = trigger_on_setpoint
+        ## Time of each sample in microseconds since arm()
+        self.t = array.array('i', bytes(4*size))
+        ## Measured position of each sample
+        self.position = array.array('i', bytes(4*size))
+        ## Error of each sample clipped to a signed short
+        self.error = array.array('h', bytes(2*size))
+        ## Actuation of each sample in hundredths of a percent
+        self.actuation = array.array('h', bytes(2*size))
+        ## Setpoint at the trigger
+        self.trig_setpoint = 0
+        self.state = IDLE
+        self.done = False
+        # Ring buffer write index and number of valid samples
+        self._idx = 0
+        self._count = 0
+        # Index of the first post-trigger sample and samples left to record
+        self._trig_idx = 0
+        self._remaining = 0
+        # Decimation counter and time origin
+        self._dec = 0
+        self._t0 = None
+
+
+    def arm(self, t_now=None):
+        '''
+        Clears the capture and starts filling the pre-trigger window.
+        @param t_now The time in microseconds to use as the time origin. By
+        default the time of the first sample is used.
+        '''
+        self._idx = 0
+        self._count = 0
+        self._dec = 0
+        self._t0 = t_now
+        self._remaining = 0
+        self.done = False
+        self.state = ARMED
+
+
+    def trigger(self, setpoint=0):
+        '''
+        Triggers the capture. Only the last pre samples before the trigger
+        are kept and the next post samples are recorded. Does nothing if the
+        capture is not armed.
+        @param setpoint The setpoint at the trigger, kept for the header
+        '''
+        if self.state != ARMED:
+            return
+        self.trig_setpoint = setpoint
+        # Drop pre-trigger samples that would be overwritten by the window
+        if self._count > self.pre:
+            self._count = self.pre
+        self._trig_idx = self._idx
+        self._remaining = self.post
+        self.state = TRIGGERED
+
+
+    def sample(self, t_us, position, error, actuation):
+        '''
+        Records one sample if the capture is armed or triggered. This is
+        called by the controller every time the algorithm runs and does not
+        allocate.
+        @param t_us The time of the sample from utime.ticks_us()
+        @param position The measured position
+        @param error The error between the setpoint and the position
+        @param actuation The actuation in percent
+        '''
+        if self.state == IDLE or self.state == DONE:
+            return
+        self._dec += 1
+        if self._dec < self.decimate:
+            return
+        self._dec = 0
+        if self._t0 is None:
+            self._t0 = t_us
+        i = self._idx
+        # Wrapping subtraction so the time stays right across ticks rollover
+        self.t[i] = (t_us - self._t0) & 0x3FFFFFFF
+        self.position[i] = position
+        if error > 32767:
+            error = 32767
+        elif error < -32768:
+            error = -32768
+        self.error[i] = int(error)
+        self.actuation[i] = int(actuation*100)
+        i += 1
+        if i >= self.size:
+            i = 0
+        self._idx = i
+        if self._count < self.size:
+            self._count += 1
+        if self.state == TRIGGERED:
+            self._remaining -= 1
+            if self._remaining <= 0:
+                self.state = DONE
+                self.done = True
+
+
+    def __len__(self):
+        '''
+        @return The number of valid samples in the capture
+        '''
+        return self._count
+
+
+    def _start(self):
+        '''
+        @return The ring index of the oldest valid sample
+        '''
+        start = self._idx - self._count
+        if start < 0:
+            start += self.size
+        return start
+
+
+    def trigger_index(self):
+        '''
+        @return The chronological index of the first post-trigger sample
+        '''
+        if self.state < TRIGGERED:
+            return self._count
+        index = self._trig_idx - self._start()
+        if index < 0:
+            index += self.size
+        return index
+
+
+    def get(self, n):
+        '''
+        Returns one sample in chronological order.
+        @param n The chronological index of the sample
+        @return (time [us], position, error, actuation [%])
+        '''
+        i = self._start() + n
+        if i >= self.size:
+            i -= self.size
+        return (self.t[i], self.position[i], self.error[i],
+                self.actuation[i]/100)
+
+
+    def get_arrays(self):
+        '''
+        Copies the capture out into new arrays in chronological order. This
+        allocates, so it should be called after the capture is done.
+        @return [time, position, error, actuation]
+        '''
+        out = []
+        for buf in (self.t, self.position, self.error, self.actuation):
+            arr = array.array(buf.typecode)
+            for lo, hi in self._spans():
+                arr.extend(buf[lo:hi])
+            out.append(arr)
+        return out
+
+
+    def _spans(self):
+        '''
+        @return The one or two (start, stop) ring spans of valid samples in
+        chronological order
+        '''
+        start = self._start()
+        end = start + self._count
+        if end <= self.size:
+            return ((start, end),)
+        return ((start, self.size), (0, end - self.size))
+
+
+    def export(self, stream):
+        '''
+        Writes the capture to a stream (such as pyb.USB_VCP or a file) as a
+        header followed by the raw time, position, error and actuation arrays
+        in chronological order. Data is sent straight from the buffers
+        through memoryview slices.
+        @param stream An object with a write() method
+        '''
+        stream.write(struct.pack(HEADER, MAGIC, self.axis, self._count,
+                                 self.trigger_index(), self.decimate,
+                                 self.trig_setpoint))
+        spans = self._spans()
+        for buf in (self.t, self.position, self.error, self.actuation):
+            view = memoryview(buf)
+            for lo, hi in spans:
+                stream.write(view[lo:hi])
+
+
+    def print_csv(self):
+        '''
+        Prints the capture as comma separated time [s], position, error and
+        actuation lines.
+        '''
+        for n in range(self._count):
+            t, pos, err, act = self.get(n)
+            print('{:10.6f}, {:d}, {:d}, {:7.2f}'.format(t*1e-6, pos, err,
+                                                         act))
+
+
+def read_export(stream):
+    '''
+    Reads one capture written by ResponseCapture.export back from a stream.
+    This is meant for the host side.
+    @param stream An object with a read() method such as a file or serial port
+    @return A dictionary with the header fields and time, position, error
+    and actuation arrays
+    '''
+    header = stream.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+        raise EOFError('Incomplete capture header')
+    magic, axis, count, trig, decimate, setpoint = struct.unpack(HEADER,
+                                                                 header)
+    if magic != MAGIC:
+        raise ValueError('Not a capture export')
+    capture = {'axis': axis, 'trigger': trig, 'decimate': decimate,
+               'setpoint': setpoint}
+    for name, code in (('t', 'i'), ('position', 'i'), ('error', 'h'),
+                       ('actuation', 'h')):
+        arr = array.array(code)
+        arr.frombytes(stream.read(count*arr.itemsize))
+        capture[name] = arr
+    return capture
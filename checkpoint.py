@@ -0,0 +1,209 @@
+'''
+@file checkpoint.py
+@authors Sam Lee and Dima Kyle
+Checkpoint file. It has the class Checkpoint which keeps the offset of the
+command being plotted in a file on the flash, so a plot that was stopped
+(by an error, a reset or the power going off) can carry on from that
+command instead of from the first line of the job.
+
+Writing the flash wears it and holds up the tasks while it is written, so
+the offset is only saved every period_ms at most, when it has changed and
+when the command task says the pen is up and the motors are at rest. When
+the plot stops on an error it is saved right away. The file has slots
+spacing bytes apart, written in turn, so the saves fall on different
+sectors of the flash and a save cut off half way leaves the one before it.
+Each slot holds a sequence number, the offset, the name and length of the
+job file and a CRC16, and the newest good slot is the checkpoint.
+
+Ex:
+@code
+saved = checkpoint.Checkpoint('checkpoint.bin', period_ms = 60000)
+offset = saved.load('drawing.txt', job_length)
+...
+saved.update(reader.line_offset)
+if saved.due():
+    saved.save()
+@endcode
+'''
+
+import os
+import struct
+import utime
+import telemetry
+
+## Start of a slot
+MAGIC = 0x4B435043
+## Offset saved once the job has been plotted
+FINISHED = 0xFFFFFFFF
+## Layout of a slot: magic, sequence, offset, job length, job name, CRC16
+SLOT = '<IIII32sH'
+## Size of a slot [bytes]
+SLOT_SIZE = struct.calcsize(SLOT)
+
+
+class Checkpoint:
+    '''
+    This class saves the offset in the job file of the command being
+    plotted to a file on the flash and loads it again after a restart.
+    '''
+    def __init__(self, file_name='checkpoint.bin', period_ms=60000, slots=8,
+                 spacing=1024):
+        '''
+        @param file_name Name of the checkpoint file on the flash
+        @param period_ms Shortest time between saves [ms]
+        @param slots Number of slots in the file
+        @param spacing Bytes from one slot to the next, at least SLOT_SIZE
+        '''
+        ## Name of the checkpoint file
+        self.file_name = file_name
+        ## Shortest time between saves [ms]
+        self.period_ms = period_ms
+        ## Offset of the command being plotted, -1 before the first
+        self.offset = -1
+        ## Offset last saved
+        self.saved = -1
+        ## Number of saves
+        self.saves = 0
+        # Number of slots, bytes between them and the next slot to write
+        self._slots = slots
+        self._spacing = max(spacing, SLOT_SIZE)
+        self._slot = 0
+        # Sequence number of the last slot written
+        self._seq = 0
+        # Name and length of the job file
+        self._name = b''
+        self._length = 0
+        # Slot being written or read
+        self._buf = bytearray(SLOT_SIZE)
+        # Time of the last save [ms]
+        self._last = utime.ticks_ms()
+        # The open checkpoint file
+        self._file = None
+
+
+    def load(self, job_name, job_length):
+        '''
+        Finds the checkpoint of a job and gets ready to save the job's.
+        @param job_name Name of the job file
+        @param job_length Length of the job file [bytes]
+        @return Offset in the job file of the command to carry on from, 0 if
+        there is no checkpoint of this job or it was finished
+        '''
+        self._name = job_name.encode()[:32]
+        self._length = job_length
+        offset = 0
+        newest = -1
+        try:
+            file = open(self.file_name, 'rb')
+        except OSError:
+            file = None
+        if file is not None:
+            for slot in range(self._slots):
+                file.seek(slot*self._spacing)
+                if file.readinto(self._buf) != SLOT_SIZE:
+                    break
+                magic, seq, saved, length, name, crc = struct.unpack(
+                    SLOT, self._buf)
+                if magic != MAGIC or crc != telemetry.crc16(
+                        self._buf, SLOT_SIZE - 2):
+                    continue
+                if newest < 0 or seq > self._seq:
+                    newest = slot
+                    self._seq = seq
+                    match = length == job_length and \
+                        name.rstrip(b'\0') == self._name
+                    offset = saved if match and saved != FINISHED else 0
+            file.close()
+        self._slot = (newest + 1) % self._slots
+        self.offset = offset
+        self.saved = offset
+        return offset
+
+
+    def update(self, offset):
+        '''
+        Sets the offset of the command being plotted, without saving it.
+        @param offset Offset of the command in the job file
+        '''
+        self.offset = offset
+
+
+    def due(self):
+        '''
+        @return True if the offset has changed since it was saved and the
+        last save was at least period_ms ago
+        '''
+        return self.offset != self.saved and utime.ticks_diff(
+            utime.ticks_ms(), self._last) >= self.period_ms
+
+
+    def save(self):
+        '''
+        Writes the offset to the next slot of the file on the flash, unless
+        it is the offset saved already.
+        '''
+        if self.offset < 0 or self.offset == self.saved:
+            return
+        if self._file is None:
+            self._open()
+        self._seq += 1
+        struct.pack_into(SLOT, self._buf, 0, MAGIC, self._seq, self.offset,
+                         self._length, self._name, 0)
+        struct.pack_into('<H', self._buf, SLOT_SIZE - 2,
+                         telemetry.crc16(self._buf, SLOT_SIZE - 2))
+        self._file.seek(self._slot*self._spacing)
+        self._file.write(self._buf)
+        self._file.flush()
+        if hasattr(os, 'sync'):
+            os.sync()
+        self._slot = (self._slot + 1) % self._slots
+        self.saved = self.offset
+        self.saves += 1
+        self._last = utime.ticks_ms()
+
+
+    def finish(self):
+        '''
+        Saves that the job has been plotted, so it isn't carried on.
+        '''
+        self.offset = FINISHED
+        self.save()
+        self.close()
+
+
+    def close(self):
+        '''
+        Closes the checkpoint file.
+        '''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+    def _open(self):
+        '''
+        Opens the checkpoint file for writing its slots, making it first if
+        it isn't there or is too short.
+        '''
+        try:
+            file = open(self.file_name, 'r+b')
+            file.seek(0, 2)
+            if file.tell() >= self._slots*self._spacing:
+                self._file = file
+                return
+            file.close()
+        except OSError:
+            pass
+        with open(self.file_name, 'wb') as file:
+            blank = bytearray(self._spacing)
+            for slot in range(self._slots):
+                file.write(blank)
+        self._file = open(self.file_name, 'r+b')
+
+
+    def __repr__(self):
+        '''
+        @return The offset saved and the number of saves
+        '''
+        return 'Checkpoint {:s} offset {:d}, {:d} saves'.format(
+            self.file_name, self.saved, self.saves)
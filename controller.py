@@ -7,8 +7,35 @@ and repeatedly output an actuation value that is sent to the motor for this
 lab, but generally could be sent to any device as a generic controller.
 '''
 
+import array
+import struct
 import utime
 
+## Magic bytes at the start of a gain table file
+GAIN_TABLE_MAGIC = b'GTB1'
+## Gain table file header: magic, number of entries, tick position of the
+## first entry, ticks between entries. The header is followed by K_P, K_I,
+## K_D float triplets.
+GAIN_TABLE_HEADER = '<4sIii'
+
+
+def load_gain_table(file_name):
+    '''
+    Loads a gain table made by make_gain_table.py into a compact array.
+    @param file_name The gain table file
+    @return (table, start, step) where table is an array('f') of K_P, K_I,
+    K_D triplets
+    '''
+    size = struct.calcsize(GAIN_TABLE_HEADER)
+    with open(file_name, 'rb') as file:
+        magic, n, start, step = struct.unpack(GAIN_TABLE_HEADER,
+                                              file.read(size))
+        if magic != GAIN_TABLE_MAGIC:
+            raise ValueError('Not a gain table')
+        table = array.array('f', file.read(12*n))
+    return table, start, step
+
+
 class Controller:
     '''
     This class implements closed-loop proportional control 
@@ -18,15 +45,16 @@ class Controller:
     
     This class has the following methods:
     _init_(), algorithm(), set_gain(), set_KI(),set_KD(),set_KW(),
-    set_setpoint(), print_response(), get_response().
+    set_setpoint(), set_capture(), set_gain_table(), schedule(),
+    print_response(), get_response().
     The constructor first sets all the necessary parameters for the controller
     to work. Algorithm returns an actuation value that can be generally set
     to anything as a generic controller. The algorithm method takes the 
     subtraction of the setpoint parameter (motor position input for this 
     project) and the actual measured parameter (measured motor position for 
-    this project). Set_setpoint creates arrays for specific parameters and 
-    sets the setpoint, which is the desired position for the DC motor in our
-    case. Set_gain sets the proportional control gain for the device.
+    this project). Set_setpoint sets the setpoint, which is the desired 
+    position for the DC motor in our case, and triggers an attached response
+    capture. Set_gain sets the proportional control gain for the device.
     Get_response and print_response are methods which run step response 
     tests each time the enter key is pressed by the user, which reads the 
     resulting data and prints a list of time, actual position, and error 
@@ -50,15 +78,16 @@ class Controller:
     signal multiplied by control gain. This will be a signal sent
     to the motor to control magnitude and direction of motor torque.
     @param actual Measured parameter of device (motor position)
-    @param act_value List of measured motor positions 
-    @param time List for how long motor has run for 
-    @param error_list List of error values between each controller run
+    @param capture Optional capture.ResponseCapture which records time,
+    position, error and actuation for response plots
     @param delta_time Total time elapsed for motor run at one revolution
     @param delta Last actual motor position measured at the end of each 
     test conducted.
     @param accuracy Percent difference from the setpoint and actual 
     values at the last motor position measured.
     @param K_I Integral control constant
+    @param gain_table Optional array('f') of K_P, K_I, K_D triplets indexed
+    by another position (the other joint's ticks) for gain scheduling
     '''
     def __init__ (self):
         '''
@@ -80,12 +109,8 @@ class Controller:
         self.actuation = 0
         ## Measured position of the motor after the setpoint desired is inputed
         self.actual = 0
-        # List of measured motor positions
-        self.act_value = []
-        # List of time values for when motor is running
-        self.time = []
-        # List of calculated error signal values
-        self.error_list = []
+        ## Response capture with preallocated buffers, None when not used
+        self.capture = None
         ## Response time of motor run for one revolution (setpoint=4000) for 
         ## the step response test
         self.delta_time = 0
@@ -113,9 +138,17 @@ class Controller:
         self.act_star = 0
         ## Anti-windup control constant
         self.K_W = 0
+        ## Gain schedule of K_P, K_I, K_D triplets, None when not used
+        self.gain_table = None
+        ## Position of the first gain table entry
+        self.table_start = 0
+        ## Positions between gain table entries
+        self.table_step = 1
+        ## Index of the last gain table entry
+        self.table_last = 0
         
     
-    def algorithm(self, actual):
+    def algorithm(self, actual, velocity=None, t=None):
         '''
         Algorithm is a function that subtracts the measured parameter of the 
         device from the desired setpoint to return an error signal, which 
@@ -123,11 +156,19 @@ class Controller:
         for an actuation value. This actuation signal which controls the 
         magnitude and direction of the device torque is limited to be 
         within -100 and 100 before getting returned.
+        
+        If a measured velocity is given (such as Encoder.velocity) the 
+        derivative term uses it instead of differencing the error over dt.
         @param actual The actual position of the object of interest
+        @param velocity The measured velocity of the object [ticks/s]
+        @param t The time the position was measured from utime.ticks_us(),
+        None to read the time here
         @return actuation The level to set the actuation for control.
         '''
         # For timing in order to calculate derivative control
-        self.t = utime.ticks_us()
+        if t is None:
+            t = utime.ticks_us()
+        self.t = t
         # Delta time, converted into seconds
         self.dt = (self.t - self.prev_t)*10**-6
         # The actual position on the         
@@ -156,13 +197,17 @@ class Controller:
             self.error_sum = -limit
         
         # Derivative control
-        self.derivative = self.K_D*self.d_error/self.dt
+        if velocity is not None:
+            # The error changes opposite to the measured velocity
+            self.derivative = -self.K_D*velocity
+        else:
+            self.derivative = self.K_D*self.d_error/self.dt
         
         # Total actuation
         self.actuation = self.proportional + self.integral + self.derivative
         
         # Setting error and time for next iteration        
-        self.prev_err = self.error
+        self.prev_error = self.error
         self.prev_t = self.t
         
         # Saturation for a*
@@ -170,6 +215,11 @@ class Controller:
             self.actuation = 100
         elif self.actuation <-100:
             self.actuation = -100
+        
+        # Recording the response if a capture is attached
+        if self.capture is not None:
+            self.capture.sample(self.t, self.actual, self.error,
+                                self.actuation)
         return self.actuation
 
 
@@ -210,21 +260,60 @@ class Controller:
         self.K_W = K_W
 
 
+    def set_capture(self, capture):
+        '''
+        This function attaches a response capture to the controller. Every
+        run of the algorithm is then offered to the capture.
+        @param capture A capture.ResponseCapture or None to detach
+        '''
+        self.capture = capture
+
+
+    def set_gain_table(self, table, start, step):
+        '''
+        This function sets a gain schedule. The table holds K_P, K_I, K_D
+        triplets for positions start, start+step, start+2*step and so on,
+        already interpolated, so that schedule() only has to index it.
+        @param table An array('f') of K_P, K_I, K_D triplets, or None to
+        stop scheduling
+        @param start The position of the first entry
+        @param step The positions between entries
+        '''
+        self.gain_table = table
+        self.table_start = start
+        self.table_step = step
+        self.table_last = len(table)//3 - 1 if table is not None else 0
+
+
+    def schedule(self, position):
+        '''
+        This function sets the gains from the gain table entry nearest to
+        a position. Positions outside the table use the end entries.
+        @param position The scheduling position (the other joint's ticks)
+        '''
+        i = (position - self.table_start + self.table_step//2)//self.table_step
+        if i < 0:
+            i = 0
+        elif i > self.table_last:
+            i = self.table_last
+        i *= 3
+        table = self.gain_table
+        self.K_P = table[i]
+        self.K_I = table[i+1]
+        self.K_D = table[i+2]
+
+
     def set_setpoint(self, point):
         '''
-        Method which creates lists for the actual value being measured, 
-        time, and error values to be used for plotting a step response of 
-        the device.
-        
-        Commented lists to hold time, error, and actual position for response
-        These are commented out for now to save memory.
+        Method which sets the setpoint. If a response capture is attached
+        and armed, a change of setpoint triggers it so the step response is
+        recorded.
         
         @param point Point to set as the setpoint.
         '''
-        
-        #self.act_value = []
-        #self.time = []
-        #self.error_list = []
+        if (self.capture is not None and point != self.setpoint
+                and self.capture.trigger_on_setpoint):
+            self.capture.trigger(point)
         self.setpoint = point
 
 
@@ -234,15 +323,18 @@ class Controller:
         the USB serial port to the MicroPython board, reading the resulting 
         actual and time data, and plotting the step response.
         '''
+        cap = self.capture
+        if cap is None or len(cap) == 0:
+            print('No response captured')
+            return
         #start collecting the time data at time 0
-        t_o = self.time[0]
-        for n in self.act_value:
-            index = self.act_value.index(n)
-            print(bytes("{:10.6f} , {:15.6f} , {:15.6f}".format(self.time[index]-t_o,n,self.error_list[index]),'UTF-8'))
-            #print('%15.10f, %15.10f,%15.15f'%(self.time[index],n,self.error_list[index]))
+        t_o = cap.get(0)[0]
+        for index in range(len(cap)):
+            t, n, error, act = cap.get(index)
+            print("{:10.6f} , {:15.6f} , {:15.6f}".format((t-t_o)*10**-6,n,error))
         self.accuracy = abs(self.setpoint-self.actual)*200/abs(self.setpoint+self.actual)
-        self.delta_time = (self.time[-1]-self.time[0])/1000
-        self.delta = (self.act_value[-1]-0)
+        self.delta_time = (cap.get(len(cap)-1)[0]-t_o)*10**-6
+        self.delta = (cap.get(len(cap)-1)[1]-0)
         print('Response Delta: %10.10f'%(self.delta))
         print('Percent Diff:   %10.10f'%(self.accuracy))
         print('Response Time:  %10.10f'%(self.delta_time))
@@ -251,12 +343,14 @@ class Controller:
 
     def get_response(self):
         '''
-        Method that takes the time values and actual measured
-        motor position values, and puts them into a list 
+        Method that copies the time values and actual measured
+        motor position values out of the capture, and puts them into a list 
         for getting time and position response of the motor.
         @return [time, act_value] Returns a list of a time and position
         '''
-        return [self.time,self.act_value]
+        if self.capture is None:
+            return [[], []]
+        return self.capture.get_arrays()[:2]
             
         
         
\ No newline at end of file
@@ -5,8 +5,11 @@ class Encoder. The class Encoder can read the current position and also
 zero the position.
 '''
 
+import array
 import pyb
+import utime
 import io_funcs
+import fastio
 
 class Encoder:
     ''' 
@@ -18,9 +21,21 @@ class Encoder:
         read(self) Returns the motors current position
         zero(self) Zeros the motor's position
         
-    Limited to Channel 1 and 2.     
+    Limited to Channel 1 and 2.
+    
+    Every read also stores the time of the read and updates a velocity
+    estimate in ticks/s. When the position changes by at least m_min ticks
+    between reads the velocity is the change over the time between reads
+    (M method). At low speed, when fewer ticks come in, it is the change
+    over the time since the position last changed (T method), and while
+    the position doesn't change the estimate is kept below one tick over
+    the time since the last change, dropping to zero after timeout_us. The
+    velocity is kept as an integer so reading does not allocate.
+    
+    With fast=True the counter is read straight from the timer's CNT
+    register with machine.mem16 instead of through pyb.Timer.counter().
     '''
-    def __init__ (self, timer, pin_1, pin_2):
+    def __init__ (self, timer, pin_1, pin_2, fast=False):
         '''
         Creates a motor driver by initializing GPIO
         pins and gets first initial position. Ensure that the timer
@@ -40,6 +55,7 @@ class Encoder:
         @param timer The timer wanted to be used.
         @param pin_1 The first pin on the board for encoder Ch A.
         @param pin_2 The second pin on the board for encoder Ch B.
+        @param fast True to read the counter register directly.
         '''
         ## The Timer desired for the encoder with period=0xFFF, prescalar=0
         self.tim = pyb.Timer(timer,period=0xFFFF,prescaler=0)
@@ -71,6 +87,28 @@ class Encoder:
         
         ## A read attribute to hold the current value of encoder's position
         self.read_value = 0
+        
+        ## Time of the last read from utime.ticks_us()
+        self.t = utime.ticks_us()
+        
+        ## Velocity estimate [ticks/s]
+        self.velocity = 0
+        
+        ## Fewest ticks between reads to use the M method
+        self.m_min = 4
+        
+        ## Time without a tick after which the velocity is zero [us]
+        self.timeout_us = 100000
+        
+        # Time of the last change of position
+        self._t_change = self.t
+        
+        ## True if the counter register is read directly
+        self.fast = fast
+        if fast:
+            ## Address of the timer's counter register
+            self.cnt_addr = fastio.cnt_addr(timer)
+            self.read = self.read_fast
 
 
     def read(self):
@@ -78,8 +116,29 @@ class Encoder:
         Method for returning the correct current position of the encoder
         @return position The current position of the encoder        
         '''
-        # Read first defined with the current position of the motor
-        self.read_value = self.tim.counter()
+        # Read first defined with the current position of the motor and the
+        # time of this read
+        return self.update(self.tim.counter(), utime.ticks_us())
+
+
+    def read_fast(self):
+        '''
+        Method for returning the current position of the encoder, reading
+        the counter register directly. Used as read() when fast is True.
+        @return position The current position of the encoder
+        '''
+        return self.update(fastio.mem16[self.cnt_addr], utime.ticks_us())
+
+
+    def update(self, count, t):
+        '''
+        Method for updating the position and velocity from a timer count
+        that has already been latched, such as by AxisGroup.read
+        @param count The timer counter value
+        @param t The time the counter was read from utime.ticks_us()
+        @return position The current position of the encoder
+        '''
+        self.read_value = count
         # Delta defined as difference between the current and last position
         self.delta = self.read_value - self.last_pos
         if self.delta >= 32768:
@@ -93,6 +152,29 @@ class Encoder:
         # Save most recent read value from the encoder to be the last position
         self.last_pos = self.read_value
         
+        if self.delta != 0:
+            if self.delta >= self.m_min or self.delta <= -self.m_min:
+                # M method, ticks counted over the read interval
+                dt = utime.ticks_diff(t, self.t)
+            else:
+                # T method, ticks over the time since the last change
+                dt = utime.ticks_diff(t, self._t_change)
+            if dt > 0:
+                self.velocity = self.delta*1000000//dt
+            self._t_change = t
+        elif self.velocity != 0:
+            dt = utime.ticks_diff(t, self._t_change)
+            if dt > self.timeout_us:
+                self.velocity = 0
+            else:
+                # No tick yet, so the speed is below one tick over dt
+                bound = 1000000//dt if dt > 0 else 0
+                if self.velocity > bound:
+                    self.velocity = bound
+                elif self.velocity < -bound:
+                    self.velocity = -bound
+        self.t = t
+        
         #print('Encoder Position: %15i '%self.position)
 
         return self.position
@@ -105,9 +187,79 @@ class Encoder:
         self.last_pos = self.tim.counter()
         self.position = 0
         self.delta = 0
+        self.t = utime.ticks_us()
+        self.velocity = 0
+        self._t_change = self.t
         
         #print('Zeroing position: %15i'%self.position)
 
+
+class AxisGroup:
+    '''
+    This class reads the encoders of both axes at the same instant. The two
+    timer counters are latched back to back with interrupts disabled, both
+    encoders are updated (including the 16 bit wrap handling) with the
+    same time, and a coherent snapshot of (position 0, position 1, time) is
+    kept in a preallocated array.
+    
+    EX:
+    
+    @code
+    axes = AxisGroup(Encoder_1, Encoder_2)
+    axes.read()
+    print(axes.snapshot[0], axes.snapshot[1], axes.snapshot[2])
+    @endcode
+    '''
+    def __init__ (self, encoder_0, encoder_1):
+        '''
+        Creates an axis group of two encoders.
+        @param encoder_0 The Encoder of axis 0
+        @param encoder_1 The Encoder of axis 1
+        '''
+        ## Encoder of axis 0
+        self.encoder_0 = encoder_0
+        ## Encoder of axis 1
+        self.encoder_1 = encoder_1
+        ## Snapshot of position 0, position 1 and the time of the read [us]
+        ## wrapped to 30 bits like utime.ticks_us()
+        self.snapshot = array.array('i', [encoder_0.position,
+                                          encoder_1.position, 0])
+        # Reading the counter registers directly if both encoders are fast
+        if encoder_0.fast and encoder_1.fast:
+            self.read = self.read_fast
+
+
+    def read(self):
+        '''
+        Method for latching both encoders and updating the snapshot.
+        @return snapshot The array of position 0, position 1 and time
+        '''
+        irq_state = pyb.disable_irq()
+        count_0 = self.encoder_0.tim.counter()
+        count_1 = self.encoder_1.tim.counter()
+        t = utime.ticks_us()
+        pyb.enable_irq(irq_state)
+        self.snapshot[0] = self.encoder_0.update(count_0, t)
+        self.snapshot[1] = self.encoder_1.update(count_1, t)
+        self.snapshot[2] = t & 0x3FFFFFFF
+        return self.snapshot
+
+
+    def read_fast(self):
+        '''
+        Method like read() that latches the counter registers directly.
+        @return snapshot The array of position 0, position 1 and time
+        '''
+        irq_state = pyb.disable_irq()
+        count_0 = fastio.mem16[self.encoder_0.cnt_addr]
+        count_1 = fastio.mem16[self.encoder_1.cnt_addr]
+        t = utime.ticks_us()
+        pyb.enable_irq(irq_state)
+        self.snapshot[0] = self.encoder_0.update(count_0, t)
+        self.snapshot[1] = self.encoder_1.update(count_1, t)
+        self.snapshot[2] = t & 0x3FFFFFFF
+        return self.snapshot
+
                   
 def main():
     '''
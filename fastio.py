@@ -0,0 +1,50 @@
+'''
+@file fastio.py
+@authors Sam Lee and Dima Kyle
+Fast register access file. It has the addresses of the STM32L476 timer
+registers used by the encoders and motors, so their counters and compare
+registers can be read and written directly with machine.mem16 and
+machine.mem32 instead of going through the pyb.Timer methods.
+
+The timers still have to be set up through pyb.Timer first. Only the
+reads of the counter (TIMx->CNT) and the writes of the compare values
+(TIMx->CCRy) are done directly.
+
+Register map from the STM32L4x6 reference manual (RM0351), section 2.2.2.
+'''
+
+import machine
+
+## Base address of each timer
+TIM_BASE = {1: 0x40012C00, 2: 0x40000000, 3: 0x40000400, 4: 0x40000800,
+            5: 0x40000C00, 8: 0x40013400, 15: 0x40014000, 16: 0x40014400,
+            17: 0x40014800}
+
+## Offset of the counter register
+CNT = 0x24
+## Offset of the auto-reload (period) register
+ARR = 0x2C
+## Offsets of the capture/compare registers of channels 1 to 4
+CCR = (None, 0x34, 0x38, 0x3C, 0x40)
+
+## 16 bit memory access
+mem16 = machine.mem16
+## 32 bit memory access
+mem32 = machine.mem32
+
+
+def cnt_addr(timer):
+    '''
+    @param timer The timer number
+    @return The address of the timer's counter register
+    '''
+    return TIM_BASE[timer] + CNT
+
+
+def ccr_addr(timer, channel):
+    '''
+    @param timer The timer number
+    @param channel The channel number, 1 to 4
+    @return The address of the channel's compare register
+    '''
+    return TIM_BASE[timer] + CCR[channel]
@@ -0,0 +1,315 @@
+'''
+@file gain_sweep.py
+@authors Sam Lee and Dima Kyle
+Gain sweep file for the host computer. It searches K_P, K_I, K_D and the
+arrival tolerance of main.py by running a reference job through the
+simulated firmware (simulator.SimPlotter) for every candidate, in a pool of
+worker processes.
+
+Each candidate is scored by its total plot time. Candidates whose overshoot
+or path error (RMS tracking error while the pen is down) is over the limit,
+or which don't finish the job, are infeasible. Every result is appended to
+a json lines file as soon as it is known, so an interrupted sweep picks up
+where it stopped when run again with the same results file. At the end the
+Pareto front of plot time against path error is printed.
+
+Three searches are available:
+- grid: every combination of grid_points values per parameter
+- random: samples drawn uniformly (log-uniformly for the gains)
+- bayes: a few random samples, then a tree-structured Parzen estimator
+  that proposes candidates which look more like the best results so far
+
+@code
+python gain_sweep.py job.txt --plant plant.json --search bayes --samples 200
+@endcode
+'''
+
+import os
+import json
+import math
+import argparse
+import contextlib
+import itertools
+import multiprocessing
+import numpy
+
+import simulator
+
+## Parameters searched and whether they are searched on a log scale
+PARAMS = (('K_P', True), ('K_I', True), ('K_D', True), ('tolerance', False))
+
+## Default search ranges
+BOUNDS = {'K_P': (0.02, 0.5), 'K_I': (1e-4, 1e-2), 'K_D': (1e-6, 1e-3),
+          'tolerance': (5, 40)}
+
+
+def key(candidate):
+    '''
+    Makes a hashable key of a candidate so repeated candidates are found.
+    @param candidate Dictionary of parameter values
+    @return Tuple of the values rounded to 6 significant digits
+    '''
+    return tuple(float('{:.6g}'.format(candidate[name]))
+                 for name, _ in PARAMS)
+
+
+def evaluate(args):
+    '''
+    Runs the reference job with one candidate. The firmware prints are
+    thrown away. Takes a single tuple so it can be used with Pool.imap.
+    @param args (candidate, job_file, plant_file, limits, timeout_s)
+    @return Dictionary with the candidate, the simulator results, whether
+    it is feasible and its cost
+    '''
+    candidate, job_file, plant_file, limits, timeout_s = args
+    plants = simulator.load_plants(plant_file) if plant_file else None
+    sim = simulator.SimPlotter(plants, gains=(candidate['K_P'],
+                               candidate['K_I'], candidate['K_D']),
+                               tolerance=int(round(candidate['tolerance'])))
+    with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+        result = sim.run_job(job_file, timeout_s)
+    result.update(candidate)
+    over = result['overshoot']/limits['overshoot']
+    path = result['path_error']/limits['path_error']
+    feasible = result['finished'] and over <= 1 and path <= 1
+    result['feasible'] = feasible
+    # Infeasible candidates cost more than any feasible one, more so the
+    # further they are from the limits
+    if feasible:
+        result['cost'] = result['plot_time']
+    else:
+        result['cost'] = 2*timeout_s + max(over, path, 1)
+    return result
+
+
+def load_results(file_name):
+    '''
+    Loads the results of an earlier (possibly interrupted) sweep.
+    @param file_name The json lines results file
+    @return List of result dictionaries, empty if the file doesn't exist
+    '''
+    results = []
+    if not os.path.exists(file_name):
+        return results
+    with open(file_name, 'r') as file:
+        for line in file:
+            try:
+                results.append(json.loads(line))
+            except ValueError:
+                # A line cut short by the interruption
+                continue
+    return results
+
+
+def _from_unit(u, bounds):
+    '''
+    Maps points of the unit cube to parameter values.
+    @param u Array of shape (n, len(PARAMS)) with values in [0, 1]
+    @return List of candidate dictionaries
+    '''
+    out = []
+    for row in u:
+        candidate = {}
+        for (name, log), x in zip(PARAMS, row):
+            lo, hi = bounds[name]
+            if log:
+                candidate[name] = lo*(hi/lo)**x
+            else:
+                candidate[name] = lo + (hi - lo)*x
+        candidate['tolerance'] = int(round(candidate['tolerance']))
+        out.append(candidate)
+    return out
+
+
+def _to_unit(candidates, bounds):
+    '''
+    Maps candidate dictionaries to points of the unit cube.
+    @return Array of shape (n, len(PARAMS))
+    '''
+    u = numpy.empty((len(candidates), len(PARAMS)))
+    for i, candidate in enumerate(candidates):
+        for j, (name, log) in enumerate(PARAMS):
+            lo, hi = bounds[name]
+            if log:
+                u[i, j] = math.log(candidate[name]/lo)/math.log(hi/lo)
+            else:
+                u[i, j] = (candidate[name] - lo)/(hi - lo)
+    return numpy.clip(u, 0, 1)
+
+
+def grid(bounds, points):
+    '''
+    @return Every combination of points values per parameter
+    '''
+    axis = numpy.linspace(0, 1, points)
+    return _from_unit(numpy.array(list(itertools.product(axis,
+                                                         repeat=len(PARAMS)))),
+                      bounds)
+
+
+def random_samples(bounds, count, seed=0):
+    '''
+    @return count random candidates, the same ones for the same seed
+    '''
+    rng = numpy.random.default_rng(seed)
+    return _from_unit(rng.random((count, len(PARAMS))), bounds)
+
+
+def tpe_propose(history, bounds, count, rng, gamma=0.25, draws=256,
+                width=0.1):
+    '''
+    Proposes candidates with a tree-structured Parzen estimator. The
+    results are split into the best fraction gamma and the rest, a Gaussian
+    kernel density is put on each group in the unit cube and, of many
+    candidates drawn around the good results, the ones with the highest
+    ratio of good to bad density are returned.
+    @param history List of result dictionaries
+    @param count Number of candidates to propose
+    @param rng A numpy random Generator
+    @return List of candidate dictionaries
+    '''
+    costs = numpy.array([result['cost'] for result in history])
+    order = numpy.argsort(costs)
+    n_good = max(1, int(math.ceil(gamma*len(history))))
+    points = _to_unit(history, bounds)
+    good = points[order[:n_good]]
+    bad = points[order[n_good:]]
+
+    def density(x, centres):
+        if len(centres) == 0:
+            return numpy.ones(len(x))
+        d2 = ((x[:, None, :] - centres[None, :, :])**2).sum(axis=2)
+        return numpy.exp(-0.5*d2/width**2).mean(axis=1) + 1e-12
+
+    picks = good[rng.integers(len(good), size=draws)]
+    x = numpy.clip(picks + rng.normal(0, width, picks.shape), 0, 1)
+    ratio = density(x, good)/density(x, bad)
+    best = numpy.argsort(ratio)[::-1][:count]
+    return _from_unit(x[best], bounds)
+
+
+def pareto_front(results):
+    '''
+    Finds the feasible results which no other feasible result beats on both
+    plot time and path error.
+    @param results List of result dictionaries
+    @return The Pareto front sorted by plot time
+    '''
+    feasible = sorted((r for r in results if r['feasible']),
+                      key=lambda r: (r['plot_time'], r['path_error']))
+    front = []
+    best_error = math.inf
+    for result in feasible:
+        if result['path_error'] < best_error:
+            front.append(result)
+            best_error = result['path_error']
+    return front
+
+
+def format_results(results):
+    '''
+    Makes a table of results.
+    @return The table as a string
+    '''
+    rows = ['{:>10s}{:>10s}{:>10s}{:>6s}{:>11s}{:>11s}{:>11s}'.format(
+        'K_P', 'K_I', 'K_D', 'TOL', 'TIME [s]', 'OVER', 'PATH ERR')]
+    for r in results:
+        rows.append('{:10.4g}{:10.4g}{:10.4g}{:6d}{:11.3f}{:11.2f}{:11.2f}'
+                    .format(r['K_P'], r['K_I'], r['K_D'], int(r['tolerance']),
+                            r['plot_time'], r['overshoot'], r['path_error']))
+    return '\n'.join(rows)
+
+
+def sweep(job_file, plant_file=None, search='random', samples=50,
+          grid_points=3, initial=16, bounds=None, limits=None,
+          results_file='sweep.jsonl', jobs=None, seed=0, timeout_s=600):
+    '''
+    Runs a gain sweep, appending each result to results_file as soon as it
+    is known and skipping candidates already in it.
+    @param search 'grid', 'random' or 'bayes'
+    @param samples Total number of candidates for random and bayes
+    @param grid_points Values per parameter for grid
+    @param initial Number of random candidates before bayes starts
+    @param bounds Dictionary of (low, high) per parameter, default BOUNDS
+    @param limits Dictionary with the 'overshoot' and 'path_error' limits
+    [ticks]
+    @param jobs Number of worker processes, by default one per CPU
+    @return List of all results, old and new
+    '''
+    bounds = dict(BOUNDS, **(bounds or {}))
+    limits = dict({'overshoot': 50.0, 'path_error': 40.0}, **(limits or {}))
+    history = load_results(results_file)
+    done = {key(result) for result in history}
+    rng = numpy.random.default_rng(seed + len(history))
+    jobs = jobs or multiprocessing.cpu_count()
+
+    with multiprocessing.Pool(jobs) as pool, \
+            open(results_file, 'a') as out:
+        def run_batch(candidates):
+            todo = []
+            for candidate in candidates:
+                if key(candidate) not in done:
+                    done.add(key(candidate))
+                    todo.append((candidate, job_file, plant_file, limits,
+                                 timeout_s))
+            for result in pool.imap_unordered(evaluate, todo):
+                history.append(result)
+                out.write(json.dumps(result) + '\n')
+                out.flush()
+                print('{:4d}  {:7.3f} s  {:s}'.format(len(history),
+                      result['plot_time'],
+                      'ok' if result['feasible'] else 'infeasible'))
+
+        if search == 'grid':
+            run_batch(grid(bounds, grid_points))
+        elif search == 'random':
+            run_batch(random_samples(bounds, samples, seed))
+        elif search == 'bayes':
+            run_batch(random_samples(bounds, min(initial, samples), seed))
+            while len(history) < samples:
+                count = min(jobs, samples - len(history))
+                before = len(history)
+                run_batch(tpe_propose(history, bounds, count, rng))
+                if len(history) == before:
+                    # Every proposal had already been run
+                    run_batch(random_samples(bounds, count,
+                                             int(rng.integers(1 << 30))))
+        else:
+            raise ValueError('Unknown search ' + str(search))
+    return history
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulated gain sweep')
+    parser.add_argument('job', help='reference job file')
+    parser.add_argument('--plant', default=None,
+                        help='plant json from sysid.py')
+    parser.add_argument('--search', choices=('grid', 'random', 'bayes'),
+                        default='random')
+    parser.add_argument('--samples', type=int, default=50)
+    parser.add_argument('--grid-points', type=int, default=3)
+    parser.add_argument('--initial', type=int, default=16)
+    for name, _ in PARAMS:
+        parser.add_argument('--' + name.lower().replace('_', ''), nargs=2,
+                            type=float, default=BOUNDS[name],
+                            metavar=('LOW', 'HIGH'),
+                            help='range of ' + name)
+    parser.add_argument('--max-overshoot', type=float, default=50.0)
+    parser.add_argument('--max-path-error', type=float, default=40.0)
+    parser.add_argument('--results', default='sweep.jsonl')
+    parser.add_argument('--jobs', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='virtual time limit per run [s]')
+    args = parser.parse_args()
+    bounds = {name: tuple(getattr(args, name.lower().replace('_', '')))
+              for name, _ in PARAMS}
+    results = sweep(args.job, args.plant, args.search, args.samples,
+                    args.grid_points, args.initial, bounds,
+                    {'overshoot': args.max_overshoot,
+                     'path_error': args.max_path_error},
+                    args.results, args.jobs, args.seed, args.timeout)
+    front = pareto_front(results)
+    print('\nPareto front ({:d} of {:d} runs):'.format(len(front),
+                                                       len(results)))
+    print(format_results(front))
@@ -0,0 +1,683 @@
+'''
+@file job_server.py
+@authors Sam Lee and Dima Kyle
+Job server file for the host computer. It runs a fleet of pen plotters,
+each with main.py set to stream_job = True, stream_jobs = 0 and
+unattended = True, so none of them has to be taken through the prompts.
+Jobs made by parse_hpgl.py are queued and given to the plotters as they
+become idle, and streamed to them with stream_job.JobStreamer, all
+plotters at once.
+
+The plot time of every job is estimated by running it through the
+simulator (simulator.SimPlotter) with the plant models of each plotter,
+in other processes so the server isn't held up. When a plotter is idle it
+gets the job the policy picks: 'lpt' takes the longest job first, which
+keeps the fleet finishing together, and 'fifo' the oldest. A job goes to
+the idle plotter which would plot it in the least time. Each plotter
+learns how long its plots take compared with the estimate, so a slower
+machine gets its estimates scaled up.
+
+The progress of each plot is the job offset in the telemetry records the
+plotter sends (main.py with telemetry_decimate set). The queue depth, the
+state, progress and utilisation (time spent plotting) of each plotter and
+the throughput of the fleet are printed every report_s seconds and
+written to a json file.
+
+Plotters are given as ports, each with an optional plant json from
+sysid.py for its estimates:
+
+@code
+python job_server.py /dev/ttyACM0=plant_0.json /dev/ttyACM1 --jobs *.txt
+@endcode
+
+With --listen the server takes more jobs while it runs, one command per
+line over TCP: "submit <job file>" answers with the job id, "status" with
+the metrics as json.
+
+@code
+python job_server.py /dev/ttyACM0 /dev/ttyACM1 --listen 7878
+echo "submit drawing.txt" | nc -q 1 localhost 7878
+@endcode
+
+A fleet of simulated plotters on pseudo terminals (simulator.py) tests
+it all on one computer:
+
+@code
+python job_server.py --simulate 3 --jobs a.txt b.txt c.txt d.txt --until-done
+@endcode
+
+A plotter which can't be opened is shown offline, and a job given to it
+goes back to the queue if the plotter stays offline for offline_s before
+the job starts. Once a plotter has started a job it finishes it there,
+resuming when the plotter comes back. A plotter still busy with a job the
+server didn't give it (after the server restarted) is left to finish it.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+import concurrent.futures
+import stream_job
+import serial_capture
+
+
+def estimate(data, plant_file=None, timeout_s=1e6):
+    '''
+    Estimates the plot time of a job by running it through the simulator.
+    The simulator replaces the pyb and utime modules, so this is run in
+    another process.
+    @param data The bytes of the job
+    @param plant_file Plant json from sysid.py, None for the default plants
+    @param timeout_s Longest plot simulated [s]
+    @return The simulated plot time [s]
+    '''
+    import io
+    import contextlib
+    import simulator
+    plants = simulator.load_plants(plant_file) if plant_file else None
+    sim = simulator.SimPlotter(plants)
+    with open(os.devnull, 'w') as log, contextlib.redirect_stdout(log):
+        sim.setup(io.BytesIO(data))
+        result = sim.run(timeout_s)
+    if result['error'] is not None:
+        raise RuntimeError(result['error'])
+    return result['plot_time']
+
+
+class Job:
+    '''
+    Class which holds a job of the queue: its bytes, its estimates and
+    where and when it was plotted.
+    '''
+    def __init__(self, name, data):
+        '''
+        @param name Name of the job, such as its file name
+        @param data The bytes of the job
+        '''
+        ## Name of the job
+        self.name = name
+        ## The bytes of the job
+        self.data = data
+        ## Id of the job sent to the plotter, random so a job given again
+        ## isn't taken for the one a plotter just finished
+        self.id = random.getrandbits(32) or 1
+        ## 'estimating', 'queued', 'plotting', 'done' or 'failed'
+        self.state = 'estimating'
+        ## Estimated plot time of each plant file [s]
+        self.estimates = {}
+        ## The Plotter plotting it
+        self.plotter = None
+        ## Times it was submitted, started and finished [s]
+        self.submitted = time.monotonic()
+        self.started = None
+        self.finished = None
+        ## Why estimating it failed
+        self.error = None
+
+
+    def to_dict(self):
+        '''
+        @return The state of the job for the metrics
+        '''
+        now = time.monotonic()
+        return {'name': self.name, 'id': '{:08x}'.format(self.id),
+                'state': self.state, 'bytes': len(self.data),
+                'estimates_s': dict((str(key), value) for key, value
+                                    in self.estimates.items()),
+                'plotter': self.plotter.name if self.plotter else None,
+                'wait_s': (self.started or now) - self.submitted,
+                'plot_s': (self.finished or now) - self.started
+                          if self.started else 0.0,
+                'error': self.error}
+
+
+class Progress:
+    '''
+    Class which takes the telemetry records out of the output of a plotter
+    (as the console of its JobStreamer) for the progress of the job.
+    '''
+    def __init__(self):
+        ## Job offset of the last record
+        self.offset = 0
+        ## Records received
+        self.records = 0
+        ## Time the last record came [s]
+        self.last = None
+        # Decoder of the telemetry frames
+        self._parser = serial_capture.FrameParser()
+
+
+    def write(self, data):
+        '''
+        @param data Bytes the plotter sent
+        '''
+        records = self._parser.feed(bytes(data))
+        if len(records):
+            self.offset = int(records['job_offset'][-1])
+            self.records += len(records)
+            self.last = time.monotonic()
+
+
+    def flush(self):
+        '''
+        Does nothing, for the JobStreamer to use it like a file.
+        '''
+        pass
+
+
+    def reset(self):
+        '''
+        Starts again for the next job.
+        '''
+        self.offset = 0
+
+
+class Plotter:
+    '''
+    Class which holds one plotter of the fleet: its JobStreamer, which
+    keeps the port open, its state and its statistics.
+    '''
+    def __init__(self, name, port, plant_file=None, packet=512):
+        '''
+        @param name Name of the plotter
+        @param port Name of its serial port
+        @param plant_file Plant json from sysid.py for its estimates, None
+        for the default plants
+        @param packet Most bytes of a job in one data message
+        '''
+        ## Name of the plotter
+        self.name = name
+        ## Plant json for its estimates
+        self.plant_file = plant_file
+        ## Telemetry progress of the job
+        self.progress = Progress()
+        ## The stream_job.JobStreamer of the plotter
+        self.streamer = stream_job.JobStreamer(port, packet=packet,
+                                               console=self.progress,
+                                               wait_done=True,
+                                               keep_open=True)
+        ## 'offline', 'busy' (with a job from elsewhere), 'idle' or
+        ## 'plotting'
+        self.state = 'offline'
+        ## The Job given to it
+        self.job = None
+        ## Jobs plotted
+        self.jobs = 0
+        ## Bytes of the jobs plotted
+        self.bytes = 0
+        ## Time spent plotting [s]
+        self.busy_s = 0.0
+        ## Plot time over estimated plot time, None until a job is plotted
+        self.speed = None
+        ## Set when the plotter is given a job
+        self.wake = asyncio.Event()
+
+
+    def predict(self, job, speed=1.0):
+        '''
+        @param job The Job, with its estimate for this plotter
+        @param speed Ratio to use until the plotter has learned its own
+        @return The time the plotter is expected to take to plot it [s]
+        '''
+        ratio = self.speed if self.speed is not None else speed
+        return job.estimates[self.plant_file]*ratio
+
+
+    def learn(self, job, plot_s):
+        '''
+        Learns the ratio of plot time to estimate from a job plotted.
+        @param job The Job
+        @param plot_s The time it took to plot [s]
+        '''
+        estimate = job.estimates.get(self.plant_file)
+        if not estimate:
+            return
+        ratio = plot_s/estimate
+        self.speed = ratio if self.speed is None else \
+            0.5*self.speed + 0.5*ratio
+
+
+    def to_dict(self, elapsed_s):
+        '''
+        @param elapsed_s Time the server has run [s]
+        @return The state of the plotter for the metrics
+        '''
+        job = self.job
+        busy = self.busy_s
+        if job is not None and job.started is not None:
+            busy += time.monotonic() - job.started
+        last = self.progress.last
+        return {'name': self.name, 'port': self.streamer.port,
+                'state': self.state,
+                'job': job.name if job else None,
+                'progress': self.progress.offset/len(job.data)
+                            if job else 0.0,
+                'received': self.streamer.received/len(job.data)
+                            if job else 0.0,
+                'telemetry_age_s': time.monotonic() - last
+                                   if last is not None else None,
+                'jobs': self.jobs,
+                'bytes': self.bytes,
+                'utilisation': busy/elapsed_s if elapsed_s else 0.0,
+                'speed': self.speed,
+                'opens': self.streamer.opens}
+
+
+class JobServer:
+    '''
+    Class which queues jobs and dispatches them to a fleet of plotters.
+    '''
+    def __init__(self, plotters, policy='lpt', probe_s=2.0, offline_s=10.0,
+                 report_s=10.0, metrics_file=None, workers=None):
+        '''
+        @param plotters List of Plotter
+        @param policy 'lpt' for the longest job first or 'fifo' for the
+        oldest first
+        @param probe_s Time between checks of plotters without a job [s]
+        @param offline_s Time a plotter given a job may stay offline before
+        the job goes back to the queue [s]
+        @param report_s Time between reports of the metrics [s], 0 for none
+        @param metrics_file Json file the metrics are written to, None for
+        none
+        @param workers Processes estimating jobs, None for the number of
+        CPUs
+        '''
+        if policy not in ('lpt', 'fifo'):
+            raise ValueError('policy must be lpt or fifo')
+        ## The Plotter of each plotter
+        self.plotters = plotters
+        ## 'lpt' or 'fifo'
+        self.policy = policy
+        ## Time between checks of plotters without a job [s]
+        self.probe_s = probe_s
+        ## Time a plotter given a job may stay offline [s]
+        self.offline_s = offline_s
+        ## Time between reports of the metrics [s]
+        self.report_s = report_s
+        ## Json file the metrics are written to
+        self.metrics_file = metrics_file
+        ## Every Job submitted, in order
+        self.jobs = []
+        # Processes estimating jobs
+        self._workers = workers
+        self._executor = None
+        # Time the server started [s]
+        self._start = time.monotonic()
+        # Set when a job is finished, for run(until_done=True)
+        self._changed = asyncio.Event()
+        # Tasks of the estimates
+        self._estimates = set()
+
+
+    def submit(self, name, data=None):
+        '''
+        Adds a job to the queue, once its plot time has been estimated.
+        @param name The job file name, or the name of the job with data
+        @param data The bytes of the job, None to read the file
+        @return The Job
+        '''
+        if data is None:
+            with open(name, 'rb') as file:
+                data = file.read()
+        job = Job(os.path.basename(name), data)
+        self.jobs.append(job)
+        task = asyncio.get_running_loop().create_task(self._estimate(job))
+        self._estimates.add(task)
+        task.add_done_callback(self._estimates.discard)
+        return job
+
+
+    async def run(self, until_done=False, listen=None):
+        '''
+        Runs the fleet.
+        @param until_done True to return once every job submitted has been
+        plotted (or failed), False to run until cancelled
+        @param listen TCP port to take commands on, None for none
+        '''
+        self._start = time.monotonic()
+        with concurrent.futures.ProcessPoolExecutor(self._workers) as pool:
+            self._executor = pool
+            tasks = [asyncio.create_task(self._serve(plotter))
+                     for plotter in self.plotters]
+            if self.report_s:
+                tasks.append(asyncio.create_task(self._report()))
+            server = None
+            if listen is not None:
+                server = await asyncio.start_server(self._control,
+                                                    'localhost', listen)
+            try:
+                if until_done:
+                    while any(job.state not in ('done', 'failed')
+                              for job in self.jobs):
+                        self._changed.clear()
+                        await self._changed.wait()
+                else:
+                    await asyncio.Event().wait()
+            finally:
+                if server is not None:
+                    server.close()
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                for plotter in self.plotters:
+                    plotter.streamer.close()
+                self._executor = None
+        if self.report_s:
+            self._write_metrics()
+
+
+    async def _estimate(self, job):
+        '''
+        Estimates the plot time of a job for the plant file of every
+        plotter and queues it.
+        @param job The Job
+        '''
+        loop = asyncio.get_running_loop()
+        while self._executor is None:
+            # Submitted before run()
+            await asyncio.sleep(0.1)
+        plant_files = set(plotter.plant_file for plotter in self.plotters)
+        try:
+            for plant_file in plant_files:
+                job.estimates[plant_file] = await loop.run_in_executor(
+                    self._executor, estimate, job.data, plant_file)
+        except Exception as error:
+            job.state = 'failed'
+            job.error = repr(error)
+            self._changed.set()
+            return
+        job.state = 'queued'
+        self._dispatch()
+
+
+    def _dispatch(self):
+        '''
+        Gives queued jobs to idle plotters: the job the policy picks goes
+        to the idle plotter which would plot it in the least time.
+        '''
+        while True:
+            idle = [plotter for plotter in self.plotters
+                    if plotter.state == 'idle' and plotter.job is None]
+            queued = [job for job in self.jobs if job.state == 'queued']
+            if not idle or not queued:
+                return
+            known = [plotter.speed for plotter in self.plotters
+                     if plotter.speed is not None]
+            speed = sum(known)/len(known) if known else 1.0
+            if self.policy == 'lpt':
+                job = max(queued, key=lambda job: min(
+                    plotter.predict(job, speed) for plotter in idle))
+            else:
+                job = queued[0]
+            plotter = min(idle, key=lambda plotter: plotter.predict(job,
+                                                                    speed))
+            job.state = 'plotting'
+            job.plotter = plotter
+            plotter.job = job
+            plotter.state = 'plotting'
+            plotter.wake.set()
+
+
+    async def _serve(self, plotter):
+        '''
+        Runs one plotter: checks it while it has no job and plots the jobs
+        it is given.
+        @param plotter The Plotter
+        '''
+        while True:
+            if plotter.job is None:
+                board = await plotter.streamer.probe()
+                if plotter.job is None:
+                    if board is None:
+                        plotter.state = 'offline'
+                    elif board != 0:
+                        plotter.state = 'busy'
+                    else:
+                        plotter.state = 'idle'
+                        self._dispatch()
+            if plotter.job is None:
+                plotter.wake.clear()
+                try:
+                    await asyncio.wait_for(plotter.wake.wait(), self.probe_s)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._plot(plotter, plotter.job)
+
+
+    async def _plot(self, plotter, job):
+        '''
+        Streams a job to a plotter until it has been plotted, or puts it
+        back in the queue if the plotter is offline before it starts.
+        @param plotter The Plotter
+        @param job The Job
+        '''
+        streamer = plotter.streamer
+        plotter.progress.reset()
+        streamer.set_job(job.data, job.id)
+        job.started = time.monotonic()
+        task = asyncio.create_task(streamer.run())
+        while not task.done():
+            await asyncio.wait([task], timeout=self.probe_s)
+            if task.done():
+                break
+            if not streamer.connected and streamer.board_job != job.id \
+                    and time.monotonic() - job.started >= self.offline_s:
+                # The plotter never took the job
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                streamer.close()
+                job.state = 'queued'
+                job.plotter = None
+                job.started = None
+                plotter.job = None
+                plotter.state = 'offline'
+                self._dispatch()
+                return
+        task.result()
+        job.finished = time.monotonic()
+        job.state = 'done'
+        plot_s = job.finished - job.started
+        plotter.busy_s += plot_s
+        plotter.jobs += 1
+        plotter.bytes += len(job.data)
+        plotter.learn(job, plot_s)
+        plotter.job = None
+        plotter.state = 'idle'
+        self._changed.set()
+        self._dispatch()
+
+
+    def metrics(self):
+        '''
+        @return Dictionary of the queue depth, the throughput and
+        utilisation of the fleet and the state of every plotter and job
+        '''
+        elapsed = time.monotonic() - self._start
+        done = [job for job in self.jobs if job.state == 'done']
+        plotters = [plotter.to_dict(elapsed) for plotter in self.plotters]
+        return {'elapsed_s': elapsed,
+                'queue_depth': sum(1 for job in self.jobs
+                                   if job.state == 'queued'),
+                'estimating': sum(1 for job in self.jobs
+                                  if job.state == 'estimating'),
+                'plotting': sum(1 for job in self.jobs
+                                if job.state == 'plotting'),
+                'done': len(done),
+                'failed': sum(1 for job in self.jobs
+                              if job.state == 'failed'),
+                'jobs_per_h': len(done)*3600/elapsed if elapsed else 0.0,
+                'bytes_per_s': sum(len(job.data) for job in done)/elapsed
+                               if elapsed else 0.0,
+                'utilisation': sum(plotter['utilisation']
+                                   for plotter in plotters)/len(plotters)
+                               if plotters else 0.0,
+                'plotters': plotters,
+                'jobs': [job.to_dict() for job in self.jobs]}
+
+
+    def _write_metrics(self):
+        '''
+        Prints a line of the metrics and writes them all to the json file.
+        @return The metrics
+        '''
+        metrics = self.metrics()
+        states = ' '.join('{:s}:{:s}{:s}'.format(
+            plotter['name'], plotter['state'],
+            ' {:.0f}%'.format(100*plotter['progress'])
+            if plotter['job'] else '') for plotter in metrics['plotters'])
+        print('{:7.1f} s queue {:d} done {:d} ({:.1f} jobs/h) utilisation '
+              '{:.0f}% | {:s}'.format(
+                  metrics['elapsed_s'], metrics['queue_depth'],
+                  metrics['done'], metrics['jobs_per_h'],
+                  100*metrics['utilisation'], states))
+        if self.metrics_file:
+            temp = self.metrics_file + '.tmp'
+            with open(temp, 'w') as file:
+                json.dump(metrics, file, indent=1)
+            os.replace(temp, self.metrics_file)
+        return metrics
+
+
+    async def _report(self):
+        '''
+        Reports the metrics every report_s seconds.
+        '''
+        while True:
+            await asyncio.sleep(self.report_s)
+            self._write_metrics()
+
+
+    async def _control(self, reader, writer):
+        '''
+        Takes commands over a TCP connection, one per line.
+        @param reader The asyncio.StreamReader of the connection
+        @param writer The asyncio.StreamWriter of the connection
+        '''
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                words = line.decode(errors='replace').split(maxsplit=1)
+                if not words:
+                    continue
+                if words[0] == 'submit' and len(words) == 2:
+                    try:
+                        job = self.submit(words[1].strip())
+                        answer = 'ok {:08x}'.format(job.id)
+                    except OSError as error:
+                        answer = 'error {:s}'.format(str(error))
+                elif words[0] == 'status':
+                    answer = json.dumps(self.metrics())
+                else:
+                    answer = 'error commands are submit <file> and status'
+                writer.write(answer.encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def simulate(count, pace=10, directory=None, plant_file=None):
+    '''
+    Starts simulated plotters, each running simulator.py on a pseudo
+    terminal.
+    @param count Number of plotters
+    @param pace Simulated seconds per host second
+    @param directory Directory of the links to the terminals, None for a
+    temporary one
+    @param plant_file Plant json from sysid.py, None for the default plants
+    @return List of the subprocesses and list of the ports
+    '''
+    import tempfile
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='plotters_')
+    here = os.path.dirname(os.path.abspath(__file__))
+    processes = []
+    ports = []
+    for number in range(count):
+        port = os.path.join(directory, 'plotter{:d}'.format(number))
+        command = [sys.executable, os.path.join(here, 'simulator.py'), port,
+                   '--pace', str(pace)]
+        if plant_file:
+            command += ['--plants', plant_file]
+        processes.append(subprocess.Popen(command))
+        ports.append(port)
+    limit = time.monotonic() + 10
+    while not all(os.path.exists(port) for port in ports):
+        if time.monotonic() > limit:
+            raise RuntimeError('the simulated plotters did not start')
+        time.sleep(0.05)
+    return processes, ports
+
+
+async def _main(args, ports):
+    '''
+    Runs the server from the command line arguments.
+    @param args The parsed arguments
+    @param ports List of the ports, each with an optional =plant json
+    '''
+    plotters = []
+    for number, spec in enumerate(ports):
+        port, _, plant_file = spec.partition('=')
+        plotters.append(Plotter('p{:d}'.format(number), port,
+                                plant_file or args.plants, args.packet))
+    server = JobServer(plotters, args.policy, report_s=args.report,
+                       metrics_file=args.metrics)
+    for name in args.jobs:
+        server.submit(name)
+    await server.run(args.until_done, args.listen)
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Dispatch jobs to a fleet of plotters')
+    parser.add_argument('ports', nargs='*',
+                        help='PORT or PORT=PLANT_JSON for each plotter')
+    parser.add_argument('--jobs', nargs='*', default=[],
+                        help='job files to queue')
+    parser.add_argument('--policy', choices=('lpt', 'fifo'), default='lpt')
+    parser.add_argument('--plants', help='plant json of the plotters '
+                        'without their own')
+    parser.add_argument('--packet', type=int, default=512,
+                        help='most bytes of a job per data message')
+    parser.add_argument('--listen', type=int,
+                        help='TCP port to take commands on')
+    parser.add_argument('--metrics', help='json file for the metrics')
+    parser.add_argument('--report', type=float, default=10,
+                        help='seconds between reports')
+    parser.add_argument('--until-done', action='store_true',
+                        help='stop once every job has been plotted')
+    parser.add_argument('--simulate', type=int, default=0,
+                        help='add this many simulated plotters')
+    parser.add_argument('--pace', type=float, default=10,
+                        help='simulated seconds per host second')
+    args = parser.parse_args()
+    processes = []
+    ports = list(args.ports)
+    if args.simulate:
+        processes, simulated = simulate(args.simulate, args.pace,
+                                        plant_file=args.plants)
+        ports += simulated
+    try:
+        server = asyncio.run(_main(args, ports))
+        for job in server.jobs:
+            print('{:s}: {:s} on {:s}, estimated {:s} s, plotted in {:.1f} s'
+                  .format(job.name, job.state,
+                          job.plotter.name if job.plotter else '-',
+                          ', '.join('{:.1f}'.format(value) for value
+                                    in job.estimates.values()),
+                          job.to_dict()['plot_s']))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
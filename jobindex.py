@@ -0,0 +1,193 @@
+'''
+@file jobindex.py
+@authors Sam Lee and Dima Kyle
+Job index file. It has the class JobIndex which reads the index that
+parse_hpgl.output_text writes next to a job file (drawing.txt gets
+drawing.idx). For every line of the job the index holds its offset in the
+file, the points of the job before it and its command and pen state, so a
+job can be started at any command by seeking the job file to its offset,
+and an offset turned into the progress of the job.
+
+The index is a header, one record per line and a last record for the end
+of the job, each three little endian uint32:
+@code
+b'JIDX'      job length    lines
+offset       points        command | pen << 16
+...
+job length   all points    0
+@endcode
+
+Records are read one at a time into a preallocated array, so an index of
+any length can be used on the board. It runs on the host computer too.
+
+Ex:
+@code
+index = jobindex.open_index('drawing.txt', job_length)
+n = index.find_points(index.points_total//2)
+file.seek(index.offset(n))
+@endcode
+'''
+
+import array
+
+## Start of the header
+MAGIC = b'JIDX'
+## Size of the header and of each record [bytes]
+RECORD_SIZE = 12
+## Pen state of a line plotted with the pen up
+PEN_UP = 0
+## Pen state of a line plotted with the pen down
+PEN_DOWN = 1
+
+
+def index_name(job_name):
+    '''
+    Makes the name of the index of a job file.
+    @param job_name The job file name
+    @return The index file name, the job file name with '.idx' for its
+    extension
+    '''
+    dot = job_name.rfind('.')
+    if dot <= job_name.rfind('/'):
+        dot = len(job_name)
+    return job_name[:dot] + '.idx'
+
+
+def open_index(job_name, job_length=None):
+    '''
+    Opens the index of a job file if there is one and it is the index of
+    the job as it is now.
+    @param job_name The job file name
+    @param job_length Length of the job file [bytes], None not to check it
+    @return The JobIndex, or None if there is no index or it is stale
+    '''
+    try:
+        file = open(index_name(job_name), 'rb')
+    except OSError:
+        return None
+    index = JobIndex(file)
+    if not index.valid or (job_length is not None and
+                           index.job_length != job_length):
+        index.close()
+        return None
+    return index
+
+
+class JobIndex:
+    '''
+    This class reads the index of a job file. Lines are numbered from 0 in
+    the order of the job file.
+    '''
+    def __init__(self, file):
+        '''
+        Reads the header of an index.
+        @param file The index file, opened in binary mode
+        '''
+        ## The index file
+        self.file = file
+        # Last record read and the number of the line it is
+        self._record = array.array('I', [0, 0, 0])
+        self._line = -1
+        header = bytearray(RECORD_SIZE)
+        count = file.readinto(header)
+        ## True if the file is an index
+        self.valid = count == RECORD_SIZE and header[:4] == MAGIC
+        ## Length of the job file [bytes]
+        self.job_length = 0
+        ## Number of lines of the job file
+        self.lines = 0
+        if self.valid:
+            self.job_length = int.from_bytes(header[4:8], 'little')
+            self.lines = int.from_bytes(header[8:12], 'little')
+        ## Points of the whole job, from the record of the end of the job
+        self.points_total = self.points(self.lines) if self.valid else 0
+
+
+    def _read(self, line):
+        '''
+        Reads the record of a line, unless it was the last one read.
+        @param line Number of the line
+        '''
+        if line != self._line:
+            self.file.seek(RECORD_SIZE*(line + 1))
+            self.file.readinto(self._record)
+            self._line = line
+
+
+    def offset(self, line):
+        '''
+        @param line Number of the line
+        @return Offset of the start of the line in the job file
+        '''
+        self._read(line)
+        return self._record[0]
+
+
+    def points(self, line):
+        '''
+        @param line Number of the line
+        @return Points of the job before the line
+        '''
+        self._read(line)
+        return self._record[1]
+
+
+    def command(self, line):
+        '''
+        @param line Number of the line
+        @return Command code of the line, as the jobreader codes
+        '''
+        self._read(line)
+        return self._record[2] & 0xFFFF
+
+
+    def pen(self, line):
+        '''
+        @param line Number of the line
+        @return PEN_DOWN if the line is plotted with the pen down, else
+        PEN_UP
+        '''
+        self._read(line)
+        return self._record[2] >> 16
+
+
+    def find(self, offset):
+        '''
+        Finds the line an offset of the job file is in.
+        @param offset The offset
+        @return Number of the line, -1 if the index is empty
+        '''
+        low = 0
+        high = self.lines - 1
+        while low < high:
+            middle = (low + high + 1)//2
+            if self.offset(middle) <= offset:
+                low = middle
+            else:
+                high = middle - 1
+        return high
+
+
+    def find_points(self, points):
+        '''
+        Finds the line being plotted once a number of points of the job
+        have been plotted.
+        @param points The number of points
+        @return Number of the line, -1 if the index is empty
+        '''
+        low = 0
+        high = self.lines - 1
+        while low < high:
+            middle = (low + high + 1)//2
+            if self.points(middle) <= points:
+                low = middle
+            else:
+                high = middle - 1
+        return high
+
+
+    def close(self):
+        '''
+        Closes the index file.
+        '''
+        self.file.close()
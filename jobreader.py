@@ -0,0 +1,327 @@
+'''
+@file jobreader.py
+@authors Sam Lee and Dima Kyle
+Job reader file. It has the class JobReader which decodes the job text files
+made by parse_hpgl.output_text without allocating memory for every line:
+
+@code
+['IN;1; 0x0']
+['AR;travel;60;0;1']
+['PU;1.0;', '900x100']
+['PD;4.0;', '900x100', '1000x150', '1100x200', '1200x250']
+@endcode
+
+The file is read in chunks into one bytearray and the numbers are parsed
+from its bytes into preallocated arrays. Commands are returned as integer
+codes made from their two letters (IN, SP, PU, PD, AR), with NAMES to turn
+them back into strings. Fractions in the point count (parse_hpgl writes
+4.0 under Python 3) are dropped.
+
+The points of a line are read through a window of max_points: a longer
+line is read one window at a time with more(), so strokes of any length
+fit in the same memory.
+
+The job file must be opened in binary mode. It can also be any object
+with a readinto() which returns None when it has no bytes yet, such as the
+jobstream.JobStream of a job sent over the USB VCP. Then next() and more()
+set waiting and return no command or points, and are called again to carry
+on once more bytes have come.
+
+Ex:
+@code
+reader = jobreader.JobReader(open('job.txt', 'rb'))
+while reader.next() != jobreader.NONE:
+    if reader.command == jobreader.PD:
+        while reader.n_points:
+            for i in range(reader.n_points):
+                print(reader.points[2*i], reader.points[2*i + 1])
+            reader.more()
+@endcode
+'''
+
+import array
+import micropython
+from micropython import const
+
+## No command, the end of the file
+NONE = const(0)
+## Initialize
+IN = const(0x494E)
+## Select pen
+SP = const(0x5350)
+## Pen up
+PU = const(0x5055)
+## Pen down
+PD = const(0x5044)
+## Arrival profile
+AR = const(0x4152)
+
+## Names of the command codes
+NAMES = {NONE: '', IN: 'IN', SP: 'SP', PU: 'PU', PD: 'PD', AR: 'AR'}
+
+
+class JobReader:
+    '''
+    This class decodes a job file one command at a time. After next(),
+    command is the command code, count the number of points the line says
+    it has and points the first window of x, y tick pairs (n_points of
+    them). Each more() reads the next window of the line in their place,
+    with start the number of points of the line before it. For AR, name
+    holds the profile name (name_len bytes) and args its numbers (n_args of
+    them).
+    '''
+    def __init__(self, file, chunk=128, max_points=64):
+        '''
+        Creates a job reader.
+        @param file The job file, opened in binary mode
+        @param chunk Bytes read from the file at a time
+        @param max_points Points in a window
+        '''
+        ## The job file
+        self.file = file
+        ## Buffer the file is read into
+        self.buf = bytearray(chunk)
+        # Memoryview of buf, so reading into it doesn't copy
+        self._view = memoryview(self.buf)
+        # Bytes of buf holding file data
+        self._length = 0
+        # Position of the next byte to decode in buf
+        self._pos = 0
+        # Bytes of the file before those in buf
+        self._base = 0
+        ## Code of the last command read, NONE at the end of the file
+        self.command = NONE
+        ## Number of points the last line says it has
+        self.count = 0
+        ## x, y pairs of the last line [ticks]
+        self.points = array.array('i', [0]*(2*max_points))
+        ## Number of points in the window
+        self.n_points = 0
+        ## Number of points of the line before the window
+        self.start = 0
+        # True until the end of the line has been read
+        self._open = False
+        # Letters and numbers read of the line
+        self._letters = 0
+        self._numbers = 0
+        # Number being parsed and ints of the window, kept while waiting
+        self._values = 0
+        self._value = 0
+        self._sign = 1
+        self._digits = False
+        self._fraction = False
+        # True while the rest of the last line is being skipped by next()
+        self._skipping = False
+        # True once next() has started on its line
+        self._started = False
+        ## True while the file has no bytes yet, call next() or more() again
+        self.waiting = False
+        ## Numbers of the last AR line
+        self.args = array.array('i', [0]*4)
+        ## Number of numbers in args
+        self.n_args = 0
+        ## Profile name of the last AR line
+        self.name = bytearray(16)
+        ## Bytes of the name in name
+        self.name_len = 0
+        ## Number of lines read
+        self.lines = 0
+        ## Offset in the file of the start of the last line read by next()
+        self.line_offset = 0
+
+
+    def _fill(self):
+        '''
+        Reads the next chunk of the file into the buffer.
+        @return The number of bytes read, 0 at the end of the file or None
+        if a stream has no bytes yet
+        '''
+        self._base += self._length
+        n = self.file.readinto(self._view)
+        self._pos = 0
+        self._length = n if n else 0
+        return n
+
+
+    def next(self):
+        '''
+        Reads and decodes the next command of the file, with the first
+        window of its points. Points of the last line that weren't read with
+        more() are skipped.
+        @return The command code, NONE at the end of the file or while
+        waiting
+        '''
+        if not self.waiting:
+            self._skipping = self._open
+            self._started = False
+        self.waiting = False
+        while self._skipping:
+            # Skipping the rest of the last line
+            self.more()
+            if self.waiting:
+                return NONE
+            self._skipping = self._open
+        if not self._started:
+            self.line_offset = self._base + self._pos
+            self.command = NONE
+            self.count = 0
+            self.n_points = 0
+            self.start = 0
+            self.n_args = 0
+            self.name_len = 0
+            self._letters = 0
+            self._numbers = 0
+            self._open = True
+            self._started = True
+        self._read()
+        if self.waiting:
+            return NONE
+        if self._letters:
+            self.lines += 1
+        return self.command
+
+
+    def more(self):
+        '''
+        Reads the next window of points of the line.
+        @return The number of points read, 0 at the end of the line or
+        while waiting
+        '''
+        if not self.waiting:
+            self.start += self.n_points
+            self.n_points = 0
+        if self._open:
+            self._read()
+        return self.n_points
+
+
+    @micropython.native
+    def _read(self):
+        '''
+        Decodes the line from the file until its end, until the window of
+        points is full or until a stream has no more bytes yet.
+        '''
+        buf = self.buf
+        points = self.points
+        window = len(points)
+        letters = self._letters
+        numbers = self._numbers
+        values = self._values
+        value = self._value
+        sign = self._sign
+        digits = self._digits
+        fraction = self._fraction
+        self.waiting = False
+        while True:
+            if self._pos >= self._length:
+                n = self._fill()
+                if n is None:
+                    # Carrying on from here in the next call
+                    self.waiting = True
+                    break
+                if not n:
+                    # End of the file, ending a last line without a newline
+                    self._open = False
+                    break
+            b = buf[self._pos]
+            self._pos += 1
+            if 48 <= b <= 57:
+                # A digit, dropping those after a decimal point
+                if not fraction:
+                    value = value*10 + b - 48
+                    digits = True
+                continue
+            if digits:
+                # The end of a number
+                value *= sign
+                if self.command == AR:
+                    if self.n_args < len(self.args):
+                        self.args[self.n_args] = value
+                        self.n_args += 1
+                elif numbers == 0:
+                    self.count = value
+                else:
+                    points[values] = value
+                    values += 1
+                numbers += 1
+                value = 0
+                digits = False
+                if values == window:
+                    # The window is full, the line goes on in more()
+                    if b == 10:
+                        self._open = False
+                    break
+            fraction = b == 46
+            sign = -1 if b == 45 else 1
+            if b == 10:
+                if letters:
+                    self._open = False
+                    break
+                # A blank line
+                continue
+            if 65 <= b <= 90 or 97 <= b <= 122:
+                if letters < 2:
+                    # The command is the first two letters of the line
+                    self.command = (self.command << 8) | b
+                    letters += 1
+                elif self.command == AR and self.name_len < len(self.name):
+                    self.name[self.name_len] = b
+                    self.name_len += 1
+        self._letters = letters
+        self._numbers = numbers
+        if self.waiting:
+            self._values = values
+            self._value = value
+            self._sign = sign
+            self._digits = digits
+            self._fraction = fraction
+            return
+        self._values = 0
+        self._value = 0
+        self._sign = 1
+        self._digits = False
+        self._fraction = False
+        self.n_points = values//2
+
+
+    def reset(self, offset=0):
+        '''
+        Starts decoding again, for the next job of a stream or after the
+        file has been moved to another line with its seek().
+        @param offset Offset in the file of the next byte read from it
+        '''
+        self._length = 0
+        self._pos = 0
+        self._base = offset
+        self.line_offset = offset
+        self.command = NONE
+        self.count = 0
+        self.n_points = 0
+        self.start = 0
+        self._open = False
+        self._letters = 0
+        self._numbers = 0
+        self._values = 0
+        self._value = 0
+        self._sign = 1
+        self._digits = False
+        self._fraction = False
+        self._skipping = False
+        self._started = False
+        self.waiting = False
+
+
+    def offset(self):
+        '''
+        @return The number of bytes of the file decoded so far
+        '''
+        return self._base + self._pos
+
+
+    def name_str(self):
+        '''
+        Makes a string of the profile name of the last AR line. This one
+        allocates, but AR lines are only in the job header.
+        @return The profile name
+        '''
+        return bytes(self.name[:self.name_len]).decode()
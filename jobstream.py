@@ -0,0 +1,448 @@
+'''
+@file jobstream.py
+@authors Sam Lee and Dima Kyle
+Job stream file. It has the class JobStream which receives job files sent
+over the USB VCP by stream_job.py or job_server.py on the host computer, so
+jobs don't have to be copied to the flash first and can be bigger than it.
+
+The bytes of the job go into a fixed task_share.ByteRing, which the
+jobreader.JobReader reads through readinto() like a file. When the ring is
+empty readinto() returns None and the reader waits; the receiver task wakes
+the command task again once bytes come. The host only sends as much as the
+ring has room for: the board grants it credit, the offset in the job it may
+send up to.
+
+Messages from the host start with a control byte, which is never in the
+text of a job, and their numbers are in hex:
+@code
+\\x05                    Hello, asks for a credit message
+\\x02IIIIIIII            The messages after it are for job IIIIIIII
+\\x01OOOOOOOOLLLL<data>  LLLL bytes of the job from offset OOOOOOOO
+\\x04TTTTTTTT            The job is TTTTTTTT bytes long
+@endcode
+
+(the host sends the job id and length of the job with every hello) and the
+board answers with credit and done messages among its other output:
+@code
+\\x06IIIIIIII RRRRRRRR LLLLLLLL\\n   Job I received up to offset R, send
+                                  up to offset L (job 0 when idle)
+\\x07IIIIIIII\\n                     Job I has been plotted
+@endcode
+
+The board takes one job at a time. A job message for another job while it
+is busy is ignored along with the data after it, so the host keeps saying
+hello until the credit message shows its job. finish() ends the job once
+it has been plotted: the done message is sent and the next job message
+starts the next job. A job message for the job just finished is answered
+with the done message again instead, in case the first one was lost.
+
+A control byte in the middle of a data message ends it, so after the host
+reconnects the board picks up its hello even if it was cut off half way
+through a message. Data from an offset other than the next one expected is
+skipped (counted in rejected), and the host always carries on from the
+offset in the credit message after its hello, so a job resumes where it
+stopped when the USB cable or the host program is restarted.
+
+Ex:
+@code
+file = jobstream.JobStream(4096)
+reader = jobreader.JobReader(file)
+receiver = cotask.Task(file.run, name = 'Job Stream', priority = 1,
+                       period = 10)
+file.set_task(command_task)
+cotask.task_list.append(receiver)
+@endcode
+'''
+
+import micropython
+import utime
+import task_share
+
+## Start of a data message
+DATA = 0x01
+## Start of the message giving the job the following messages are for
+JOB = 0x02
+## Start of the message giving the length of the job
+END = 0x04
+## Hello message
+HELLO = 0x05
+## Start of a credit message
+CREDIT = 0x06
+## Size of a credit message [bytes]
+CREDIT_SIZE = 28
+## Start of a done message
+DONE = 0x07
+## Size of a done message [bytes]
+DONE_SIZE = 10
+
+# Parser states: between messages, reading hex numbers, reading data
+_IDLE = 0
+_HEADER = 1
+_PAYLOAD = 2
+
+# ASCII of the hex digits
+_HEX = b'0123456789abcdef'
+
+
+class JobStream:
+    '''
+    Class which receives jobs over the USB VCP into a ring buffer and lets
+    a jobreader.JobReader read them like a file, one after another. run()
+    is the receiver task: it reads the VCP when the ring has room, wakes
+    the command task when the reader is waiting for bytes and sends credit
+    to the host.
+    '''
+    def __init__(self, ring_size=4096, stage_size=256, bytes_per_run=1024,
+                 start=0):
+        '''
+        Creates the job stream and its buffers.
+        @param ring_size Bytes of the job held on the board
+        @param stage_size Most bytes read from the VCP at a time
+        @param bytes_per_run Most bytes read from the VCP per run of the
+        receiver task
+        @param start Offset in the job to start from
+        '''
+        ## Bytes of the job waiting for the reader
+        self.ring = task_share.ByteRing(ring_size)
+        # Most bytes in the ring and the offset the job started from
+        self._size = ring_size
+        self._start = start
+        ## Most bytes read from the VCP per run of the receiver task
+        self.bytes_per_run = bytes_per_run
+        ## The cotask.Task of the command task, woken when bytes come
+        self.task = None
+        ## Id of the job being received, 0 until a job message comes
+        self.job = 0
+        ## Id of the last job finished, 0 for none
+        self.last_done = 0
+        ## Jobs finished
+        self.finished = 0
+        ## Offset in the job of the next byte expected from the host
+        self.received = start
+        ## Offset in the job of the next byte to be read
+        self.consumed = start
+        ## Length of the job, -1 until the host sends it
+        self.total = -1
+        ## Times the reader found the ring empty in the middle of the job
+        self.underruns = 0
+        ## Time the reader spent waiting for bytes after underruns [us]
+        self.starved_us = 0
+        ## Data bytes skipped for not being at the offset expected
+        self.rejected = 0
+        ## Messages cut off by another one, or with bad hex
+        self.resyncs = 0
+        ## Hello messages received
+        self.hellos = 0
+        # Bytes read from the VCP
+        self._stage = bytearray(stage_size)
+        self._stage_view = memoryview(self._stage)
+        # The credit message, and how much of it is left to send
+        self._credit = bytearray(CREDIT_SIZE)
+        self._credit_view = memoryview(self._credit)
+        self._credit_left = 0
+        # The done message, and how much of it is left to send
+        self._done = bytearray(DONE_SIZE)
+        self._done_view = memoryview(self._done)
+        self._done_left = 0
+        # Credit limit and received offset last sent
+        self._granted = start
+        self._reported = start
+        # True when a hello has to be answered
+        self._hello = False
+        # True while the messages from the host are for the job received
+        self._mine = False
+        # Parser state, message being read, its hex digits left to read
+        # and the number they make
+        self._state = _IDLE
+        self._kind = 0
+        self._digits = 0
+        self._value = 0
+        # Offset of a data message, its bytes left and the bytes to skip
+        self._offset = 0
+        self._left = 0
+        self._skip = 0
+        # True while the reader is waiting for bytes, since when, and if it
+        # is an underrun
+        self._starved = False
+        self._starved_at = 0
+        self._underrun = False
+
+
+    def set_task(self, task):
+        '''
+        @param task The cotask.Task to wake with go() when bytes come
+        '''
+        self.task = task
+
+
+    def limit(self):
+        '''
+        @return The offset in the job the host may send up to
+        '''
+        return self.consumed + self._size
+
+
+    def ended(self):
+        '''
+        @return True once the whole job has been received
+        '''
+        return 0 <= self.total <= self.received
+
+
+    def finish(self):
+        '''
+        Ends the job once it has been plotted: queues the done message and
+        waits for the next job, which starts from offset 0.
+        '''
+        self._write_id(self._done, 1, self.job)
+        self._done[0] = DONE
+        self._done[9] = 10
+        self._done_left = DONE_SIZE
+        self.last_done = self.job
+        self.finished += 1
+        self.job = 0
+        self._mine = False
+        self._start = 0
+        self.received = 0
+        self.consumed = 0
+        self.total = -1
+        self._granted = self.limit()
+        self._reported = 0
+        self._starved = False
+
+
+    def readinto(self, buf):
+        '''
+        Copies bytes of the job into a buffer, like the readinto() of a
+        file.
+        @param buf The buffer, such as a memoryview of a bytearray
+        @return The number of bytes copied, 0 at the end of the job or None
+        if no bytes have come yet (or no job has started)
+        '''
+        ring = self.ring
+        if not ring.any():
+            if self.ended():
+                return 0
+            if not self._starved:
+                self._starved = True
+                self._starved_at = utime.ticks_us()
+                # Waiting for the first bytes of the job isn't counted
+                self._underrun = self.received > self._start
+                if self._underrun:
+                    self.underruns += 1
+            return None
+        if self._starved:
+            self._starved = False
+            if self._underrun:
+                self.starved_us += utime.ticks_diff(utime.ticks_us(),
+                                                    self._starved_at)
+        count = 0
+        while count < len(buf) and ring.any():
+            chunk = ring.peek(len(buf) - count)
+            buf[count:count + len(chunk)] = chunk
+            ring.consume(len(chunk))
+            count += len(chunk)
+        self.consumed += count
+        return count
+
+
+    def close(self):
+        '''
+        Does nothing, for main.py to close the stream like a file.
+        '''
+        pass
+
+
+    @micropython.native
+    def _parse(self, count):
+        '''
+        Parses the bytes read from the VCP, putting the job bytes of data
+        messages into the ring.
+        @param count Number of bytes in the stage
+        '''
+        data = self._stage
+        n = 0
+        while n < count:
+            b = data[n]
+            if b == DATA or b == END or b == HELLO or b == JOB:
+                if self._state != _IDLE:
+                    self.resyncs += 1
+                self._state = _IDLE
+                n += 1
+                if b == HELLO:
+                    self.hellos += 1
+                    self._hello = True
+                    continue
+                self._kind = b
+                self._digits = 12 if b == DATA else 8
+                self._value = 0
+                self._state = _HEADER
+                continue
+            if self._state == _HEADER:
+                if 48 <= b <= 57:
+                    digit = b - 48
+                elif 65 <= b <= 70 or 97 <= b <= 102:
+                    digit = (b | 32) - 87
+                else:
+                    self.resyncs += 1
+                    self._state = _IDLE
+                    n += 1
+                    continue
+                self._value = (self._value << 4) | digit
+                self._digits -= 1
+                n += 1
+                if self._kind == END:
+                    if self._digits == 0:
+                        if self._mine:
+                            self.total = self._value
+                        self._state = _IDLE
+                elif self._kind == JOB:
+                    if self._digits == 0:
+                        self._select(self._value)
+                        self._state = _IDLE
+                elif self._digits == 4:
+                    self._offset = self._value
+                    self._value = 0
+                elif self._digits == 0:
+                    self._left = self._value
+                    # Skipping bytes already received or after a gap, or
+                    # of another job
+                    skip = self.received - self._offset
+                    if skip < 0 or skip > self._left or not self._mine:
+                        skip = self._left
+                    self._skip = skip
+                    self.rejected += skip
+                    self._state = _PAYLOAD if self._left else _IDLE
+                continue
+            if self._state == _PAYLOAD:
+                # The bytes of the message up to a control byte
+                end = n
+                last = n + self._left
+                if last > count:
+                    last = count
+                while end < last:
+                    c = data[end]
+                    if c == DATA or c == END or c == HELLO or c == JOB:
+                        break
+                    end += 1
+                size = end - n
+                self._left -= size
+                if self._skip >= size:
+                    self._skip -= size
+                else:
+                    start = n + self._skip
+                    self._skip = 0
+                    put = self.ring.put(self._stage_view[start:end])
+                    self.received += put
+                    if put < end - start:
+                        # No room, so the rest of the message is skipped
+                        self.rejected += end - start - put
+                        self._skip = self._left
+                        self.rejected += self._left
+                n = end
+                if self._left == 0:
+                    self._state = _IDLE
+                continue
+            n += 1
+
+
+    def _select(self, job):
+        '''
+        Takes in a job message: starts the job if none is being received,
+        or sends the done message again if it is the job just finished.
+        @param job The job id
+        '''
+        if self.job == 0 and job != 0:
+            if job == self.last_done:
+                if self._done_left == 0:
+                    self._done_left = DONE_SIZE
+            else:
+                self.job = job
+        self._mine = job == self.job
+
+
+    @micropython.native
+    def _write_id(self, message, at, value):
+        '''
+        Writes a number as 8 hex digits into a message.
+        @param message The message bytearray
+        @param at Index of the first digit
+        @param value The number
+        '''
+        for n in range(7, -1, -1):
+            message[at + n] = _HEX[value & 15]
+            value >>= 4
+
+
+    def _make_credit(self):
+        '''
+        Writes the credit message for the current job and offsets.
+        '''
+        message = self._credit
+        message[0] = CREDIT
+        self._write_id(message, 1, self.job)
+        message[9] = 32
+        self._write_id(message, 10, self.received)
+        message[18] = 32
+        self._write_id(message, 19, self.limit())
+        message[27] = 10
+        self._credit_left = CREDIT_SIZE
+
+
+    def run(self):
+        '''
+        Receiver task function. Reads what the host sent when the ring has
+        room for it, up to bytes_per_run bytes, wakes the command task if
+        its reader is waiting and sends credit once a quarter of the ring
+        has been read, a hello has come or the whole job has been received.
+        A done message waiting goes first.
+        '''
+        import pyb
+        vcp = pyb.USB_VCP()
+        stage = self._stage
+        quantum = self._size//4
+        while True:
+            budget = self.bytes_per_run
+            while budget > 0 and vcp.any():
+                room = self.ring.room()
+                if room > len(stage):
+                    room = len(stage)
+                if room == 0:
+                    break
+                count = vcp.readinto(stage, room)
+                if not count:
+                    break
+                self._parse(count)
+                budget -= count
+            if self._starved and self.task is not None and (
+                    self.ring.any() or self.ended()):
+                self.task.go()
+            if self._credit_left == 0 and self._done_left:
+                sent = vcp.send(self._done_view[DONE_SIZE - self._done_left:],
+                                timeout = 0)
+                self._done_left -= sent
+            elif self._credit_left == 0 and (
+                    self._hello or self.limit() - self._granted >= quantum
+                    or (self.ended() and self._reported != self.received)):
+                self._hello = False
+                self._make_credit()
+                self._granted = self.limit()
+                self._reported = self.received
+            if self._credit_left:
+                sent = vcp.send(self._credit_view[CREDIT_SIZE
+                                                  - self._credit_left:],
+                                timeout = 0)
+                self._credit_left -= sent
+            yield(0)
+
+
+    def __repr__(self):
+        '''
+        @return The job, the bytes received and the underrun statistics
+        '''
+        return ('Job stream job {:08x} {:d} bytes, {:d} finished, {:d} '
+                'underruns, {:d} ms starved, {:d} rejected, {:d} resyncs, '
+                '{:d} hellos'.format(
+                    self.job, self.received, self.finished, self.underruns,
+                    self.starved_us//1000, self.rejected, self.resyncs,
+                    self.hellos))
@@ -3,6 +3,7 @@ This is the main file that runs the pen plotter.
 @authors Sam Lee and Dima Kyle
 '''
 
+import os
 import pyb
 import micropython
 import gc
@@ -10,6 +11,15 @@ import cotask
 import motor_task
 import io_funcs
 import servo
+import capture
+import checkpoint
+import controller
+import encoder
+import jobindex
+import jobreader
+import jobstream
+import task_share
+import telemetry
 
 
 micropython.alloc_emergency_exception_buf (100)
@@ -19,52 +29,145 @@ micropython.alloc_emergency_exception_buf (100)
 lift = 30
 # Tolerance between setpoint and actual
 tolerance = 20
+# Record the response of both axes during the plot and send it over the
+# USB VCP when the plot ends. Size is in samples per axis, 0 to turn it off.
+capture_size = 0
+# Gain table for motor 1 scheduled on the position of motor 2, made by
+# make_gain_table.py. None to use the fixed gains in motor_task.py.
+gain_table_file = None
+# Latch both encoders together so arrival is checked on positions from the
+# same instant
+group_encoders = True
+# Snapshot of both encoders when group_encoders is True
+axes = None
+# Read the encoder counters and write the motor compare registers directly
+# (fastio.py) instead of through pyb.Timer
+fast_io = False
+# Run both control loops in one task (motor_task.AxisPair) instead of one
+# task per motor. The encoders are always latched together when merged.
+merge_axes = True
+# The AxisPair when merge_axes is True
+pair = None
+# Run the command task only when there is something to do: when both motors
+# arrive at its target, when the servo is done, or right away when it can
+# go on. False to poll it every 50 ms.
+event_command = True
+# Arrival criteria for each kind of move: (tolerance [ticks], largest speed
+# of each motor [ticks/s] or None for any speed, control updates in a row at
+# the point). travel is pen up moves, first is the first point of a stroke,
+# where the pen comes down, and point is the other points of a stroke. A
+# tolerance of None uses tolerance. Job files can change them with AR lines.
+arrival_profiles = {'travel': (60, None, 1),
+                    'first': (None, 2000, 2),
+                    'point': (None, None, 1)}
+# The motor_task.ArrivalSignal used to check and signal arrival
+arrival = None
+# Travel time model of the pen servo. Measure your servo and make one with
+# servo.ServoTravel.fit() for the best timing.
+travel = servo.ServoTravel(deg_per_s = 545, dead_ms = 20, settle_ms = 30)
+# Start lifting and lowering the pen on the final approach, the servo travel
+# time before the predicted arrival, instead of after arrival. The pen is
+# lowered to hover degrees above the paper before arrival and only touches
+# down once both motors are at the point.
+pen_overlap = True
+# Lead time before the predicted arrival [ms], None for the servo travel time
+pen_lead_ms = None
+# Height the pen waits at above the paper before touching down [degrees]
+hover = 10
+# Points of a stroke held at a time, longer strokes are read in windows
+job_points = 64
+# The jobreader.JobReader decoding the job file
+reader = None
+# Queue the points of a stroke for the motor tasks, which take the next one
+# themselves on arrival, so the command task decodes ahead of the motors.
+# False to hand the points over one at a time.
+setpoint_fifo = True
+# Points in the setpoint queue, and the watermarks: the command task stops
+# decoding at fifo_high points and is woken at fifo_low (None for the depth
+# and a quarter of it)
+fifo_depth = 32
+fifo_high = None
+fifo_low = None
+# The motor_task.SetpointFIFO when setpoint_fifo is True
+fifo = None
+# Send the state of both axes as binary telemetry records (telemetry.py)
+# every telemetry_decimate control updates instead of printing it, 0 to
+# print. Decode them on the host with telemetry.py.
+telemetry_decimate = 0
+# The telemetry.Telemetry when telemetry_decimate is set
+telemetry_stream = None
+# Receive the job over the USB VCP from stream_job.py on the host instead of
+# opening a file on the flash
+stream_job = False
+# Bytes of a streamed job held on the board, and the period of the task
+# receiving them [ms]
+stream_ring = 4096
+stream_period = 10
+# Streamed jobs to plot before ending, 0 to plot one after another until
+# stopped (for job_server.py)
+stream_jobs = 1
+# Start without the prompts, for plotters run by job_server.py: the pen is
+# taken as calibrated at pen_down_angle and the arms as at the calibration
+# point when the board starts. Use it with stream_job.
+unattended = False
+pen_down_angle = 90
+# Save the offset of the command being plotted to this file on the flash
+# (checkpoint.py), so a plot that stopped can carry on from that command.
+# It is saved every checkpoint_ms at most, with the pen up. None not to.
+checkpoint_file = 'checkpoint.bin'
+checkpoint_ms = 60000
+# The checkpoint.Checkpoint of a job from the flash
+job_checkpoint = None
+# Line of the job to start at, found in the index parse_hpgl.py writes next
+# to the job file. None to start at the first line, or at the checkpoint.
+start_line = None
 
 def servo_func():
     '''
-    Servo task function. This function has 2 (3 including a done state).
-    The three states are Up, Down, and Done.
-    servo_state is what causes the state to change
-    This function receives a class instance of a servo and the angles that
-    correspond with down and up.
+    Servo task function. The command task asks for a pen position with
+    servo_state: 'UP', 'HOVER' (hover degrees above the paper) or 'DOWN'.
+    The servo is only written when the request changes (Servo.move), and
+    once the travel model says the servo has got there servo_state is set
+    to 'DONE' and the command task is woken.
+    As a guard, while the pen is asked to go down and the motors are not at
+    the point (the arrival target), or are predicted from their speed to
+    leave it before the pen gets down, the pen is held at the hover height.
     '''
     global pen_servo, servo_state, up_angle, down_angle
-    # Initial state
-    state = 0
-    # How many time it iterates before moving to its next state
-    time_reset = 100
-    # Initializing time
-    time = time_reset
     
     while True:
         # Setting to correct state
         if servo_state == 'UP':
             state = 1
+            angle = up_angle
         elif servo_state == 'DOWN':
             state = 2
+            angle = down_angle
+            # Time until the pen touches down
+            if pen_servo.target == down_angle:
+                ahead = pen_servo.remaining_us()
+            else:
+                ahead = pen_servo.travel_us(down_angle)
+            if not arrival.at(arrival.target[0], arrival.target[1], ahead):
+                # Never touching down off the point, holding the pen up
+                # (and not done) until the motors are back
+                angle = down_angle + hover
+                state = 4
+        elif servo_state == 'HOVER':
+            state = 3
+            angle = down_angle + hover
         else:
             state = 0
-        if state == 1:
-            # Bring the pen up
-            pen_servo.write_angle(degrees = up_angle)
-            time -= 1
-            if time == 0:
+        if state != 0:
+            # Moving the pen, which does nothing if it is already going there
+            if pen_servo.move(angle) == 0 and state != 4:
                 servo_state = 'DONE'
                 print('Done')
-                state = 0
-                time = time_reset
-        if state == 2:
-            # Bring the pen down
-            pen_servo.write_angle(degrees = down_angle)
-            time -= 1
-            if time == 0:
-                servo_state = 'DONE'
-                print('Done')
-                state = 0
-                time = time_reset
+                wake_command()
         #print(servo_state)
         yield(state)
 
+
 def command_func():
     '''
     This is the main command function. It takes in a two motor task instances
@@ -74,14 +177,25 @@ def command_func():
     It takes in a file and reads it line by line. Parses it by the command.
     The commands are the main states of this task.
     There are 5 main states: NEXT, IN, PU, PD, SP. IN and SP are neglected.
-    In NEXT, the next line of the file is read and parsed to get the next
-    command and maybe points.
+    In NEXT, the next line of the file is read and decoded by the
+    jobreader.JobReader into its command and points, without allocating.
     PU brings the pen up after reaching a setpoint
     PD brings the motor to a point, brings the pen down, and then traces the 
     following points.
+    AR lines in the job (usually in its header) set an arrival profile,
+    with the name, tolerance [ticks], largest speed [ticks/s] (0 for any)
+    and dwell [control updates]:
+    @code
+    ['AR;travel;60;0;1']
+    @endcode
     '''
-    global motor_1_task, motor_2_task, file, servo_state, end
+    global motor_1_task, motor_2_task, reader, servo_state, end
     COM = 'NEXT'
+    # The pen position asked for in this command
+    pen = ''
+    # True while the pen is up and the motors are at the last point, when
+    # the checkpoint can be saved
+    rest = True
     # A time reset variable. This would be the preferred way to control the 
     # system but since we did not have our controls down we chose to use a
     # tolerance instead
@@ -90,119 +204,411 @@ def command_func():
     
     while True:
         if COM == 'NEXT':
-            # Read line and parse the commands and points
-            line = file.readline()
-            if line == '':
+            # Read line and decode the command and points
+            code = reader.next()
+            if reader.waiting:
+                # A streamed job has no more bytes yet, the job stream
+                # wakes the task when they come
+                yield(COM)
+                continue
+            if code == jobreader.NONE:
+                if job_checkpoint is not None:
+                    # The job has been plotted, so it isn't carried on
+                    job_checkpoint.finish()
+                if isinstance(file, jobstream.JobStream):
+                    # Telling the host the job has been plotted
+                    file.finish()
+                    print(file)
+                    if stream_jobs == 0 or file.finished < stream_jobs:
+                        # Reading the next job, which waits for it to come
+                        reader.reset()
+                        continue
                 end = True
                 yield(COM)
-            # Getting rid of end extra quotes
-            line = line[1:-1]
-            # Split the COM, number of coordinates, and list of coordinates
-            command_list = line.split(';')
-            # The command is the first of the list
-            COM = command_list[0]
-            # Getting rid of extra quote
-            COM = COM[1:]
+            COM = jobreader.NAMES.get(code, '?')
             print(COM)
-            # Second entry is the number of coordinates
-            point_num = int(command_list[1])
-            # Deleting the first two to only have the coordinates remain
-            del command_list[0]
-            del command_list[0]
-            points = command_list[0]
-            # Getting rid of extra end quotes and space
-            points = points[4:-2]
+            if job_checkpoint is not None and code != jobreader.NONE:
+                # A restart carries on from the command about to be plotted.
+                # Writing the flash holds up the tasks, so it is only saved
+                # with the motors at rest.
+                job_checkpoint.update(reader.line_offset)
+                if rest and job_checkpoint.due():
+                    job_checkpoint.save()
+            if COM == 'AR':
+                set_profile()
+                COM = 'NEXT'
         elif COM == 'IN':
             # Simply move to next command
             COM = 'NEXT'
+            wake_command()
             yield(COM)            
         elif COM == 'PU':
-            point_one = points.split('x')
             # Setting ticks
-            ticks_1 = int(point_one[0])
-            ticks_2 = int(point_one[1])
+            ticks_1 = reader.points[0]
+            ticks_2 = reader.points[1]
             # Setting the motor task setpoints
             motor_1_task.control.set_setpoint(ticks_1)
             motor_2_task.control.set_setpoint(ticks_2)
             time -= 1 
             # booleans for whether the motors are here or not
-            here_1 = ticks_1-tolerance<motor_1_task.position < ticks_1+tolerance
-            here_2 = ticks_2-tolerance<motor_2_task.position < ticks_2+tolerance 
-            if servo_state == 'DONE':
+            arrival.use('travel')
+            here = arrived(ticks_1, ticks_2)
+            if here and pen == 'UP' and servo_state == 'DONE':
                 # Checking if the servo is done then move
                 COM = 'NEXT'
                 servo_state = ''
+                pen = ''
                 time = time_reset
-            if here_1 and here_2:
-                # If both points are there set the servo to go up
+                rest = True
+            elif pen == '' and (here or pen_lead(ticks_1, ticks_2, up_angle)):
+                # If both points are there (or about to be) set the servo to
+                # go up
+                pen = 'UP'
                 servo_state = 'UP'
+            lead_us = pen_lead_us(up_angle) if pen == '' else 0
+            wait_for(COM, here, ticks_1, ticks_2, lead_us)
             yield(COM) 
             
         elif COM == 'PD':
             # Bring the pen to a point, pen down, then trace all other points
-            points_list = points.replace("'","")
-            # Getting rid of quotes
-            if point_num>1:
-                points_list = points_list.split(',')
-                point_paired = [x.split('x')for x in points_list]
-            else:
-                # If there is only one pair of points
-                point_paired = [points.split('x')]
-            point_one = point_paired[0]
-            ticks_1 = int(point_one[0])
-            ticks_2 = int(point_one[1])
+            ticks_1 = reader.points[0]
+            ticks_2 = reader.points[1]
             # Setting the motor ticks 
             motor_1_task.control.set_setpoint(ticks_1)
             motor_2_task.control.set_setpoint(ticks_2)
             time -= 1
-            here_1 = ticks_1-tolerance<motor_1_task.position < ticks_1+tolerance
-            here_2 = ticks_2-tolerance<motor_2_task.position < ticks_2+tolerance
+            arrival.use('first')
+            here = arrived(ticks_1, ticks_2)
             
-            if servo_state == 'DONE':
+            if pen == 'DOWN' and servo_state == 'DONE':
                 # When the servo is down
                 time = time_reset
-                if point_num > 1:
-                    # Delete the first point since we are already there
-                    del point_paired[0]
-                    n = 0
-                    while n < len(point_paired)-1:
+                # Start from the second point since we are already at the
+                # first
+                arrival.use('point')
+                n = 1
+                if fifo is not None:
+                    # Decoding the points into the setpoint queue ahead of
+                    # the motors, which take them on arrival
+                    fifo.start()
+                    while not fifo.done():
+                        while not fifo.closed and not fifo.full():
+                            if n >= reader.n_points:
+                                # End of the window of points
+                                if reader.more() == 0:
+                                    if not reader.waiting:
+                                        fifo.close()
+                                    break
+                                n = 0
+                            fifo.put(reader.points[2*n],
+                                     reader.points[2*n + 1])
+                            n += 1
+                        if not fifo.done():
+                            fifo.wait()
+                            yield(COM)
+                else:
+                    while True:
+                        if n >= reader.n_points:
+                            # End of the window of points, reading the next
+                            # points of the stroke from the file
+                            if reader.more() == 0:
+                                if reader.waiting:
+                                    yield(COM)
+                                    continue
+                                break
+                            n = 0
                         # For every other point, trace
-                        point = point_paired[n]
-                        ticks_1 = int(point[0])
-                        ticks_2 = int(point[1])
+                        ticks_1 = reader.points[2*n]
+                        ticks_2 = reader.points[2*n + 1]
                         motor_1_task.control.set_setpoint(ticks_1)
                         motor_2_task.control.set_setpoint(ticks_2)
-                        here_1 = ticks_1-tolerance<motor_1_task.position < ticks_1+tolerance
-                        here_2 = ticks_2-tolerance<motor_2_task.position < ticks_2+tolerance
+                        here = arrived(ticks_1, ticks_2)
                         #print(point)
                         #print(motor_1_task.position,motor_2_task.position)
-                        #print(here_1,here_2)
-                        if here_1 and here_2:
+                        if here:
                             n += 1
+                            wake_command()
+                        else:
+                            wait_arrival(ticks_1, ticks_2)
                         yield(COM)
                 #gc.collect()
                 COM = 'NEXT'
                 servo_state = ''
+                pen = ''
                 time = time_reset
-            if here_1 and here_2:
+                rest = False
+            elif here:
                 # Setting the servo down
-                servo_state = 'DOWN'
+                if pen != 'DOWN':
+                    pen = 'DOWN'
+                    servo_state = 'DOWN'
+            elif pen == '' and pen_lead(ticks_1, ticks_2,
+                                        down_angle + hover):
+                # Lowering the pen to just above the paper on the approach
+                pen = 'HOVER'
+                servo_state = 'HOVER'
+            lead_us = pen_lead_us(down_angle + hover) if pen == '' else 0
+            wait_for(COM, here, ticks_1, ticks_2, lead_us)
             yield(COM)
         elif COM == 'SP':
             # Ignore
             COM = 'NEXT'
         else:
             print('uh oh')
+            COM = 'NEXT'
         #gc.collect()
+        wake_command()
         yield(COM)
     
     
+def make_motor_tasks():
+    '''
+    Creates the two motor control tasks and adds them to the task list.
+    If merge_axes is True both control loops run in a single AxisPair task.
+    If gain_table_file is set, the gains of motor 1 are scheduled on the
+    position of motor 2. If group_encoders is True, both encoders are
+    latched together by motor 1's task and the command task checks arrival
+    on that coherent snapshot. If fast_io is True, the encoders and motors
+    use direct register access.
+    '''
+    global motor_1_task, motor_2_task, axes, pair, arrival, fifo
+    global telemetry_stream
+    motor_1_task = motor_task.Motor_control_task(0, fast_io)
+    motor_2_task = motor_task.Motor_control_task(1, fast_io)
+    axes = None
+    pair = None
+    if merge_axes:
+        # One task for both motors, latching both encoders every run
+        pair = motor_task.AxisPair(motor_1_task, motor_2_task)
+        axes = pair.group
+        motors = cotask.Task(pair.run, name = 'Motors', priority = 3,
+                             period = 8, profile = True)
+        cotask.task_list.append(motors)
+    else:
+        mname1 = 'Motor_' + str (motor_1_task.motor_number)
+        cotask.task_list.append(cotask.Task(motor_1_task.run_motor,
+            name = mname1, priority = 3, period = 8, profile = True))
+        mname2 = 'Motor_' + str (motor_2_task.motor_number)
+        motors = cotask.Task(motor_2_task.run_motor, name = mname2,
+                             priority = 3, period = 8, profile = True)
+        cotask.task_list.append(motors)
+        
+        # Reading both encoders at the same instant
+        if group_encoders:
+            axes = encoder.AxisGroup(motor_1_task.encoder,
+                                     motor_2_task.encoder)
+            motor_1_task.set_group(axes, leader = True)
+            motor_2_task.set_group(axes, leader = False)
+    
+    # Checking arrival after every control update. With two tasks motor 2's
+    # task checks, as it runs after motor 1's.
+    arrival = motor_task.ArrivalSignal(motor_1_task, motor_2_task, tolerance,
+                                       group = axes)
+    for name in arrival_profiles:
+        profile_tolerance, speed, dwell = arrival_profiles[name]
+        if profile_tolerance is None:
+            profile_tolerance = tolerance
+        arrival.set_profile(name, profile_tolerance, speed, dwell)
+    if pair is not None:
+        pair.set_arrival(arrival)
+    else:
+        motor_2_task.set_arrival(arrival)
+    # The motor tasks take the points of strokes from the setpoint queue
+    fifo = None
+    if setpoint_fifo:
+        fifo = motor_task.SetpointFIFO(arrival, fifo_depth, fifo_high,
+                                       fifo_low)
+        arrival.set_fifo(fifo)
+    
+    # Binary telemetry sampled by the task which checks arrival
+    telemetry_stream = None
+    if telemetry_decimate:
+        telemetry_stream = telemetry.Telemetry(motor_1_task, motor_2_task,
+                                               telemetry_decimate)
+        telemetry_stream.set_task(motors)
+        telemetry_stream.set_arrival(arrival)
+        writer = cotask.Task(telemetry_stream.run, name = 'Telemetry',
+                             priority = 0, profile = True)
+        telemetry_stream.set_writer(writer)
+        cotask.task_list.append(writer)
+        if pair is not None:
+            pair.set_telemetry(telemetry_stream)
+        else:
+            motor_2_task.set_telemetry(telemetry_stream)
+    
+    # Scheduling the gains of motor 1 on the arm 2 position
+    if gain_table_file:
+        table, start, step = controller.load_gain_table(gain_table_file)
+        motor_1_task.control.set_gain_table(table, start, step)
+        motor_1_task.couple(motor_2_task)
+
+
+def set_calibration_point():
+    '''
+    Sets the motors to the calibration point, x = 0 and y = L1 + L2.
+    '''
+    # Setting the motors to the initial position
+    motor_1_task.position = 800
+    motor_1_task.encoder.position = 800
+    motor_1_task.control.actual = 800
+    motor_1_task.control.setpoint = 800
+    motor_2_task.position = 0
+    motor_2_task.encoder.position = 0
+    motor_2_task.control.actual = 0
+    motor_2_task.control.setpoint = 0
+    if axes is not None:
+        axes.snapshot[0] = 800
+        axes.snapshot[1] = 0
+
+
+def make_job_tasks():
+    '''
+    Creates the servo task and the command task and adds them to the task
+    list. If event_command is True the command task has no period and is
+    started right away. If the job file is a jobstream.JobStream, the task
+    receiving it is added too.
+    '''
+    global servo_task, command_task, servo_state, reader
+    reader = jobreader.JobReader(file, max_points = job_points)
+    servo_task = cotask.Task(servo_func, name = 'Servo Task', priority=1,
+                             period = 50, profile = True)
+    command_task = cotask.Task(command_func, name = 'Command Task', priority=2,
+                             period = None if event_command else 50,
+                             profile = True)
+    cotask.task_list.append(servo_task)
+    cotask.task_list.append(command_task)
+    servo_state = ''
+    pen_servo.travel = travel
+    arrival.set_task(command_task)
+    if fifo is not None:
+        fifo.set_task(command_task)
+    if telemetry_stream is not None:
+        telemetry_stream.set_job(reader)
+    if isinstance(file, jobstream.JobStream):
+        # The job comes over the USB VCP
+        receiver = cotask.Task(file.run, name = 'Job Stream', priority = 1,
+                               period = stream_period, profile = True)
+        file.set_task(command_task)
+        cotask.task_list.append(receiver)
+    wake_command()
+
+
+def set_profile():
+    '''
+    Sets the arrival profile of the AR line the reader has just read: its
+    name, tolerance, speed and dwell.
+    '''
+    speed = reader.args[1]
+    arrival.set_profile(reader.name_str(), reader.args[0],
+                        speed if speed > 0 else None, reader.args[2])
+
+
+def start_at(offset):
+    '''
+    Starts the job at the line at an offset of the job file instead of at
+    its first line, by seeking the file. The AR lines at the start of the
+    job are read first, as they apply to the whole job. Call it after
+    make_job_tasks() and before the tasks run.
+    @param offset Offset of the line in the job file
+    '''
+    while reader.next() == jobreader.AR:
+        set_profile()
+    file.seek(offset)
+    reader.reset(offset)
+    if job_checkpoint is not None:
+        job_checkpoint.update(offset)
+
+
+def arrived(ticks_1, ticks_2):
+    '''
+    Checks if both motors have arrived at a point with the arrival profile
+    in use: within its tolerance, slower than its speed and for its dwell.
+    With grouped encoders both positions come from the same snapshot.
+    @param ticks_1 Setpoint of motor 1 [ticks]
+    @param ticks_2 Setpoint of motor 2 [ticks]
+    @return True if both motors are there
+    '''
+    return arrival.arrived(ticks_1, ticks_2)
+
+
+def wake_command():
+    '''
+    Makes the event driven command task run again on the next pass of the
+    scheduler. A polled command task runs on its period anyway.
+    '''
+    if event_command:
+        command_task.go()
+
+
+def wait_arrival(ticks_1, ticks_2, lead_us=0):
+    '''
+    Makes the event driven command task run again when both motors arrive
+    at a point, and also lead_us before the predicted arrival.
+    @param ticks_1 Setpoint of motor 1 [ticks]
+    @param ticks_2 Setpoint of motor 2 [ticks]
+    @param lead_us Lead time [us], 0 to only wake on arrival
+    '''
+    if event_command:
+        arrival.arm(ticks_1, ticks_2, lead_us)
+
+
+def wait_for(COM, here, ticks_1, ticks_2, lead_us=0):
+    '''
+    Decides what wakes the event driven command task after a PU or PD run:
+    itself if the command is done, the arrival at the point (or the lead
+    time before it) if the motors are not there yet, and the servo when it
+    is done.
+    @param COM The command after this run
+    @param here True if both motors are at the point
+    @param ticks_1 Setpoint of motor 1 [ticks]
+    @param ticks_2 Setpoint of motor 2 [ticks]
+    @param lead_us Lead time before arrival to wake at [us]
+    '''
+    if COM == 'NEXT':
+        wake_command()
+    elif not here:
+        wait_arrival(ticks_1, ticks_2, lead_us)
+
+
+def pen_lead_us(angle):
+    '''
+    @param angle The angle the pen is to move to [degrees]
+    @return How long before the predicted arrival the pen should start to
+    move to angle [us], 0 if pen_overlap is False
+    '''
+    if not pen_overlap:
+        return 0
+    if pen_lead_ms is not None:
+        return int(pen_lead_ms*1000)
+    return pen_servo.travel_us(angle)
+
+
+def pen_lead(ticks_1, ticks_2, angle):
+    '''
+    Checks if both motors are predicted to arrive at a point within the
+    lead time of a pen move, from their distance to go and speed.
+    @param ticks_1 Setpoint of motor 1 [ticks]
+    @param ticks_2 Setpoint of motor 2 [ticks]
+    @param angle The angle the pen is to move to [degrees]
+    @return True if the pen should start to move
+    '''
+    lead_us = pen_lead_us(angle)
+    if lead_us == 0:
+        return False
+    eta = arrival.eta_us(ticks_1, ticks_2)
+    return 0 <= eta <= lead_us
+
+
 if __name__ == "__main__":
     # Pen initialization and calibration
     pen_servo = servo.Servo('PA5',prescaler=4.5, freq=25, min_us=665, max_us=2360, angle=190)
     pen_servo.write_angle(90)
-    pen_cal = True
+    pen_cal = not unattended
     n = 0
+    if unattended:
+        angle = pen_down_angle
+        down_angle = angle
+        up_angle = down_angle+lift
     # Loop to get correct pen down angle
     while pen_cal == True:
         answer = io_funcs.get_input(str,'Calibrated? [y/n] ')
@@ -228,49 +634,69 @@ if __name__ == "__main__":
     pen_servo.write_angle(up_angle)
             
     # Filename for hpgl text file
-    file_search = True
+    file_search = not stream_job
+    if stream_job:
+        print('Send the job with stream_job.py or job_server.py')
+        file = jobstream.JobStream(stream_ring)
     while file_search == True:
         file_name = io_funcs.get_input(str,'File name? [file.txt] ')
         try:
-            file = open(file_name,'r')
+            file = open(file_name,'rb')
             file_search = False
         except:
             print('Not a valid file name or type. Please try again')
     
-    # Initializing motors and encoders with a task
-    motor_1_task = motor_task.Motor_control_task(0)
-    mname1 = 'Motor_' + str (motor_1_task.motor_number)
-    cotask.task_list.append(cotask.Task(motor_1_task.run_motor, name = mname1,
-        priority = 3, period = 8, profile = True))
+    # Carrying on from the checkpoint of the job or starting at a line
+    start = 0
+    if not stream_job:
+        length = os.stat(file_name)[6]
+        index = jobindex.open_index(file_name, length)
+        if checkpoint_file:
+            job_checkpoint = checkpoint.Checkpoint(checkpoint_file,
+                                                   period_ms = checkpoint_ms)
+            start = job_checkpoint.load(file_name, length)
+        if start_line is not None and index is not None:
+            start = index.offset(start_line)
+        elif start > 0:
+            if index is not None:
+                line = index.find(start)
+                print('Stopped at line '+str(line)+' of '+str(index.lines)
+                      +', '+str(100*index.points(line)
+                                //max(index.points_total, 1))
+                      +'% of the points')
+            else:
+                print('Stopped at byte '+str(start)+' of '+str(length))
+            answer = 'y'
+            while not unattended:
+                answer = io_funcs.get_input(str,'Carry on from there? [y/n] ')
+                if answer == 'y' or answer == 'n':
+                    break
+                print('Incorrect input')
+            if answer == 'n':
+                start = 0
+        if index is not None:
+            index.close()
     
-    motor_2_task = motor_task.Motor_control_task(1)
-    mname2 = 'Motor_' + str (motor_2_task.motor_number)
-    cotask.task_list.append(cotask.Task(motor_2_task.run_motor, name = mname2,
-        priority = 3, period = 8, profile = True))
+    # Initializing motors and encoders with a task
+    make_motor_tasks()
     
     # Zero calibration
     print('Bring the motors to calibration point, aka x = 0 and y = L1 + L2')
-    cal = True
+    cal = not unattended
+    if unattended:
+        set_calibration_point()
     while cal == True:
         answer = io_funcs.get_input(str,'At position? [y/n] ')
         if answer == 'n':
             print('Bring the motors to calibration point, aka x = 0 and y = L1 + L2')
         elif answer == 'y':
             print('At calibration point. Setting position to calibration point')
-            # Setting the motors to the initial position
-            motor_1_task.position = 800
-            motor_1_task.encoder.position = 800
-            motor_1_task.control.actual = 800
-            motor_1_task.control.setpoint = 800
-            motor_2_task.position = 0
-            motor_2_task.encoder.position = 0
-            motor_2_task.control.actual = 0
-            motor_2_task.control.setpoint = 0
+            set_calibration_point()
             cal = False
         else:
             print('Incorrect input')
     
-    run_wait = True
+    run_wait = not unattended
     while run_wait == True:
         answer = io_funcs.get_input(str,'Run? [y/n] ')
         if answer == 'n':
@@ -282,13 +708,18 @@ if __name__ == "__main__":
             print('Incorrect input')
     
     # Initializing a servo task and a command task
-    servo_task = cotask.Task(servo_func, name = 'Servo Task', priority=1,
-                             period = 50, profile = True)
-    command_task = cotask.Task(command_func, name = 'Command Task', priority=2,
-                             period = 50, profile = True)
-    cotask.task_list.append(servo_task)
-    cotask.task_list.append(command_task)
-    servo_state = ''
+    make_job_tasks()
+    if start:
+        start_at(start)
+    
+    # Optional response captures, allocated before the plot starts
+    if capture_size:
+        for task in (motor_1_task, motor_2_task):
+            cap = capture.ResponseCapture(size=capture_size,
+                                          pre=capture_size//8,
+                                          axis=task.motor_number)
+            task.control.set_capture(cap)
+            cap.arm()
 
     # Running Main Printing
     vcp = pyb.USB_VCP ()    
@@ -302,10 +733,33 @@ if __name__ == "__main__":
         except:
             motor_1_task.motor.set_duty_cycle(0)
             motor_2_task.motor.set_duty_cycle(0)
+            if job_checkpoint is not None and not end:
+                # Carrying on from the command being plotted next time, saved
+                # on the first fault only
+                try:
+                    job_checkpoint.save()
+                except OSError:
+                    pass
             end = True
     # Turning off the motors before ending
     motor_1_task.motor.set_duty_cycle(0)
     motor_2_task.motor.set_duty_cycle(0)
     print('Ending program')
+    if pair is not None:
+        print(pair)
+    if fifo is not None:
+        print(fifo)
+    if telemetry_stream is not None:
+        print(telemetry_stream)
+    if stream_job:
+        print(file)
+    if job_checkpoint is not None:
+        print(job_checkpoint)
+    # Queue statistics, for sizing the queues
+    print(task_share.show_all())
+    # Sending the captured responses as binary blocks
+    if capture_size:
+        for task in (motor_1_task, motor_2_task):
+            task.control.capture.export(vcp)
     # Always close the file!
     file.close()
@@ -0,0 +1,138 @@
+'''
+@file make_gain_table.py
+@authors Sam Lee and Dima Kyle
+Gain table file for the host computer. It makes the gain schedule loaded by
+controller.load_gain_table, which sets the gains of motor 1 (joint 0) from
+the arm 2 position so the response is the same all over the workspace.
+
+The gains are scaled with the effective inertia seen by joint 0, so the
+nominal gains (the ones tuned with the arm straight, arm 2 at 0 ticks) are
+kept where the inertia is the nominal one. The inertia can come from:
+
+- the kinematics, treating the arms as uniform rods:
+  J(theta_2) = J_rotor + m1*L1^2/3 + m2*(L1^2 + L2^2/3 + L1*L2*cos(theta_2))
+- identified plant models at several arm 2 positions (sysid.py json files).
+  For a first order motor tau/gain is proportional to the inertia.
+
+The table is sampled every step ticks over one revolution of arm 2 and
+stored already interpolated, so the firmware only indexes it.
+
+@code
+python make_gain_table.py kinematic --L1 8.11 --L2 10.08 --m1 1 --m2 1
+python make_gain_table.py plants 0:plant_0.json 800:plant_800.json
+@endcode
+'''
+
+import argparse
+import struct
+import numpy
+
+import simulator
+simulator.install()
+import controller
+
+
+def kinematic_inertia(ticks, cpr, L1, L2, m1, m2, rotor=0.0):
+    '''
+    Finds the inertia about joint 0 of two uniform rod arms.
+    @param ticks Array of arm 2 positions [ticks]
+    @param cpr Encoder counts per output revolution
+    @param L1 Length of arm 1 [in]
+    @param L2 Length of arm 2 [in]
+    @param m1 Mass of arm 1
+    @param m2 Mass of arm 2 (including the pen carriage)
+    @param rotor Reflected motor and gearbox inertia
+    @return Array of inertias in mass*in^2
+    '''
+    theta_2 = 2*numpy.pi*numpy.asarray(ticks, dtype=float)/cpr
+    return (rotor + m1*L1**2/3
+            + m2*(L1**2 + L2**2/3 + L1*L2*numpy.cos(theta_2)))
+
+
+def plant_inertia(ticks, entries, joint=0):
+    '''
+    Interpolates the relative inertia of a joint between identified plants.
+    @param ticks Array of arm 2 positions [ticks]
+    @param entries List of (arm 2 ticks, plant json file)
+    @param joint The joint whose plant is used
+    @return Array of relative inertias
+    '''
+    at = []
+    ratio = []
+    for tick, file_name in sorted(entries):
+        plant = simulator.load_plants(file_name)[joint]
+        at.append(tick)
+        ratio.append(plant.tau/plant.gain)
+    return numpy.interp(ticks, at, ratio)
+
+
+def make_table(inertia, nominal, gains):
+    '''
+    Scales the nominal gains by the inertia.
+    @param inertia Array of inertias at the table positions
+    @param nominal The inertia the nominal gains were tuned at
+    @param gains (K_P, K_I, K_D) nominal gains
+    @return Array of shape (n, 3) of scheduled gains
+    '''
+    scale = numpy.asarray(inertia)/nominal
+    return numpy.outer(scale, gains)
+
+
+def write_table(file_name, table, start, step):
+    '''
+    Writes a gain table in the format read by controller.load_gain_table.
+    @param table Array of shape (n, 3) of K_P, K_I, K_D
+    @param start Position of the first entry [ticks]
+    @param step Ticks between entries
+    '''
+    with open(file_name, 'wb') as file:
+        file.write(struct.pack(controller.GAIN_TABLE_HEADER,
+                               controller.GAIN_TABLE_MAGIC, len(table),
+                               int(start), int(step)))
+        file.write(numpy.asarray(table, dtype='<f4').tobytes())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Make a gain schedule')
+    parser.add_argument('source', choices=('kinematic', 'plants'))
+    parser.add_argument('plants', nargs='*', metavar='TICKS:FILE',
+                        help='arm 2 position and plant json (plants only)')
+    parser.add_argument('--L1', type=float, default=8.11)
+    parser.add_argument('--L2', type=float, default=10.08)
+    parser.add_argument('--m1', type=float, default=1.0)
+    parser.add_argument('--m2', type=float, default=1.0)
+    parser.add_argument('--rotor', type=float, default=0.0)
+    parser.add_argument('--cpr', type=int, default=3200)
+    parser.add_argument('--step', type=int, default=32,
+                        help='ticks between table entries')
+    parser.add_argument('--nominal', type=int, default=0,
+                        help='arm 2 position the gains were tuned at')
+    parser.add_argument('--gains', type=float, nargs=3,
+                        default=(0.1, 0.001, 0.00001),
+                        metavar=('K_P', 'K_I', 'K_D'))
+    parser.add_argument('-o', '--output', default='gains.bin')
+    args = parser.parse_args()
+
+    start = -args.cpr//2
+    ticks = numpy.arange(start, start + args.cpr + 1, args.step)
+    if args.source == 'kinematic':
+        def inertia(at):
+            return kinematic_inertia(at, args.cpr, args.L1, args.L2,
+                                     args.m1, args.m2, args.rotor)
+    else:
+        entries = []
+        for entry in args.plants:
+            tick, file_name = entry.split(':', 1)
+            entries.append((int(tick), file_name))
+        if not entries:
+            parser.error('plants needs at least one TICKS:FILE')
+
+        def inertia(at):
+            return plant_inertia(at, entries)
+    table = make_table(inertia(ticks), float(inertia([args.nominal])[0]),
+                       args.gains)
+    write_table(args.output, table, start, args.step)
+    print('{:d} entries from {:d} ticks every {:d} ticks, gain scale '
+          '{:.3f} to {:.3f}, saved in {:s}'.format(len(table), start,
+          args.step, table[:, 0].min()/args.gains[0],
+          table[:, 0].max()/args.gains[0], args.output))
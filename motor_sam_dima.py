@@ -7,6 +7,7 @@ output the current duty cycle of a motor and set the duty cycle of the motor.
 
 import pyb
 import io_funcs
+import fastio
 
 class MotorDriver:
     ''' 
@@ -19,8 +20,13 @@ class MotorDriver:
     get_duty_cycle() ==> returns the duty_cycle of the motor
     
     Limited to Timers 3 and 5
+    
+    With fast=True, set_duty_cycle writes compare values straight into the
+    timer's CCR1 and CCR2 registers with machine.mem32, worked out from the
+    duty cycle at the timer's full resolution like pulse_width_percent,
+    instead of calling pulse_width_percent.
     '''
-    def __init__ (self, timer, pin_1, pin_2, pin_3):
+    def __init__ (self, timer, pin_1, pin_2, pin_3, fast=False):
         ''' 
         Creates a motor driver by initializing GPIO
         pins and turning the motor off for safety. We will be using DC motors
@@ -59,6 +65,7 @@ class MotorDriver:
         pin at pin_1.
         @param pin_3 Third pin for IN2 direction 2. PinIN2 is to be the output 
         pin at pin_2.
+        @param fast True to write the compare registers directly.
         '''
         ## Open-drain output pin set high to enable the DC motor
         self.pinEN = pyb.Pin(pin_1, pyb.Pin.OUT_PP)
@@ -88,6 +95,17 @@ class MotorDriver:
         self.ch1.pulse_width_percent(0)
         self.ch2.pulse_width_percent(0)
         
+        ## True if the compare registers are written directly
+        self.fast = fast
+        if fast:
+            ## Address of the channel 1 compare register
+            self.ccr1_addr = fastio.ccr_addr(timer, 1)
+            ## Address of the channel 2 compare register
+            self.ccr2_addr = fastio.ccr_addr(timer, 2)
+            ## Timer counts in a period, the compare value of 100 % duty cycle
+            self.top = self.tim.period() + 1
+            self.set_duty_cycle = self.set_duty_cycle_fast
+        
         #print ('Creating a motor driver')
 
     
@@ -132,6 +150,28 @@ class MotorDriver:
             self.ch1.pulse_width_percent(0)
             self.ch2.pulse_width_percent(0)
         #print ('Setting duty cycle to ' + str (level))
+    
+    def set_duty_cycle_fast (self, level):
+        ''' 
+        This method sets the duty cycle like set_duty_cycle but writes the
+        compare registers directly. Levels outside -100 to 100 are limited.
+        Used as set_duty_cycle when fast is True.
+        @param level The duty cycle of the motor (%) 
+        '''
+        if level > 100:
+            level = 100
+        elif level < -100:
+            level = -100
+        self.duty_cycle = int(level)
+        if level > 0:
+            fastio.mem32[self.ccr1_addr] = int(level*self.top)//100
+            fastio.mem32[self.ccr2_addr] = 0
+        elif level < 0:
+            fastio.mem32[self.ccr1_addr] = 0
+            fastio.mem32[self.ccr2_addr] = int(-level*self.top)//100
+        else:
+            fastio.mem32[self.ccr1_addr] = 0
+            fastio.mem32[self.ccr2_addr] = 0
       
 
 def main():
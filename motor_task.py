@@ -5,9 +5,11 @@ This file has a class which runs motors under closed-loop motor control
 at the same time so that motors act indepedndently of each other.
 '''
 
+import array
 import encoder
 import motor_sam_dima
 import controller
+import task_share
 
 
 class Motor_control_task:
@@ -21,9 +23,13 @@ class Motor_control_task:
     instance of the same motor controller task.
     
     There is a method run_motor() to run the motor's in a scheduler.
+    
+    If the controller has a gain table and the task is coupled to the task
+    of the other joint with couple(), the gains are scheduled on the other
+    joint's position every run.
     '''
     
-    def __init__(self, motor_num): 
+    def __init__(self, motor_num, fast=False): 
         ''' This constructor method initializes two instances of DC motors
         and two quadruture encoders. Additionally, the optimal proportional 
         gain of Kp is set for each motor. Both encoder positions 
@@ -33,6 +39,8 @@ class Motor_control_task:
         
         @param motor_number Motor number parmater that specifies which motor and 
         encoder is being initialized for each task. 
+        @param fast True to use the direct register access of the encoder
+        and motor driver.
         
         These are values that can be changed in the code itself.
         @param state The state for which the motor control task is in.
@@ -45,9 +53,9 @@ class Motor_control_task:
         '''
         self.control = controller.Controller()
         if motor_num == 0:
-            self.motor = motor_sam_dima.MotorDriver(3,'PA10','PB4','PB5')
+            self.motor = motor_sam_dima.MotorDriver(3,'PA10','PB4','PB5',fast)
             # A +/- on top board
-            self.encoder = encoder.Encoder(8,'PC6','PC7')
+            self.encoder = encoder.Encoder(8,'PC6','PC7',fast)
             # Left goes to C6, right to PC7, rotates counterclockwise positive
             self.control.set_gain(0.1)
             # Setting the KI
@@ -58,9 +66,9 @@ class Motor_control_task:
             self.control.set_KW(0)
 
         elif motor_num == 1:
-            self.motor = motor_sam_dima.MotorDriver(5,'PC1','PA0','PA1')
+            self.motor = motor_sam_dima.MotorDriver(5,'PC1','PA0','PA1',fast)
             # B +/- on top board
-            self.encoder = encoder.Encoder(4,'PB6','PB7')
+            self.encoder = encoder.Encoder(4,'PB6','PB7',fast)
             # Left goes to B6, right to PB7, rotates counterclockwise positive
             self.control.set_gain(0.1)
             # Setting the KI
@@ -80,6 +88,8 @@ class Motor_control_task:
         self.state = 0
         ## Position of the motor initially
         self.position = 0
+        ## Velocity of the motor from the encoder [ticks/s]
+        self.velocity = 0
         ## Initial setpoint
         self.control.setpoint = 3200 
         ## Iteration limit for outputting data
@@ -87,9 +97,74 @@ class Motor_control_task:
         ## Limit on the amount of iterations the motor is outputting position 
         ## data for.
         self.limit = 50
+        ## Motor task of the other joint, used for gain scheduling
+        self.other = None
+        ## Encoder AxisGroup shared with the other joint, if any
+        self.group = None
+        ## True if this task latches the group's encoders
+        self.leader = False
+        ## ArrivalSignal checked after every control update, if any
+        self.arrival = None
+        ## telemetry.Telemetry sampled after every control update, if any
+        self.telemetry = None
         # print('Initialized Motor '+str(self.motor_number))
     
     
+    def couple(self, other):
+        '''
+        Couples this task to the task of the other joint so the gains can
+        be scheduled on the other joint's position.
+        @param other The Motor_control_task of the other joint
+        '''
+        self.other = other
+
+
+    def set_group(self, group, leader):
+        '''
+        Makes this task use an encoder.AxisGroup. The leader task latches
+        both encoders at once and the other task uses the position from
+        that latch instead of reading its own encoder.
+        @param group The encoder.AxisGroup holding this task's encoder
+        @param leader True if this task reads the group
+        '''
+        self.group = group
+        self.leader = leader
+
+
+    def set_arrival(self, arrival):
+        '''
+        Makes this task check an ArrivalSignal after every control update.
+        Only one of the two motor tasks (or the AxisPair) should check it.
+        @param arrival The ArrivalSignal
+        '''
+        self.arrival = arrival
+
+
+    def set_telemetry(self, telemetry):
+        '''
+        Makes this task sample a telemetry stream after every control
+        update instead of printing its position. Only one of the two motor
+        tasks should sample it.
+        @param telemetry The telemetry.Telemetry
+        '''
+        self.telemetry = telemetry
+
+
+    def step(self, t=None):
+        '''
+        Runs one control update from the position already in self.position,
+        for tasks driven by an AxisPair.
+        @param t The time the position was latched from utime.ticks_us()
+        '''
+        # Gain scheduling on the other joint's position
+        if self.other is not None and self.control.gain_table is not None:
+            self.control.schedule(self.other.position)
+        self.velocity = self.encoder.velocity
+        self.actuation = self.control.algorithm(self.position, self.velocity,
+                                                t)
+        self.motor.set_duty_cycle(self.actuation)
+
+
     def run_motor(self):
         '''
         Motor task function consisting of two states. The first state 
@@ -102,10 +177,20 @@ class Motor_control_task:
         '''
         n = 0
         while True:
+            # Gain scheduling on the other joint's position
+            if self.other is not None and self.control.gain_table is not None:
+                self.control.schedule(self.other.position)
             # State to run with data
             if self.state == 0:
-                self.position = self.encoder.read()
-                self.actuation = self.control.algorithm(self.position)
+                if self.group is None:
+                    self.position = self.encoder.read()
+                else:
+                    if self.leader:
+                        self.group.read()
+                    self.position = self.encoder.position
+                self.velocity = self.encoder.velocity
+                self.actuation = self.control.algorithm(self.position,
+                                                        self.velocity)
                 self.motor.set_duty_cycle(self.actuation)
                 #self.iterate += 1
                 
@@ -115,19 +200,614 @@ class Motor_control_task:
                     
             # State to run without data        
             elif self.state == 1:
-                self.position = self.encoder.read()
-                self.actuation = self.control.algorithm(self.position)
+                if self.group is None:
+                    self.position = self.encoder.read()
+                else:
+                    if self.leader:
+                        self.group.read()
+                    self.position = self.encoder.position
+                self.velocity = self.encoder.velocity
+                self.actuation = self.control.algorithm(self.position,
+                                                        self.velocity)
                 self.motor.set_duty_cycle(self.actuation)
+            
+            # Waking the command task if both axes are at its target
+            if self.arrival is not None:
+                self.arrival.check()
                 
-            if n == 500:    
+            if self.telemetry is not None:
+                self.telemetry.sample()
+            elif n == 500:    
                 print(str(self.motor_number),str(self.position),str(self.control.setpoint))
                 n = 0
             n += 1
             
             yield(self.state)
+
+
+class AxisPair:
+    '''
+    Class which runs the control loops of both joints in a single task, so
+    each control cycle costs the scheduler one ready() check, one generator
+    resume and one profile update instead of two. Both encoders are latched
+    together with an encoder.AxisGroup, and the time of that latch is the
+    only utime.ticks_us() read of the cycle; both controllers use it.
+    
+    The two Motor_control_task objects still own their encoder, controller
+    and motor driver, so the rest of main.py uses them as before.
+    
+    Statistics are kept per axis in stats, a preallocated array with
+    STATS entries per axis: control cycles, largest error [ticks] and
+    cycles with the actuation saturated.
+    
+    EX:
+    
+    @code
+    pair = AxisPair(motor_1_task, motor_2_task)
+    cotask.task_list.append(cotask.Task(pair.run, name = 'Motors',
+        priority = 3, period = 8, profile = True))
+    @endcode
+    '''
+    ## Number of statistics per axis
+    STATS = 3
+    
+    def __init__(self, task_0, task_1):
+        '''
+        Creates an axis pair from the motor tasks of joint 0 and joint 1.
+        @param task_0 The Motor_control_task of joint 0
+        @param task_1 The Motor_control_task of joint 1
+        '''
+        ## Motor task of joint 0
+        self.task_0 = task_0
+        ## Motor task of joint 1
+        self.task_1 = task_1
+        ## Encoder AxisGroup latching both encoders
+        self.group = encoder.AxisGroup(task_0.encoder, task_1.encoder)
+        ## Per axis statistics, STATS entries for each axis
+        self.stats = array.array('i', [0]*(2*self.STATS))
+        ## ArrivalSignal checked after every control cycle, if any
+        self.arrival = None
+        ## telemetry.Telemetry sampled after every control cycle, if any
+        self.telemetry = None
+
+
+    def set_arrival(self, arrival):
+        '''
+        Makes the pair check an ArrivalSignal after every control cycle.
+        @param arrival The ArrivalSignal
+        '''
+        self.arrival = arrival
+
+
+    def set_telemetry(self, telemetry):
+        '''
+        Makes the pair sample a telemetry stream after every control cycle
+        instead of printing the positions.
+        @param telemetry The telemetry.Telemetry
+        '''
+        self.telemetry = telemetry
+
+
+    def reset_stats(self):
+        '''
+        Clears the per axis statistics.
+        '''
+        for i in range(len(self.stats)):
+            self.stats[i] = 0
+
+
+    def _record(self, axis, task):
+        '''
+        Adds one control cycle of a task to the statistics of an axis.
+        @param axis The axis number, 0 or 1
+        @param task The Motor_control_task of the axis
+        '''
+        i = axis*self.STATS
+        self.stats[i] += 1
+        error = task.control.error
+        if error < 0:
+            error = -error
+        if error > self.stats[i + 1]:
+            self.stats[i + 1] = int(error)
+        if task.actuation >= 100 or task.actuation <= -100:
+            self.stats[i + 2] += 1
+
+
+    def run(self):
+        '''
+        Control task function for both joints. Every run latches both
+        encoders, updates both positions first so the gain scheduling sees
+        the current position of the other joint, then runs both control
+        loops with the latch time.
+        '''
+        n = 0
+        snapshot = self.group.snapshot
+        while True:
+            self.group.read()
+            t = snapshot[2]
+            self.task_0.position = snapshot[0]
+            self.task_1.position = snapshot[1]
+            self.task_0.step(t)
+            self.task_1.step(t)
+            self._record(0, self.task_0)
+            self._record(1, self.task_1)
+            # Waking the command task if both axes are at its target
+            if self.arrival is not None:
+                self.arrival.check()
             
+            if self.telemetry is not None:
+                self.telemetry.sample()
+            elif n == 500:
+                print('0',str(self.task_0.position),
+                      str(self.task_0.control.setpoint))
+                print('1',str(self.task_1.position),
+                      str(self.task_1.control.setpoint))
+                n = 0
+            n += 1
             
-                
-                
-            
-            
\ No newline at end of file
+            yield(0)
+
+
+    def __repr__(self):
+        '''
+        @return The per axis statistics as a table
+        '''
+        rst = 'Axis  Cycles  Max error  Saturated\n'
+        for axis in range(2):
+            i = axis*self.STATS
+            rst += '{:4d}{:8d}{:11d}{:11d}\n'.format(axis, self.stats[i],
+                   self.stats[i + 1], self.stats[i + 2])
+        return rst
+
+
+class ArrivalSignal:
+    '''
+    Class which checks when both axes have arrived at a target and tells a
+    task, so the task can wait with period=None instead of polling.
+    
+    Arrival combines three criteria: both axes within tolerance of the
+    target, both moving slower than max_velocity (if it is set), and both
+    for at least dwell control updates in a row. The motor control task
+    calls check() after every control update to count the updates at the
+    target. The command task sets the target with arrived(), which also
+    tells it whether the axes are there, and can wait() for the arrival,
+    in which case check() calls go() on it once they are.
+    
+    The criteria come in named profiles, one per kind of move, so pen up
+    travel can be looser than drawing. use() selects the profile.
+    
+    eta_us() predicts the time to arrival from the distance to go and the
+    speed of both axes. A task waiting with a lead time is also woken once
+    the predicted arrival is within that lead, so it can start something
+    (such as a pen move) before the axes get there.
+    
+    With an encoder AxisGroup both positions come from the same latch.
+    
+    EX:
+    
+    @code
+    arrival = ArrivalSignal(motor_1_task, motor_2_task, 20, group = axes)
+    arrival.set_profile('travel', 60, None, 1)
+    arrival.set_task(command_task)
+    pair.set_arrival(arrival)
+    arrival.use('travel')
+    if not arrival.arrived(900, 100):
+        arrival.wait()
+    @endcode
+    '''
+    def __init__(self, task_0, task_1, tolerance, max_velocity=None,
+                 group=None, dwell=1):
+        '''
+        Creates an arrival signal for the motor tasks of both joints. The
+        criteria given are those of the 'default' profile, which is used
+        until another one is selected.
+        @param task_0 The Motor_control_task of joint 0
+        @param task_1 The Motor_control_task of joint 1
+        @param tolerance Largest distance from the target on each axis
+        [ticks]
+        @param max_velocity Largest speed of each axis at arrival [ticks/s],
+        None to not check the speed
+        @param group The encoder AxisGroup of both encoders, if any
+        @param dwell Control updates in a row the axes must be at the target
+        '''
+        ## Motor task of joint 0
+        self.task_0 = task_0
+        ## Motor task of joint 1
+        self.task_1 = task_1
+        ## Largest distance from the target on each axis [ticks]
+        self.tolerance = tolerance
+        ## Largest speed of each axis at arrival [ticks/s], None for any
+        self.max_velocity = max_velocity
+        ## Control updates in a row the axes must be at the target
+        self.dwell = dwell
+        ## Encoder AxisGroup the positions are read from, if any
+        self.group = group
+        ## Arrival profiles, name to (tolerance, max_velocity, dwell)
+        self.profiles = {'default': (tolerance, max_velocity, dwell)}
+        ## Name of the profile in use
+        self.profile = 'default'
+        ## Target of both axes [ticks]
+        self.target = array.array('i', [0, 0])
+        ## Control updates in a row the axes have been at the target
+        self.settled = 0
+        ## True while the task waits for the axes to arrive
+        self.armed = False
+        ## Wake the task this long before the predicted arrival [us], 0 not
+        ## to wake it before arrival
+        self.lead_us = 0
+        ## The cotask.Task woken on arrival
+        self.task = None
+        ## Number of arrivals signalled
+        self.count = 0
+        ## SetpointFIFO advanced after every check, if any
+        self.fifo = None
+
+
+    def set_profile(self, name, tolerance, max_velocity=None, dwell=1):
+        '''
+        Adds or changes an arrival profile. If it is the one in use the new
+        criteria apply right away.
+        @param name The name of the profile, such as 'travel'
+        @param tolerance Largest distance from the target [ticks]
+        @param max_velocity Largest speed at arrival [ticks/s], None for any
+        @param dwell Control updates in a row at the target
+        '''
+        self.profiles[name] = (tolerance, max_velocity, dwell)
+        if name == self.profile:
+            self.profile = None
+            self.use(name)
+
+
+    def use(self, name):
+        '''
+        Selects the arrival profile for the next moves. Unknown names keep
+        the profile in use. The dwell at the target starts again from the
+        latest reading, checked with the new criteria.
+        @param name The name of the profile
+        '''
+        if name != self.profile and name in self.profiles:
+            self.tolerance, self.max_velocity, self.dwell = \
+                self.profiles[name]
+            self.profile = name
+            self.settled = 1 if self.at(self.target[0], self.target[1]) \
+                else 0
+
+
+    def set_task(self, task):
+        '''
+        @param task The cotask.Task to wake with go() on arrival
+        '''
+        self.task = task
+
+
+    def set_fifo(self, fifo):
+        '''
+        @param fifo The SetpointFIFO to take the next target from on arrival
+        '''
+        self.fifo = fifo
+
+
+    def at(self, ticks_1, ticks_2, ahead_us=0):
+        '''
+        Checks if both axes are at a point in the latest reading, without
+        the dwell. With ahead_us, both axes must also still be within
+        tolerance ahead_us later if they keep their speed.
+        @param ticks_1 Position of joint 0 [ticks]
+        @param ticks_2 Position of joint 1 [ticks]
+        @param ahead_us Time to look ahead [us]
+        @return True if both axes are within tolerance (and slow enough)
+        '''
+        if self.group is not None:
+            position_1 = self.group.snapshot[0]
+            position_2 = self.group.snapshot[1]
+        else:
+            position_1 = self.task_0.position
+            position_2 = self.task_1.position
+        tolerance = self.tolerance
+        if not (ticks_1-tolerance < position_1 < ticks_1+tolerance
+                and ticks_2-tolerance < position_2 < ticks_2+tolerance):
+            return False
+        if self.max_velocity is not None:
+            limit = self.max_velocity
+            if not (-limit <= self.task_0.encoder.velocity <= limit
+                    and -limit <= self.task_1.encoder.velocity <= limit):
+                return False
+        if ahead_us:
+            position_1 += self.task_0.encoder.velocity*ahead_us//1000000
+            position_2 += self.task_1.encoder.velocity*ahead_us//1000000
+            if not (ticks_1-tolerance < position_1 < ticks_1+tolerance
+                    and ticks_2-tolerance < position_2 < ticks_2+tolerance):
+                return False
+        return True
+
+
+    def _eta(self, error, velocity):
+        '''
+        Predicts the time until one axis is within tolerance.
+        @param error Distance to go, target minus position [ticks]
+        @param velocity Speed of the axis [ticks/s]
+        @return Time [us], 0 if within tolerance, -1 if not moving closer
+        '''
+        if error < 0:
+            error = -error
+            velocity = -velocity
+        error -= self.tolerance
+        if error <= 0:
+            return 0
+        if velocity <= 0:
+            return -1
+        return error*1000000//velocity
+
+
+    def eta_us(self, ticks_1, ticks_2):
+        '''
+        Predicts the time until both axes are within tolerance of a point
+        if they keep their speed.
+        @param ticks_1 Target of joint 0 [ticks]
+        @param ticks_2 Target of joint 1 [ticks]
+        @return Time [us], -1 if an axis outside the tolerance is not moving
+        closer
+        '''
+        if self.group is not None:
+            position_1 = self.group.snapshot[0]
+            position_2 = self.group.snapshot[1]
+        else:
+            position_1 = self.task_0.position
+            position_2 = self.task_1.position
+        eta_1 = self._eta(ticks_1 - position_1, self.task_0.encoder.velocity)
+        eta_2 = self._eta(ticks_2 - position_2, self.task_1.encoder.velocity)
+        if eta_1 < 0 or eta_2 < 0:
+            return -1
+        return eta_1 if eta_1 > eta_2 else eta_2
+
+
+    def arrived(self, ticks_1, ticks_2):
+        '''
+        Sets the target and checks if both axes have arrived at it. A new
+        target starts its dwell from the latest reading.
+        @param ticks_1 Target of joint 0 [ticks]
+        @param ticks_2 Target of joint 1 [ticks]
+        @return True if the axes meet the criteria of the profile in use
+        '''
+        if ticks_1 != self.target[0] or ticks_2 != self.target[1]:
+            self.target[0] = ticks_1
+            self.target[1] = ticks_2
+            self.settled = 1 if self.at(ticks_1, ticks_2) else 0
+        return self.settled >= self.dwell
+
+
+    def wait(self, lead_us=0):
+        '''
+        Makes check() wake the task once the axes arrive at the target, and
+        also once the predicted arrival is within lead_us.
+        @param lead_us Lead time [us], 0 to only wake on arrival
+        '''
+        self.armed = True
+        self.lead_us = lead_us
+
+
+    def arm(self, ticks_1, ticks_2, lead_us=0):
+        '''
+        Sets the target and waits for the axes to arrive at it.
+        @param ticks_1 Target of joint 0 [ticks]
+        @param ticks_2 Target of joint 1 [ticks]
+        @param lead_us Lead time [us], 0 to only wake on arrival
+        '''
+        self.arrived(ticks_1, ticks_2)
+        self.wait(lead_us)
+
+
+    def disarm(self):
+        '''
+        Stops waiting without waking the task.
+        '''
+        self.armed = False
+
+
+    def check(self):
+        '''
+        Counts the control updates at the target and wakes the waiting task
+        once the axes have arrived. Called by the motor control task after
+        every control update.
+        '''
+        if self.at(self.target[0], self.target[1]):
+            if self.settled < self.dwell:
+                self.settled += 1
+        else:
+            self.settled = 0
+        if self.fifo is not None:
+            self.fifo.advance()
+        if not self.armed:
+            return
+        if self.settled >= self.dwell:
+            self.armed = False
+            self.lead_us = 0
+            self.count += 1
+            if self.task is not None:
+                self.task.go()
+        elif self.lead_us:
+            # Waking the task once, the lead time before arrival
+            eta = self.eta_us(self.target[0], self.target[1])
+            if 0 <= eta <= self.lead_us:
+                self.lead_us = 0
+                if self.task is not None:
+                    self.task.go()
+
+
+class SetpointFIFO:
+    '''
+    Class which queues the points of a stroke for the motor tasks, so the
+    command task can decode points ahead of the axes instead of handing
+    them over one at a time. The tick pairs go into a task_share.Queue of
+    depth pairs. Once the axes arrive at a point (by the ArrivalSignal, which
+    calls advance() after every control update) the next pair is taken
+    from the queue and set as the setpoints and the arrival target.
+    
+    The command task fills the queue up to the high watermark and waits.
+    It is woken when the queue drains to the low watermark, and when the
+    last point of the stroke has been reached. Every time the axes reach a
+    point and the queue is empty before the stroke is closed, the motors
+    stall waiting for the decoder, which is counted in underflows.
+    
+    EX:
+    
+    @code
+    fifo = SetpointFIFO(arrival, depth = 32, high = 32, low = 8)
+    arrival.set_fifo(fifo)
+    fifo.set_task(command_task)
+    fifo.start()
+    while not fifo.full():
+        fifo.put(ticks_1, ticks_2)
+    fifo.wait()
+    @endcode
+    '''
+    def __init__(self, arrival, depth=32, high=None, low=None):
+        '''
+        Creates a setpoint FIFO.
+        @param arrival The ArrivalSignal of both motor tasks
+        @param depth Most points in the queue
+        @param high Points in the queue at which the command task stops
+        decoding, None for depth
+        @param low Points left in the queue at which the command task is
+        woken to decode more, None for a quarter of depth
+        '''
+        ## ArrivalSignal of both motor tasks
+        self.arrival = arrival
+        ## Queue of x, y tick pairs, two items per point
+        self.queue = task_share.Queue('i', 2*depth, thread_protect = False,
+                                      name = 'Setpoints')
+        ## Most points in the queue
+        self.depth = depth
+        ## Points in the queue at which the command task stops decoding
+        self.high = depth if high is None else min(high, depth)
+        ## Points left in the queue at which the command task is woken
+        self.low = depth//4 if low is None else low
+        ## The cotask.Task that fills the queue
+        self.task = None
+        ## True while the points are being taken from the queue
+        self.active = False
+        ## True once the last point of the stroke is in the queue
+        self.closed = False
+        ## True while the command task waits to be woken
+        self.waiting = False
+        ## Times the axes reached a point with the queue empty
+        self.underflows = 0
+        ## Points taken from the queue
+        self.count = 0
+        # True while the queue is empty after an underflow
+        self._starved = False
+
+
+    def set_task(self, task):
+        '''
+        @param task The cotask.Task to wake with go() at the low watermark
+        '''
+        self.task = task
+
+
+    def level(self):
+        '''
+        @return The number of points in the queue
+        '''
+        return self.queue.num_in()//2
+
+
+    def full(self):
+        '''
+        @return True if the queue is at the high watermark
+        '''
+        return self.queue.num_in() >= 2*self.high
+
+
+    def put(self, ticks_1, ticks_2):
+        '''
+        Adds a point to the queue. Check full() first, put() doesn't wait.
+        @param ticks_1 Setpoint of joint 0 [ticks]
+        @param ticks_2 Setpoint of joint 1 [ticks]
+        '''
+        self.queue.put(ticks_1)
+        self.queue.put(ticks_2)
+
+
+    def start(self):
+        '''
+        Starts a stroke. The points are taken from the queue from the next
+        arrival on.
+        '''
+        self.closed = False
+        self._starved = False
+        self.active = True
+
+
+    def close(self):
+        '''
+        Marks the last point of the stroke as put.
+        '''
+        self.closed = True
+
+
+    def done(self):
+        '''
+        @return True once the axes have reached the last point of the stroke
+        '''
+        return not self.active
+
+
+    def wait(self):
+        '''
+        Makes advance() wake the task at the low watermark, or once the
+        stroke is done.
+        '''
+        self.waiting = True
+
+
+    def _wake(self):
+        '''
+        Wakes the waiting task.
+        '''
+        if self.waiting:
+            self.waiting = False
+            if self.task is not None:
+                self.task.go()
+
+
+    def advance(self):
+        '''
+        Takes the next point from the queue once the axes have arrived at
+        the current one. Called by the ArrivalSignal after every check.
+        '''
+        if not self.active:
+            return
+        arrival = self.arrival
+        if arrival.settled < arrival.dwell:
+            return
+        queue = self.queue
+        if queue.any():
+            ticks_1 = queue.get()
+            ticks_2 = queue.get()
+            arrival.task_0.control.set_setpoint(ticks_1)
+            arrival.task_1.control.set_setpoint(ticks_2)
+            arrival.arrived(ticks_1, ticks_2)
+            self.count += 1
+            self._starved = False
+            if not self.closed and queue.num_in() <= 2*self.low:
+                self._wake()
+        elif self.closed:
+            # The last point of the stroke is reached
+            self.active = False
+            self._wake()
+        elif not self._starved:
+            # The axes are waiting for the decoder
+            self._starved = True
+            self.underflows += 1
+            self._wake()
+
+
+    def __repr__(self):
+        '''
+        @return The depth, watermarks and counters of the queue
+        '''
+        return ('Setpoints {:d}/{:d} high {:d} low {:d} points {:d} '
+                'underflows {:d}'.format(self.level(), self.depth, self.high,
+                                         self.low, self.count,
+                                         self.underflows))
@@ -5,7 +5,9 @@ paths in them. It returns a list with the commands and coordinates for relevant
 commands. The more high resolution of the x,y coordinates the better.
 
 There is also a command for writing all the commands to a txt file as well
-as converting the coordinates into units to inches.
+as converting the coordinates into units to inches. An index of the txt
+file is written next to it (drawing.txt gets drawing.idx) for
+jobindex.JobIndex, so the plotter can start the job at any command.
 
 This python file can be run with the system args of the input file, output file
 and the resolution of the hpgl file.
@@ -39,6 +41,7 @@ There may be an error in the coord to ticks function
 
 import sys
 import math
+import struct
 
 def parse_file(file_name, res, state=0, CPR=0, L1=0, L2=0, x_0=0, y_0=0):
     ''' 
@@ -185,20 +188,81 @@ def pair_split(iterable):
         i += 2 
     return list_of_pairs
     
-def output_text(hpgl, file_name):
+def output_text(hpgl, file_name, profiles=None, index=True):
     ''' 
     A function to output to a text file
     @param hpgl A list of commands from parsed_list
     @param file_name The output file name, extension '.txt' file must be included.
+    @param profiles Optional dictionary of arrival profiles for main.py, 
+    name to (tolerance [ticks], speed [ticks/s] or None, dwell), written as
+    AR lines in the header of the file
+    @param index True to write the index of the file next to it, the index
+    file name, or False for none (always none if file_name is a file)
     '''
     if type(file_name) == str:
-        file = open(file_name, 'w')
+        # Newlines kept as they are so the offsets in the index are right
+        file = open(file_name, 'w', newline='\n')
+        if index == True:
+            index = index_name(file_name)
     else:
         file = file_name
+        index = False
+    lines = []
+    # Arrival profiles go first so they apply to every move
+    if profiles:
+        for name in profiles:
+            tolerance, speed, dwell = profiles[name]
+            lines.append(['AR;'+name+';'+str(int(tolerance))+';'
+                          +str(int(speed or 0))+';'+str(int(dwell))])
+    lines += hpgl
     # Write each command to the file with a newline at the end
-    for n in hpgl:
+    for n in lines:
         file.write(str(n)+'\n')
     file.close()
+    if index:
+        output_index(lines, index)
+
+
+def index_name(file_name):
+    '''
+    Makes the name of the index of a job file, like jobindex.index_name.
+    @param file_name The job file name
+    @return The index file name, the job file name with '.idx' for its
+    extension
+    '''
+    dot = file_name.rfind('.')
+    if dot <= file_name.rfind('/'):
+        dot = len(file_name)
+    return file_name[:dot]+'.idx'
+
+
+def output_index(lines, file_name):
+    '''
+    Writes the index of a job file for jobindex.JobIndex. The header is
+    b'JIDX', the length of the job file and the number of lines, and each
+    line of the job file has a record of its offset in the file, the
+    points of the job before it and its command code (the ASCII of its two
+    letters) with the pen state (1 for down) in the high 16 bits, all as
+    little endian uint32. A last record has the length of the job file and
+    all its points.
+    @param lines The lines of the job file, as lists of strings
+    @param file_name The index file name
+    '''
+    records = []
+    offset = 0
+    points = 0
+    for n in lines:
+        command = n[0][:2]
+        code = (ord(command[0]) << 8) | ord(command[1])
+        pen = 1 if command == 'PD' else 0
+        records.append(struct.pack('<III', offset, points, code | pen << 16))
+        offset += len((str(n)+'\n').encode())
+        # The points are the elements after the command
+        points += len(n) - 1
+    records.append(struct.pack('<III', offset, points, 0))
+    with open(file_name, 'wb') as file:
+        file.write(b'JIDX'+struct.pack('<II', offset, len(records) - 1))
+        file.write(b''.join(records))
     
 def coord_to_ticks(coords,CPR,L1,L2,x_0,y_0,pre_tick, pre_angle):
     '''
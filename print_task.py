@@ -8,6 +8,13 @@
 #  the printing between characters, even when all the tasks are being 
 #  cooperatively scheduled with a priority-based scheduler. 
 #
+#  With @c CHUNKED set, the characters are kept in a @c task_share.ByteRing
+#  instead and each run of the task sends as many of them as the USB VCP
+#  will take without blocking, up to @c BYTES_PER_RUN bytes and 
+#  @c US_PER_RUN of time, so a status line goes out in one run instead of
+#  one run per character. Characters which don't fit in the buffer are
+#  dropped and counted in either mode.
+#
 #    Example code:
 #    @code
 #    # In each module which needs to print something:
@@ -27,6 +34,7 @@
 #  GNU Public License, version 3.0. 
 
 import pyb
+import utime
 import cotask
 import task_share
 
@@ -41,6 +49,17 @@ THREAD_PROTECT = True
 ## A flag which controls if the printing task is to be profiled
 PROFILE = True
 
+## A flag which makes the print task send chunks from a 
+#  @c task_share.ByteRing rather
+#  than one character per run from a @c task_share.Queue
+CHUNKED = True
+
+## The most bytes sent in one run of the chunked print task
+BYTES_PER_RUN = const (64)
+
+## The most time spent sending in one run of the chunked print task [us]
+US_PER_RUN = const (500)
+
 
 #@micropython.native
 def put (a_string):
@@ -53,10 +72,22 @@ def put (a_string):
     as soon as the print task is run by the task scheduler. 
     @param a_string A string to be put into the queue """
 
+    global dropped
+
+    if print_ring is not None:
+        data = a_string.encode ()
+        count = print_ring.put (data)
+        dropped += len (data) - count
+        if count:
+            print_task.go ()
+        return
+
     for a_ch in a_string:
         if not print_queue.full ():
             print_queue.put (ord (a_ch))
             print_task.go ()
+        else:
+            dropped += 1
 
 
 #@micropython.native
@@ -67,10 +98,21 @@ def put_bytes (b_arr):
     task is run by the task scheduler. 
     @param b_arr The bytearray whose contents go into the queue """
 
+    global dropped
+
+    if print_ring is not None:
+        count = print_ring.put (b_arr)
+        dropped += len (b_arr) - count
+        if count:
+            print_task.go ()
+        return
+
     for byte in b_arr:
         if not print_queue.full ():
             print_queue.put (byte)
             print_task.go ()
+        else:
+            dropped += 1
 
 
 def run ():
@@ -83,10 +125,13 @@ def run ():
     the higher priority tasks don't need to run. 
     """
 
+    global written
+
     while True:
         # If there's a character in the queue, print it
         if print_queue.any ():
             print (chr (print_queue.get ()), end = '')
+            written += 1
 
         # If there's another character, tell this task to run again ASAP
         if print_queue.any ():
@@ -95,16 +140,83 @@ def run ():
         yield (0)
 
 
+def run_chunked ():
+    """ Run function for the chunked print task. Each run sends bytes from
+    the ring to the USB VCP with a zero timeout, so it never waits for the
+    host, until the VCP is full, the ring is empty, or the byte or time 
+    budget of the run is used up. If bytes are left the task runs again as
+    soon as the higher priority tasks let it. """
+
+    global written
+
+    vcp = pyb.USB_VCP ()
+    while True:
+        start = utime.ticks_us ()
+        budget = BYTES_PER_RUN
+        while budget > 0 and print_ring.any ():
+            sent = vcp.send (print_ring.peek (budget), timeout = 0)
+            if not sent:
+                # The VCP is full, so try again on the next run
+                break
+            print_ring.consume (sent)
+            written += sent
+            budget -= sent
+            if utime.ticks_diff (utime.ticks_us (), start) >= US_PER_RUN:
+                break
+
+        if print_ring.any ():
+            print_task.go ()
+
+        yield (0)
+
+
+def make_task (chunked = CHUNKED):
+    """ Create the buffer and the print task and add the task to the system
+    task list. This is done when the module is imported. 
+    @param chunked @c True for the chunked print task with a 
+        @c task_share.ByteRing, 
+        @c False for one character per run from a @c task_share.Queue """
+
+    global print_queue, print_ring, print_task, written, dropped
+
+    if chunked:
+        print_queue = None
+        print_ring = task_share.ByteRing (BUF_SIZE)
+        print_task = cotask.Task (run_chunked, name = 'Printing', 
+                                  priority = 0, profile = PROFILE)
+    else:
+        print_ring = None
+        print_queue = task_share.Queue ('B', BUF_SIZE, name = "Print_Queue",
+                                thread_protect = THREAD_PROTECT, 
+                                overwrite = False)
+        print_task = cotask.Task (run, name = 'Printing', priority = 0, 
+                                  profile = PROFILE)
+
+    # Counts of characters printed and characters lost
+    written = 0
+    dropped = 0
+
+    # This line tells the task scheduler to add this task to the system task 
+    # list
+    cotask.task_list.append (print_task)
+    return print_task
+
+
 ## This queue holds characters to be printed when the print task gets around
-#  to it.
-global print_queue
-print_queue = task_share.Queue ('B', BUF_SIZE, name = "Print_Queue", 
-                        thread_protect = THREAD_PROTECT, overwrite = False)
+#  to it, if the print task is not chunked.
+print_queue = None
+
+## This ring holds characters to be printed when the print task gets around
+#  to it, if the print task is chunked.
+print_ring = None
 
 ## This is the task which schedules printing. 
-global print_task
-print_task = cotask.Task (run, name = 'Printing', priority = 0, 
-                          profile = PROFILE)
+print_task = None
+
+## The number of characters printed
+written = 0
+
+## The number of characters lost because the buffer was full
+dropped = 0
 
-# This line tells the task scheduler to add this task to the system task list
-cotask.task_list.append (print_task)
+make_task ()
@@ -0,0 +1,582 @@
+'''
+@file serial_capture.py
+@authors Sam Lee and Dima Kyle
+Serial capture file for the host computer. It reads one or more serial
+ports at once with asyncio and stores what the boards send as chunked NumPy
+column files, in place of the blocking readlines() of response.py.
+
+Each port is read in one of two modes:
+- frames: the COBS framed binary records of telemetry.py, decoded with
+  telemetry.decode_numpy
+- lines: text lines of numbers, such as the time, position lines printed by
+  the step response tests. The first columns numbers of a line are kept and
+  lines with fewer are dropped.
+
+Records are copied into a preallocated chunk of chunk_rows rows. A full
+chunk is saved as one structured .npy file (one column per field) by a
+worker thread while the next chunk fills, and only the newest keep files
+are kept, so the memory and disk used stay bounded however long it runs.
+A board that resets or is unplugged is reopened when it comes back, with
+the partial frame or line it was sending dropped.
+
+@code
+python serial_capture.py /dev/ttyACM0=frames /dev/ttyACM1=lines -o runs
+python serial_capture.py --loopback 10
+@endcode
+
+The chunks of a port are loaded back in order with load():
+
+@code
+data = serial_capture.load('runs/ttyACM0')
+pyplot.plot(data['t_us'], data['position_0'])
+@endcode
+
+--loopback checks the capture against a pseudo terminal standing in for a
+board: telemetry frames are written to it as fast as it takes them, with a
+simulated reset half way, and the stored records are checked for gaps.
+'''
+
+import os
+import re
+import sys
+import glob
+import time
+import asyncio
+import argparse
+import numpy
+import serial
+
+import telemetry
+
+## Modes a port can be read in
+MODES = ('frames', 'lines')
+## Bytes read from a port at a time
+READ_SIZE = 65536
+## Longest partial line kept between reads [bytes]
+MAX_LINE = 4096
+
+# A number in a text line, with its sign and fraction
+_NUMBER = re.compile(rb'-?\d+(?:\.\d*)?')
+
+
+class FrameParser:
+    '''
+    Decodes telemetry frames from the bytes of a port as they arrive. A
+    frame cut in two by a read is kept until the rest of it comes.
+    '''
+    def __init__(self):
+        ## Structured type of the records
+        self.dtype = telemetry.dtype()
+        ## Frames that failed their length, COBS or CRC check
+        self.bad = 0
+        # Bytes after the last delimiter
+        self._rest = b''
+
+
+    def feed(self, data):
+        '''
+        @param data The bytes read
+        @return Structured array of the records completed by data
+        '''
+        if self._rest:
+            data = self._rest + data
+        records, bad, self._rest = telemetry.decode_numpy(data)
+        self.bad += bad
+        if len(self._rest) > telemetry.FRAME_SIZE:
+            # No frame is this long, so it's noise
+            self.bad += 1
+            self._rest = b''
+        return records
+
+
+    def reset(self):
+        '''
+        Drops the partial frame, for when the port was reopened.
+        '''
+        self._rest = b''
+
+
+class LineParser:
+    '''
+    Parses text lines of numbers from the bytes of a port as they arrive.
+    Anything around the numbers (such as the b'...' of printed bytes) is
+    ignored.
+    '''
+    def __init__(self, columns=2, names=None):
+        '''
+        @param columns Numbers kept from each line
+        @param names Names of the columns, col_0, col_1, ... by default
+        '''
+        if names is None:
+            names = ['col_{:d}'.format(n) for n in range(columns)]
+        ## Structured type of the rows
+        self.dtype = numpy.dtype([(name, '<f8') for name in names])
+        ## Lines dropped for having too few numbers
+        self.bad = 0
+        # Number of columns
+        self._columns = len(names)
+        # Bytes after the last newline
+        self._rest = b''
+
+
+    def feed(self, data):
+        '''
+        @param data The bytes read
+        @return Structured array of the rows completed by data
+        '''
+        lines = (self._rest + data).split(b'\n')
+        self._rest = lines.pop()
+        if len(self._rest) > MAX_LINE:
+            self.bad += 1
+            self._rest = b''
+        columns = self._columns
+        values = []
+        for line in lines:
+            numbers = _NUMBER.findall(line)
+            if len(numbers) < columns:
+                if line.strip():
+                    self.bad += 1
+                continue
+            values.extend(numbers[:columns])
+        rows = numpy.array(values, dtype=float).reshape(-1, columns)
+        return numpy.ascontiguousarray(rows).view(self.dtype).ravel()
+
+
+    def reset(self):
+        '''
+        Drops the partial line, for when the port was reopened.
+        '''
+        self._rest = b''
+
+
+class ChunkWriter:
+    '''
+    Keeps records in a preallocated chunk and saves every full chunk as
+    prefix_NNNNNN.npy in a directory from a worker thread. There are two
+    chunks, so one fills while the other is saved.
+    '''
+    def __init__(self, directory, prefix, dtype, chunk_rows=65536,
+                 keep=None):
+        '''
+        @param directory Directory of the chunk files, made if missing
+        @param prefix Start of the chunk file names
+        @param dtype Structured type of the records
+        @param chunk_rows Records per chunk file
+        @param keep Number of newest chunk files kept, all of them if None
+        '''
+        os.makedirs(directory, exist_ok=True)
+        ## Directory of the chunk files
+        self.directory = directory
+        ## Start of the chunk file names
+        self.prefix = prefix
+        ## Number of newest chunk files kept
+        self.keep = keep
+        ## Records stored
+        self.rows = 0
+        ## Chunk files saved
+        self.files = 0
+        # The chunk filling and the one being saved
+        self._chunk = numpy.empty(chunk_rows, dtype)
+        self._spare = numpy.empty(chunk_rows, dtype)
+        # Rows of the chunk filled
+        self._fill = 0
+        # Save of the spare chunk in progress
+        self._saving = None
+        # Numbers of the chunk files on disk, carried on from an old run
+        self._numbers = sorted(int(name[len(prefix) + 1:-4]) for name in
+                               os.listdir(directory)
+                               if re.fullmatch(re.escape(prefix)
+                                               + r'_\d{6}\.npy', name))
+        self._next = self._numbers[-1] + 1 if self._numbers else 0
+
+
+    async def append(self, records):
+        '''
+        Copies records into the chunk, saving it each time it is full.
+        @param records Structured array of records
+        '''
+        done = 0
+        while done < len(records):
+            count = min(len(records) - done, len(self._chunk) - self._fill)
+            self._chunk[self._fill:self._fill + count] = \
+                records[done:done + count]
+            self._fill += count
+            done += count
+            if self._fill == len(self._chunk):
+                await self.flush()
+        self.rows += len(records)
+
+
+    async def flush(self):
+        '''
+        Starts saving the rows of the chunk and swaps to the spare, after
+        the last save has finished.
+        '''
+        if self._saving is not None:
+            await self._saving
+            self._saving = None
+        if self._fill == 0:
+            return
+        rows = self._chunk[:self._fill]
+        self._chunk, self._spare = self._spare, self._chunk
+        self._fill = 0
+        self._saving = asyncio.get_running_loop().run_in_executor(
+            None, self._save, rows, self._next)
+        self._next += 1
+
+
+    async def close(self):
+        '''
+        Saves the rows left and waits for the save.
+        '''
+        await self.flush()
+        if self._saving is not None:
+            await self._saving
+            self._saving = None
+
+
+    def _save(self, rows, number):
+        '''
+        Saves a chunk file, through a temporary name so a reader never sees
+        half of one, and deletes the oldest files past keep. Runs in a
+        worker thread.
+        @param rows The rows to save
+        @param number Number of the chunk file
+        '''
+        name = os.path.join(self.directory,
+                            '{:s}_{:06d}.npy'.format(self.prefix, number))
+        with open(name + '.tmp', 'wb') as file:
+            numpy.save(file, rows)
+        os.replace(name + '.tmp', name)
+        self._numbers.append(number)
+        self.files += 1
+        while self.keep is not None and len(self._numbers) > self.keep:
+            old = self._numbers.pop(0)
+            os.remove(os.path.join(self.directory, '{:s}_{:06d}.npy'.format(
+                self.prefix, old)))
+
+
+class PortCapture:
+    '''
+    Reads one serial port into a ChunkWriter, reopening it whenever the
+    board resets or is unplugged.
+    '''
+    def __init__(self, port, mode, directory, baudrate=115200,
+                 chunk_rows=65536, keep=None, wake=None, columns=2,
+                 retry_s=0.5):
+        '''
+        @param port Name of the serial port
+        @param mode 'frames' or 'lines'
+        @param directory Directory of the chunk files
+        @param baudrate Baud rate, which doesn't matter for the USB VCP
+        @param chunk_rows Records per chunk file
+        @param keep Number of newest chunk files kept, all of them if None
+        @param wake Bytes written each time the port is opened, such as
+        b'\\r' to start a test
+        @param columns Numbers kept from each line in lines mode
+        @param retry_s Time between attempts to reopen the port [s]
+        '''
+        if mode not in MODES:
+            raise ValueError('mode must be one of ' + ', '.join(MODES))
+        ## Name of the serial port
+        self.port = port
+        ## Baud rate
+        self.baudrate = baudrate
+        ## Bytes written each time the port is opened
+        self.wake = wake
+        ## Time between attempts to reopen the port [s]
+        self.retry_s = retry_s
+        ## The FrameParser or LineParser
+        self.parser = FrameParser() if mode == 'frames' else \
+            LineParser(columns)
+        name = os.path.basename(port)
+        ## The ChunkWriter of the records
+        self.writer = ChunkWriter(directory, name, self.parser.dtype,
+                                  chunk_rows, keep)
+        ## Bytes read
+        self.bytes = 0
+        ## Times the port was opened
+        self.opens = 0
+        ## Time of the last byte read [s], from time.monotonic
+        self.last_read = None
+
+
+    async def run(self):
+        '''
+        Captures until cancelled, then saves the rows left.
+        '''
+        try:
+            while True:
+                link = await self._open()
+                try:
+                    await self._read(link)
+                except (serial.SerialException, OSError):
+                    # The board reset or was unplugged
+                    pass
+                finally:
+                    link.close()
+                self.parser.reset()
+                await asyncio.sleep(self.retry_s)
+        finally:
+            await asyncio.shield(self.writer.close())
+
+
+    async def _open(self):
+        '''
+        Opens the port, trying again until it is there.
+        @return The open serial.Serial
+        '''
+        while True:
+            try:
+                link = serial.Serial(self.port, self.baudrate, timeout=0)
+            except (serial.SerialException, OSError):
+                await asyncio.sleep(self.retry_s)
+                continue
+            self.opens += 1
+            if self.wake:
+                link.write(self.wake)
+            return link
+
+
+    async def _read(self, link):
+        '''
+        Reads the port whenever it has bytes, until it fails.
+        @param link The open serial.Serial
+        '''
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        loop.add_reader(link.fileno(), readable.set)
+        try:
+            while True:
+                await readable.wait()
+                readable.clear()
+                # Raises SerialException if the device has gone
+                data = link.read(READ_SIZE)
+                if not data:
+                    continue
+                self.bytes += len(data)
+                self.last_read = time.monotonic()
+                records = self.parser.feed(data)
+                if len(records):
+                    await self.writer.append(records)
+        finally:
+            loop.remove_reader(link.fileno())
+
+
+    def __repr__(self):
+        '''
+        @return The bytes, records and bad frames or lines of the port
+        '''
+        return '{:s}: {:d} bytes, {:d} records, {:d} bad, {:d} files, ' \
+            'opened {:d} times'.format(self.port, self.bytes,
+                                       self.writer.rows, self.parser.bad,
+                                       self.writer.files, self.opens)
+
+
+async def capture(captures, seconds=None, idle_s=None, report_s=None):
+    '''
+    Runs port captures together.
+    @param captures The PortCaptures
+    @param seconds Time to capture for [s], until cancelled if None
+    @param idle_s Stop when no port has sent anything for this long [s],
+    never if None
+    @param report_s Time between printed reports of the captures [s]
+    '''
+    tasks = [asyncio.ensure_future(port.run()) for port in captures]
+    start = time.monotonic()
+    try:
+        while True:
+            await asyncio.sleep(min(s for s in (seconds, idle_s, report_s,
+                                                0.1) if s))
+            now = time.monotonic()
+            if report_s and now - start >= report_s:
+                for port in captures:
+                    print(port)
+            if seconds is not None and now - start >= seconds:
+                break
+            last = max([start] + [port.last_read for port in captures
+                                  if port.last_read])
+            if idle_s is not None and now - last >= idle_s:
+                break
+            for task in tasks:
+                if task.done():
+                    # A capture failed, so its exception is raised
+                    task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def load(directory):
+    '''
+    Loads the chunk files of a port in order.
+    @param directory Directory of the chunk files
+    @return One structured array of all their records
+    '''
+    names = sorted(glob.glob(os.path.join(directory, '*_[0-9]*.npy')))
+    if not names:
+        raise FileNotFoundError('No chunk files in ' + directory)
+    return numpy.concatenate([numpy.load(name) for name in names])
+
+
+def record(port, seconds=None, idle_s=5, mode='lines', columns=2,
+           wake=b'\r', directory=None):
+    '''
+    Captures from one port until it goes quiet and loads what was sent, the
+    way response.py used readlines().
+    @param port Name of the serial port
+    @param seconds Longest time to capture for [s]
+    @param idle_s Stop after this long without data [s]
+    @param mode 'frames' or 'lines'
+    @param columns Numbers kept from each line in lines mode
+    @param wake Bytes written when the port is opened
+    @param directory Directory for the chunk files, a temporary one if None
+    @return Structured array of the records
+    '''
+    import tempfile
+    with tempfile.TemporaryDirectory() as temp:
+        directory = directory or temp
+        port = PortCapture(port, mode, directory, wake=wake, columns=columns)
+        asyncio.run(capture([port], seconds, idle_s))
+        if not port.writer.rows:
+            return numpy.empty(0, port.parser.dtype)
+        return load(directory)
+
+
+def _loopback_frames(count):
+    '''
+    Makes telemetry frames with sequence numbers 0 to count - 1 (wrapping),
+    encoded by telemetry.Telemetry.
+    @param count Number of frames
+    @return The frames, one after another
+    '''
+    import types
+    axis = types.SimpleNamespace(position=0, actuation=0,
+                                 control=types.SimpleNamespace(setpoint=0))
+    stream = telemetry.Telemetry(axis, axis, ring_size=(count + 1)
+                                 * telemetry.FRAME_SIZE)
+    for n in range(count):
+        axis.position = n
+        axis.control.setpoint = -n
+        stream.sample()
+    return bytes(stream.ring.peek(stream.ring.num_in()))
+
+
+def loopback(seconds=10, chunk_rows=65536):
+    '''
+    Checks the capture of telemetry frames against a pseudo terminal: a
+    thread writes frames to it as fast as the capture takes them, with a
+    simulated reset (the terminal is closed and a new one opened under the
+    same name) half way. Every frame written must be stored, in order.
+    @param seconds Time to write for [s]
+    @param chunk_rows Records per chunk file
+    @return The rate the frames were captured at [bytes/s]
+    '''
+    import pty
+    import tty
+    import tempfile
+    import threading
+    if 'utime' not in sys.modules:
+        # telemetry.Telemetry needs a clock to make the frames
+        import simulator
+        simulator.install()
+    # Frames of one whole turn of the sequence number
+    block = _loopback_frames(0x10000)
+    written = [0]
+
+    def board(link_name):
+        '''
+        Writes frames to a pseudo terminal linked from link_name.
+        '''
+        end = time.monotonic() + seconds
+        for half in range(2):
+            master, slave = pty.openpty()
+            tty.setraw(slave)
+            os.symlink(os.ttyname(slave), link_name + '.new')
+            os.replace(link_name + '.new', link_name)
+            while port.opens <= half:
+                # Opening a port flushes what is waiting in it
+                time.sleep(0.01)
+            while time.monotonic() < end - (1 - half)*seconds/2:
+                view = memoryview(block)
+                while view:
+                    sent = os.write(master, view)
+                    written[0] += sent
+                    view = view[sent:]
+            # Let the capture read everything before the reset
+            time.sleep(0.5)
+            os.close(master)
+            os.close(slave)
+
+    with tempfile.TemporaryDirectory() as temp:
+        link_name = os.path.join(temp, 'ttyLOOP')
+        port = PortCapture(link_name, 'frames', os.path.join(temp, 'out'),
+                           chunk_rows=chunk_rows, retry_s=0.05)
+        writer = threading.Thread(target=board, args=(link_name,))
+        writer.start()
+        asyncio.run(capture([port], seconds + 2))
+        writer.join()
+        data = load(os.path.join(temp, 'out'))
+        print(port)
+        gaps = numpy.count_nonzero(numpy.diff(data['seq'].astype(int))
+                                   % 0x10000 != 1)
+        print('{:d} bytes written, {:d} records stored, {:d} sequence gaps'
+              .format(written[0], len(data), gaps))
+        rate = port.bytes/seconds
+        print('{:.2f} MB/s captured'.format(rate*1e-6))
+        if (port.bytes != written[0] or gaps or port.parser.bad
+                or len(data) != written[0]//telemetry.FRAME_SIZE):
+            raise RuntimeError('Frames were lost')
+        return rate
+
+
+def _port_spec(spec):
+    '''
+    @param spec PORT or PORT=MODE from the command line
+    @return (port, mode)
+    '''
+    port, _, mode = spec.partition('=')
+    return port, mode or 'frames'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Capture serial ports')
+    parser.add_argument('ports', nargs='*', type=_port_spec,
+                        help='PORT or PORT=MODE, where MODE is frames '
+                             '(default) or lines')
+    parser.add_argument('-o', '--out', default='captures',
+                        help='directory of the chunk files, one directory '
+                             'per port')
+    parser.add_argument('--baudrate', type=int, default=115200)
+    parser.add_argument('--chunk', type=int, default=65536,
+                        help='records per chunk file')
+    parser.add_argument('--keep', type=int, default=None,
+                        help='newest chunk files kept per port')
+    parser.add_argument('--columns', type=int, default=2,
+                        help='numbers kept per line in lines mode')
+    parser.add_argument('--wake', action='store_true',
+                        help='write a carriage return when a port opens')
+    parser.add_argument('--seconds', type=float, default=None)
+    parser.add_argument('--report', type=float, default=10,
+                        help='seconds between reports')
+    parser.add_argument('--loopback', type=float, default=None,
+                        metavar='SECONDS',
+                        help='check the capture against a pseudo terminal')
+    args = parser.parse_args()
+    if args.loopback:
+        loopback(args.loopback, args.chunk)
+        sys.exit()
+    if not args.ports:
+        parser.error('no ports given')
+    ports = [PortCapture(port, mode, os.path.join(args.out,
+                                                  os.path.basename(port)),
+                         args.baudrate, args.chunk, args.keep,
+                         b'\r' if args.wake else None, args.columns)
+             for port, mode in args.ports]
+    try:
+        asyncio.run(capture(ports, args.seconds, report_s=args.report))
+    except KeyboardInterrupt:
+        pass
+    for port in ports:
+        print(port)
@@ -6,6 +6,8 @@ of the servo.
 '''
 import pyb
 import math
+import array
+import utime
 
 class Servo:
     """
@@ -18,6 +20,13 @@ class Servo:
     write_us(us)  ==> sets the servo duty cycle
     write_angle(degrees) ==> solves for servo signal in microseconds from 
                              user input angle.
+    move(degrees) ==> starts a move without waiting and returns the time
+                      until the servo is expected to have settled
+    settled() ==> True once the servo is expected to have settled
+    
+    The timer compare value of every whole degree is worked out once when
+    the servo is created, so writing a whole angle is a table lookup, and
+    the timer is only written when the compare value changes.
     
     To Properly initialize an instance of Servo, refer to the example below
     Ex:
@@ -37,12 +46,15 @@ class Servo:
     @param min_us (int): The minimum signal length supported by the servo.
     @param max_us (int): The maximum signal length supported by the servo.
     @param angle (int): The angle between the minimum and maximum positions.
+    @param travel (ServoTravel): Travel time model used by move(), None for
+        the default model.
         
     All of these parameters can be found on the servo's datasheet linked below.
     HS-65MG Servo Datasheet: https://www.servocity.com/hs-65mg-servo     
     """
     
-    def __init__(self, pin, prescaler=4.5, freq=50, min_us=665, max_us=2360, angle=190):
+    def __init__(self, pin, prescaler=4.5, freq=50, min_us=665, max_us=2360, angle=190,
+                 travel=None):
         ## The Timer desired for the servo at a specified frequency
         self.tim = pyb.Timer(2, freq=freq) 
         ## Output pin used to control the servo
@@ -62,7 +74,39 @@ class Servo:
         # electronic counting circuit used to reduce a high frequency
         # electrical signal to a lower frequency 
         self.prescaler = prescaler
-        self.t_freq = 0
+        # solve for period of signal in microseconds
+        self.t_freq = (1/(self.freq+self.prescaler))*10**6
+        ## Timer counts per microsecond of signal
+        self.counts_per_us = (self.tim.period()+1)/self.t_freq
+        ## Timer compare value for every whole degree from 0 to angle
+        self.table = array.array('I', [self.compare(d)
+                                       for d in range(int(angle)+1)])
+        ## The compare value last written, None before the first write
+        self.pulse = None
+        ## The angle last written [degrees], None before the first write
+        self.target = None
+        ## Travel time model used by move()
+        self.travel = travel if travel is not None else ServoTravel()
+        ## Time the servo is expected to have settled from utime.ticks_us()
+        self.done = utime.ticks_us()
+    
+    def compare(self, degrees):
+        '''
+        Solves for the timer compare value of an angle.
+        @param degrees The angle [degrees]
+        @return The compare value [timer counts]
+        '''
+        us = self.min_us + (self.max_us - self.min_us) * degrees / self.angle
+        return int(round(us*self.counts_per_us))
+    
+    def write_compare(self, pulse):
+        '''
+        Writes a compare value to the timer if it is not already there.
+        @param pulse The compare value [timer counts]
+        '''
+        if pulse != self.pulse:
+            self.ch2.pulse_width(pulse)
+            self.pulse = pulse
 
     def write_us(self, us):
         ''' setting the duty cycle for the servo to control its position. 
@@ -73,14 +117,10 @@ class Servo:
         '''
         # print('Signal length: '+str(us)+' microseconds')
         # print('Signal Frequency: '+str(self.freq)+' Hz')
-        # solve for period of signal in seconds
-        self.t_freq = (1/(self.freq+self.prescaler))*10**6
         # print('Signal Period: '+str(t_freq)+' seconds')
-        # solve for duty cycle to determine position of servo
-        duty = 100*us/self.t_freq
-        # print('Servo Duty Cycle: '+str(duty)+' %')
-        # et the percent duty cycle for the servo to control its position
-        self.ch2.pulse_width_percent(duty)
+        # solve for the compare value to determine position of servo
+        # set the compare value for the servo to control its position
+        self.write_compare(int(round(us*self.counts_per_us)))
 
     def write_angle(self, degrees=None, radians=None):
         '''Move to the specified angle in ``degrees`` or ``radians``.
@@ -90,11 +130,53 @@ class Servo:
             degrees = math.degrees(radians)
         # divide input angle by 360 deg with remainder
         degrees = degrees % 360
-        # solve for total range of servo signal length 
-        total_range = self.max_us - self.min_us
-        # solve for signal length in microsec based on user input angle 
-        us = self.min_us + total_range * degrees / self.angle
-        self.write_us(us)
+        self.target = degrees
+        if degrees == int(degrees) and degrees < len(self.table):
+            # Whole angles come from the table
+            self.write_compare(self.table[int(degrees)])
+        else:
+            self.write_compare(self.compare(degrees))
+    
+    def move(self, degrees):
+        '''
+        Starts moving to an angle without waiting for the servo. Asking
+        for the angle it is already moving to changes nothing.
+        @param degrees The angle [degrees]
+        @return Time until the servo is expected to have settled [us]
+        '''
+        now = utime.ticks_us()
+        if degrees != self.target:
+            start = self.target if self.target is not None else degrees
+            self.done = utime.ticks_add(now,
+                                        self.travel.time_us(start, degrees))
+            self.write_angle(degrees)
+        return self.remaining_us(now)
+    
+    def remaining_us(self, now=None):
+        '''
+        @param now The time now from utime.ticks_us(), None to read it
+        @return Time until the servo is expected to have settled [us], 0
+        once it has
+        '''
+        if now is None:
+            now = utime.ticks_us()
+        remaining = utime.ticks_diff(self.done, now)
+        return remaining if remaining > 0 else 0
+    
+    def settled(self):
+        '''
+        @return True once the servo is expected to have settled
+        '''
+        return self.remaining_us() == 0
+    
+    def travel_us(self, degrees):
+        '''
+        @param degrees The angle to move to [degrees]
+        @return Time a move from the angle last written would take [us]
+        '''
+        if self.target is None:
+            return 0
+        return self.travel.time_us(self.target, degrees)
     
     def read_servo(self):
         '''
@@ -105,6 +187,66 @@ class Servo:
         self.conversion = 90/500 #degrees per microsecond conversion
         self.servo_pos  = self.read*self.conversion #convert microseconds to degrees
         return self.servo_pos
+
+
+
+class ServoTravel:
+    '''
+    A travel time model of a servo: a dead time before it starts moving,
+    then a constant slew rate, then a settling margin. The defaults are the
+    HS-65MG datasheet speed (0.11 s/60 deg at 4.8 V); a measured model can
+    be made from timed moves with fit().
+    
+    Ex:
+    @code
+    travel = ServoTravel(deg_per_s=545, dead_ms=20, settle_ms=30)
+    travel.time_us(120, 90)
+    travel = ServoTravel.fit([(30, 85000), (60, 140000), (90, 200000)])
+    @endcode
+    '''
+    
+    def __init__(self, deg_per_s=545, dead_ms=20, settle_ms=30):
+        '''
+        @param deg_per_s The slew rate of the servo [deg/s]
+        @param dead_ms Time before the servo starts to move [ms]
+        @param settle_ms Time for the servo to settle after the slew [ms]
+        '''
+        ## Slew rate [deg/s]
+        self.deg_per_s = deg_per_s
+        ## Fixed time of every move: dead time and settling [us]
+        self.fixed_us = int(1000*(dead_ms + settle_ms))
+        ## Slew time per degree [us/deg]
+        self.us_per_deg = 1000000/deg_per_s
+    
+    def time_us(self, from_angle, to_angle):
+        '''
+        Predicts the time a move takes until the servo has settled.
+        @param from_angle The angle the servo is at [deg]
+        @param to_angle The angle the servo moves to [deg]
+        @return Travel time [us], 0 if the angle doesn't change
+        '''
+        if from_angle == to_angle:
+            return 0
+        return self.fixed_us + int(abs(to_angle - from_angle)*self.us_per_deg)
+    
+    @staticmethod
+    def fit(moves, settle_ms=30):
+        '''
+        Makes a model from measured moves by fitting a straight line of time
+        against travel angle. The intercept is the dead time.
+        @param moves List of (travel angle [deg], measured time [us]) for at
+        least two different angles
+        @param settle_ms Settling margin added to the fitted dead time [ms]
+        @return The fitted ServoTravel
+        '''
+        n = len(moves)
+        mean_a = sum(abs(a) for a, t in moves)/n
+        mean_t = sum(t for a, t in moves)/n
+        s_at = sum((abs(a) - mean_a)*(t - mean_t) for a, t in moves)
+        s_aa = sum((abs(a) - mean_a)**2 for a, t in moves)
+        us_per_deg = s_at/s_aa
+        dead_us = max(0, mean_t - us_per_deg*mean_a)
+        return ServoTravel(1000000/us_per_deg, dead_us/1000, settle_ms)
         
         
 def main():
@@ -0,0 +1,1052 @@
+'''
+@file simulator.py
+@authors Sam Lee and Dima Kyle
+Simulator file for running the pen plotter on the host computer. It has the
+class DCMotorPlant, a discrete model of one joint (DC motor, gearbox and
+arm) driven by the duty cycle and measured in encoder ticks, stand-ins for
+the pyb, utime and micropython modules so the firmware files run unchanged
+under CPython, and the class SimPlotter which runs a job file through the
+firmware tasks against the plant models on a virtual clock.
+
+The plant parameters are the ones identified by sysid.py and are kept in a
+json file with one entry per joint:
+
+@code
+{"joints": {"0": {"gain": 52.0, "tau": 0.045, "deadband": 6.0,
+                  "coulomb": 2.5, "cpr": 3200}, "1": {...}}}
+@endcode
+
+Ex:
+@code
+plants = simulator.load_plants('plant.json')
+plants[0].step(40, 0.008)
+print(plants[0].position)
+@endcode
+
+Running a job in the simulator:
+@code
+sim = simulator.SimPlotter(simulator.load_plants('plant.json'))
+result = sim.run_job('drawing.txt')
+print(result['plot_time'], result['path_error'])
+@endcode
+
+A simulated plotter taking streamed jobs one after another, for
+stream_job.py or job_server.py, runs on a pseudo terminal linked at a path:
+
+@code
+python simulator.py /tmp/plotter0 --plants plant.json --pace 10
+python stream_job.py /tmp/plotter0 drawing.txt --wait
+@endcode
+
+The firmware wiring is the one in motor_task.py: the motor on timer 3 is
+measured by the encoder on timer 8 (joint 0) and the motor on timer 5 by
+the encoder on timer 4 (joint 1). The pen servo is on timer 2.
+'''
+
+import sys
+import json
+import math
+import types
+import builtins
+
+
+class DCMotorPlant:
+    '''
+    This class implements a first order DC motor model with a deadband and
+    Coulomb friction. The velocity v in ticks/s follows
+
+    v[k+1] = a*v[k] + (1-a)*gain*(u[k] - coulomb*sign)
+
+    where a = exp(-dt/tau), u is the duty cycle in percent and sign is the
+    direction of motion (or of u when starting from rest). When the motor
+    is at rest and |u| is within the deadband the motor does not move.
+
+    The defaults model a gearmotor turning about 5000 ticks/s (1.5 rev/s
+    of the output) at full duty, which the firmware's default gains settle
+    within the arrival tolerance.
+
+    @param gain Steady state speed per percent duty [ticks/s/%]
+    @param tau Mechanical time constant [s]
+    @param deadband Duty cycle needed to break away from rest [%]
+    @param coulomb Duty cycle lost to Coulomb friction while moving [%]
+    @param cpr Encoder counts per output revolution
+    '''
+    def __init__(self, gain=50.0, tau=0.05, deadband=5.0, coulomb=2.0,
+                 cpr=3200):
+        '''
+        Creates a plant at rest at position zero.
+        '''
+        ## Steady state speed per percent duty [ticks/s/%]
+        self.gain = float(gain)
+        ## Mechanical time constant [s]
+        self.tau = float(tau)
+        ## Breakaway duty cycle [%]
+        self.deadband = float(deadband)
+        ## Coulomb friction as a duty cycle [%]
+        self.coulomb = float(coulomb)
+        ## Encoder counts per output revolution
+        self.cpr = int(cpr)
+        ## Position in ticks (not rounded)
+        self.position = 0.0
+        ## Velocity in ticks/s
+        self.velocity = 0.0
+        # Cached decay factor and the dt it was computed for
+        self._dt = None
+        self._a = 0.0
+
+
+    def step(self, duty, dt):
+        '''
+        Advances the plant by dt with a constant duty cycle.
+        @param duty The duty cycle, -100 to 100 [%]
+        @param dt The time step [s]
+        @return The new position [ticks]
+        '''
+        if dt <= 0:
+            return self.position
+        if dt != self._dt:
+            self._dt = dt
+            self._a = math.exp(-dt/self.tau)
+        v = self.velocity
+        if v == 0.0 and abs(duty) <= self.deadband:
+            # Stuck in the deadband
+            return self.position
+        sign = v if v != 0.0 else duty
+        drive = duty - self.coulomb if sign > 0 else duty + self.coulomb
+        v_next = self._a*v + (1 - self._a)*self.gain*drive
+        # Friction can stop the motor but not push it backwards
+        if v != 0.0 and (v > 0) != (v_next > 0):
+            v_next = 0.0
+        self.position += 0.5*(v + v_next)*dt
+        self.velocity = v_next
+        return self.position
+
+
+    def reset(self, position=0.0):
+        '''
+        Puts the plant at rest at a position.
+        @param position The position [ticks]
+        '''
+        self.position = float(position)
+        self.velocity = 0.0
+
+
+    def to_dict(self):
+        '''
+        @return The plant parameters as a dictionary
+        '''
+        return {'gain': self.gain, 'tau': self.tau, 'deadband': self.deadband,
+                'coulomb': self.coulomb, 'cpr': self.cpr}
+
+
+    @classmethod
+    def from_dict(cls, params):
+        '''
+        Creates a plant from a dictionary made by to_dict. Extra keys (such
+        as fit quality) are ignored.
+        @param params Dictionary of plant parameters
+        @return A new DCMotorPlant
+        '''
+        keys = ('gain', 'tau', 'deadband', 'coulomb', 'cpr')
+        return cls(**{key: params[key] for key in keys if key in params})
+
+
+def load_plants(file_name):
+    '''
+    Loads the plant models of all joints from a json file.
+    @param file_name The json file written by save_plants or sysid.py
+    @return Dictionary of joint number to DCMotorPlant
+    '''
+    with open(file_name, 'r') as file:
+        data = json.load(file)
+    return {int(joint): DCMotorPlant.from_dict(params)
+            for joint, params in data['joints'].items()}
+
+
+def save_plants(plants, file_name, extra=None):
+    '''
+    Saves plant models to a json file.
+    @param plants Dictionary of joint number to DCMotorPlant
+    @param file_name The json file name
+    @param extra Optional dictionary of joint number to extra entries (such
+    as fit quality) stored next to each plant's parameters
+    '''
+    joints = {}
+    for joint, plant in plants.items():
+        params = plant.to_dict()
+        if extra and joint in extra:
+            params.update(extra[joint])
+        joints[str(joint)] = params
+    with open(file_name, 'w') as file:
+        json.dump({'joints': joints}, file, indent=2)
+
+
+# =============================================================================
+# Stand-ins for the MicroPython hardware modules
+
+## Which encoder timer measures the joint driven by each motor timer
+WIRING = {3: (8, 0), 5: (4, 1)}
+
+
+class SimClock:
+    '''
+    This class is the virtual clock read through the utime stand-in. Time
+    only moves when the simulator advances it.
+    '''
+    def __init__(self):
+        '''
+        Creates a clock at time zero.
+        '''
+        ## The current time in microseconds
+        self.now_us = 0
+
+
+    def advance(self, us):
+        '''
+        Moves the clock forward.
+        @param us Microseconds to advance
+        '''
+        self.now_us += int(us)
+
+
+class SimChannel:
+    '''
+    This class stands in for a pyb timer channel and keeps the last pulse
+    width written to it.
+    '''
+    def __init__(self, timer, number):
+        '''
+        @param timer The SimTimer the channel belongs to
+        @param number The channel number
+        '''
+        self.timer = timer
+        self.number = number
+        ## The last pulse width written, in percent
+        self.percent = 0.0
+        ## Number of writes to the channel
+        self.writes = 0
+
+
+    def pulse_width_percent(self, value=None):
+        '''
+        Sets or reads the pulse width in percent like pyb.
+        '''
+        if value is None:
+            return self.percent
+        self.timer.before_write()
+        self.percent = float(value)
+        self.writes += 1
+
+
+    def pulse_width(self, value=None):
+        '''
+        Sets or reads the pulse width in timer counts like pyb.
+        '''
+        if value is None:
+            return int(self.percent*(self.timer._period + 1)/100)
+        self.pulse_width_percent(100*value/(self.timer._period + 1))
+
+
+class SimTimer:
+    '''
+    This class stands in for pyb.Timer. Motor timers drive a joint of the
+    plotter and encoder timers count its position.
+    '''
+    PWM = 'PWM'
+    ENC_AB = 'ENC_AB'
+
+    ## Timer clock [Hz]
+    CLOCK = 80000000
+
+    def __init__(self, number, freq=None, period=0xFFFF, prescaler=0):
+        '''
+        Creates or reuses the simulated timer with this number. The period
+        follows from freq like pyb when freq is given.
+        '''
+        self.number = number
+        self.freq = freq
+        if freq is not None:
+            period = int(round(self.CLOCK/freq)) - 1
+        self._period = period
+        self.prescaler = prescaler
+        self.channels = {}
+        _hw.timers[number] = self
+
+
+    def channel(self, number, mode=None, pin=None):
+        '''
+        @return The SimChannel with this number
+        '''
+        if number not in self.channels:
+            self.channels[number] = SimChannel(self, number)
+        return self.channels[number]
+
+
+    def counter(self, value=None):
+        '''
+        Reads the timer counter. Encoder timers return the joint position
+        wrapped to 16 bits.
+        '''
+        joint = _hw.encoder_joint(self.number)
+        if joint is None:
+            return 0
+        return int(math.floor(joint.advance())) & 0xFFFF
+
+
+    def period(self):
+        '''
+        @return The timer period
+        '''
+        return self._period
+
+
+    def before_write(self):
+        '''
+        Brings the driven joint up to the current time before its duty
+        cycle changes.
+        '''
+        joint = _hw.motor_joint(self.number)
+        if joint is not None:
+            joint.advance()
+
+
+class SimMemory:
+    '''
+    This class stands in for machine.mem16 and machine.mem32. Only the
+    timer counter and compare registers listed in fastio are mapped: reads
+    of TIMx->CNT go through SimTimer.counter() and writes of TIMx->CCRy
+    through SimChannel.pulse_width(), so the plants see direct register
+    writes like any other duty cycle change.
+    '''
+    def __init__(self, bits):
+        '''
+        @param bits The access width, 16 or 32
+        '''
+        self.mask = (1 << bits) - 1
+
+
+    def _register(self, address):
+        '''
+        @return (timer number, register offset) of an address
+        '''
+        import fastio
+        for number, base in fastio.TIM_BASE.items():
+            if base <= address < base + 0x400:
+                return number, address - base
+        raise ValueError('Unmapped address 0x{:08X}'.format(address))
+
+
+    def __getitem__(self, address):
+        import fastio
+        number, offset = self._register(address)
+        timer = _hw.timers.get(number)
+        if timer is None:
+            return 0
+        if offset == fastio.CNT:
+            return timer.counter() & self.mask
+        if offset == fastio.ARR:
+            return timer.period() & self.mask
+        if offset in fastio.CCR:
+            return timer.channel(fastio.CCR.index(offset)).pulse_width()
+        return 0
+
+
+    def __setitem__(self, address, value):
+        import fastio
+        number, offset = self._register(address)
+        if offset not in fastio.CCR:
+            raise ValueError('Register 0x{:08X} is read only in the '
+                             'simulator'.format(address))
+        timer = _hw.timers[number]
+        timer.channel(fastio.CCR.index(offset)).pulse_width(value & self.mask)
+
+
+class SimPin:
+    '''
+    This class stands in for pyb.Pin.
+    '''
+    IN = 'IN'
+    OUT_PP = 'OUT_PP'
+    OUT_OD = 'OUT_OD'
+
+    def __init__(self, name, mode=None, af=None, pull=None):
+        '''
+        @param name The pin name, such as 'PA5'
+        '''
+        self.name = name
+        self._value = 0
+
+
+    def high(self):
+        '''
+        Sets the pin high.
+        '''
+        self._value = 1
+
+
+    def low(self):
+        '''
+        Sets the pin low.
+        '''
+        self._value = 0
+
+
+    def value(self, value=None):
+        '''
+        Sets or reads the pin value like pyb.
+        '''
+        if value is None:
+            return self._value
+        self._value = int(bool(value))
+
+
+class SimVCP:
+    '''
+    This class stands in for pyb.USB_VCP. Bytes written are collected in a
+    bytearray and bytes to be read can be fed in by the host side. After
+    link_vcp() the VCP reads from and writes to a file descriptor instead,
+    such as the master of a pseudo terminal a host program has opened.
+
+    send() goes through a model of the USB transmit buffer: it holds
+    TX_SIZE bytes and empties at BYTES_PER_S, and a send that finds it full
+    waits (moving the clock) up to its timeout. Copying the bytes costs
+    US_PER_BYTE of time.
+    '''
+    ## Size of the USB transmit buffer [bytes]
+    TX_SIZE = 1024
+    ## Rate the host takes bytes from the transmit buffer [bytes/s]
+    BYTES_PER_S = 500000
+    ## Time to copy a byte into the transmit buffer [us]
+    US_PER_BYTE = 0.25
+
+    def __init__(self):
+        '''
+        Connects the VCP to the buffers of the current SimHardware.
+        '''
+        self.tx = _hw.vcp_tx
+        self.rx = _hw.vcp_rx
+
+
+    def _pull(self):
+        '''
+        Reads what has come from the linked file descriptor into rx.
+        '''
+        if _hw.vcp_fd is None:
+            return
+        import os
+        try:
+            data = os.read(_hw.vcp_fd, 4096)
+        except (BlockingIOError, OSError):
+            # Nothing waiting, or the host side isn't open
+            return
+        self.rx.extend(data)
+
+
+    def any(self):
+        '''
+        @return True if there are bytes waiting to be read
+        '''
+        if not self.rx:
+            self._pull()
+        return len(self.rx) > 0
+
+
+    def read(self, nbytes=None):
+        '''
+        Reads up to nbytes (or all waiting bytes).
+        @return The bytes read or None if there are none
+        '''
+        if not self.rx:
+            self._pull()
+        if not self.rx:
+            return None
+        if nbytes is None:
+            nbytes = len(self.rx)
+        data = bytes(self.rx[:nbytes])
+        del self.rx[:nbytes]
+        return data
+
+
+    def readinto(self, buf, maxlen=None):
+        '''
+        Reads up to maxlen (or len(buf)) waiting bytes into a buffer.
+        @return The number of bytes read or None if there are none
+        '''
+        if maxlen is None or maxlen > len(buf):
+            maxlen = len(buf)
+        data = self.read(maxlen)
+        if data is None:
+            return None
+        buf[:len(data)] = data
+        return len(data)
+
+
+    def _push(self, data):
+        '''
+        Puts bytes written to the host side in tx, or writes them to the
+        linked file descriptor.
+        @param data The bytes
+        '''
+        if _hw.vcp_fd is None:
+            self.tx.extend(data)
+            return
+        import os
+        import time
+        view = memoryview(bytes(data))
+        wait = 0
+        while view and wait < 1000:
+            try:
+                view = view[os.write(_hw.vcp_fd, view):]
+            except BlockingIOError:
+                # The host isn't reading, as a full USB buffer would block
+                time.sleep(0.001)
+                wait += 1
+            except OSError:
+                # No host side, so the bytes are lost as on a USB VCP
+                return
+
+
+    def write(self, data):
+        '''
+        Writes bytes to the host side.
+        @return The number of bytes written
+        '''
+        self._push(data)
+        return len(data)
+
+
+    def _room(self):
+        '''
+        Empties the transmit buffer for the time since the last call.
+        @return Free bytes in the transmit buffer
+        '''
+        now = _hw.clock.now_us
+        drained = (now - _hw.vcp_drained_us)*self.BYTES_PER_S//1000000
+        if drained > 0:
+            _hw.vcp_pending = max(0, _hw.vcp_pending - drained)
+            _hw.vcp_drained_us = now
+        elif _hw.vcp_pending == 0:
+            _hw.vcp_drained_us = now
+        return self.TX_SIZE - _hw.vcp_pending
+
+
+    def send(self, data, timeout=5000):
+        '''
+        Sends as many bytes as fit in the transmit buffer, waiting up to
+        timeout for room.
+        @param data The bytes to send
+        @param timeout Longest wait for room [ms], 0 not to wait
+        @return The number of bytes sent
+        '''
+        data = bytes(data)
+        sent = 0
+        limit = _hw.clock.now_us + 1000*timeout
+        while True:
+            count = min(len(data) - sent, self._room())
+            if count > 0:
+                self._push(data[sent:sent + count])
+                _hw.vcp_pending += count
+                sent += count
+                _hw.clock.advance(count*self.US_PER_BYTE)
+            if sent == len(data) or _hw.clock.now_us >= limit:
+                return sent
+            # Waiting for the host to take a byte
+            _hw.clock.advance(max(1, 1000000//self.BYTES_PER_S))
+
+
+class SimJoint:
+    '''
+    This class joins a plant to the motor timer driving it. The duty cycle
+    is the difference of the two motor channels, as set by
+    motor_sam_dima.MotorDriver.
+    '''
+    def __init__(self, plant, motor_timer, hw):
+        '''
+        @param plant The DCMotorPlant of the joint
+        @param motor_timer The number of the timer driving the motor
+        @param hw The SimHardware the joint belongs to
+        '''
+        self.plant = plant
+        self.motor_timer = motor_timer
+        self.hw = hw
+        self._last_us = hw.clock.now_us
+
+
+    def duty(self):
+        '''
+        @return The duty cycle applied to the plant [%]
+        '''
+        timer = self.hw.timers.get(self.motor_timer)
+        if timer is None:
+            return 0.0
+        ch1 = timer.channels.get(1)
+        ch2 = timer.channels.get(2)
+        return ((ch1.percent if ch1 else 0.0)
+                - (ch2.percent if ch2 else 0.0))
+
+
+    def advance(self):
+        '''
+        Steps the plant from its last update to the current time with the
+        duty cycle it had over that time.
+        @return The plant position [ticks]
+        '''
+        now = self.hw.clock.now_us
+        if now > self._last_us:
+            self.plant.step(self.duty(), (now - self._last_us)*1e-6)
+            self._last_us = now
+        return self.plant.position
+
+
+class SimHardware:
+    '''
+    This class holds the state shared by the hardware stand-ins: the clock,
+    the timers, the joints and the VCP buffers.
+    '''
+    def __init__(self, plants=None):
+        '''
+        @param plants Dictionary of joint number to DCMotorPlant. Joints
+        without a plant get a default DCMotorPlant.
+        '''
+        self.clock = SimClock()
+        self.timers = {}
+        self.vcp_tx = bytearray()
+        self.vcp_rx = bytearray()
+        # Bytes in the USB transmit buffer and when it was last emptied
+        self.vcp_pending = 0
+        self.vcp_drained_us = 0
+        # File descriptor the VCP is linked to, None for the buffers
+        self.vcp_fd = None
+        plants = plants or {}
+        self.joints = {}
+        for motor_timer, (encoder_timer, joint) in WIRING.items():
+            plant = plants.get(joint) or DCMotorPlant()
+            self.joints[encoder_timer] = SimJoint(plant, motor_timer, self)
+
+
+    def encoder_joint(self, timer_number):
+        '''
+        @return The SimJoint measured by an encoder timer or None
+        '''
+        return self.joints.get(timer_number)
+
+
+    def motor_joint(self, timer_number):
+        '''
+        @return The SimJoint driven by a motor timer or None
+        '''
+        wiring = WIRING.get(timer_number)
+        if wiring is None:
+            return None
+        return self.joints.get(wiring[0])
+
+
+## The hardware state used by the stand-in modules
+_hw = SimHardware()
+
+
+def _identity(function):
+    '''
+    Stand-in for the micropython.native and micropython.viper decorators.
+    '''
+    return function
+
+
+def install():
+    '''
+    Puts the pyb, utime, micropython and machine stand-ins into sys.modules
+    and const into the builtins, so firmware files can be imported under CPython. This
+    must be called before the firmware files are imported.
+    '''
+    if 'pyb' in sys.modules and getattr(sys.modules['pyb'], 'SIMULATED',
+                                        False):
+        return
+    pyb = types.ModuleType('pyb')
+    pyb.SIMULATED = True
+    pyb.Timer = SimTimer
+    pyb.Pin = SimPin
+    pyb.USB_VCP = SimVCP
+    pyb.disable_irq = lambda: 0
+    pyb.enable_irq = lambda state=True: None
+    pyb.delay = lambda ms: _hw.clock.advance(ms*1000)
+    pyb.udelay = lambda us: _hw.clock.advance(us)
+    pyb.millis = lambda: _hw.clock.now_us//1000
+    pyb.micros = lambda: _hw.clock.now_us
+
+    utime = types.ModuleType('utime')
+    utime.ticks_us = lambda: _hw.clock.now_us
+    utime.ticks_ms = lambda: _hw.clock.now_us//1000
+    utime.ticks_diff = lambda a, b: a - b
+    utime.ticks_add = lambda a, b: a + b
+    utime.sleep_ms = lambda ms: _hw.clock.advance(ms*1000)
+    utime.sleep_us = lambda us: _hw.clock.advance(us)
+
+    upy = types.ModuleType('micropython')
+    upy.native = _identity
+    upy.viper = _identity
+    upy.const = lambda value: value
+    upy.alloc_emergency_exception_buf = lambda size: None
+    upy.mem_info = lambda *args: None
+
+    machine = types.ModuleType('machine')
+    machine.mem16 = SimMemory(16)
+    machine.mem32 = SimMemory(32)
+    machine.freq = lambda: SimTimer.CLOCK
+
+    sys.modules['pyb'] = pyb
+    sys.modules['utime'] = utime
+    sys.modules['micropython'] = upy
+    sys.modules['machine'] = machine
+    builtins.const = upy.const
+
+
+def reset(plants=None):
+    '''
+    Replaces the simulated hardware with a fresh one at time zero.
+    @param plants Dictionary of joint number to DCMotorPlant
+    @return The new SimHardware
+    '''
+    global _hw
+    _hw = SimHardware(plants)
+    return _hw
+
+
+def link_vcp(fd):
+    '''
+    Links the simulated USB VCP to a file descriptor, such as the master of
+    a pseudo terminal, so a host program can talk to the simulated firmware
+    through the other end. Call it after reset() or SimPlotter.setup().
+    @param fd The file descriptor, None to go back to the buffers
+    '''
+    if fd is not None:
+        import os
+        os.set_blocking(fd, False)
+    _hw.vcp_fd = fd
+
+
+def hardware():
+    '''
+    @return The SimHardware currently used by the stand-ins
+    '''
+    return _hw
+
+
+# =============================================================================
+
+class SimPlotter:
+    '''
+    This class runs a job file through the firmware in main.py (the command
+    and servo tasks) and motor_task.py (the motor control tasks) against
+    plant models. The cooperative scheduler from cotask.py is called in a
+    loop and each call costs dispatch_us of virtual time. When no task is
+    ready the clock jumps to the next task period.
+
+    While the job runs the setpoint and position of both axes are sampled
+    every sample_us to find the overshoot and, while the pen is down, the
+    path error.
+
+    The pen servo moves to the angle written to it at servo_deg_per_s
+    after servo_dead_ms, and the pen touches the paper within contact
+    degrees of the down angle. Every touchdown farther than the tolerance
+    of the 'first' arrival profile from the point is counted as bad.
+    '''
+    def __init__(self, plants=None, dispatch_us=200, sample_us=8000,
+                 gains=None, tolerance=None, config=None,
+                 servo_deg_per_s=545, servo_dead_ms=20, contact=1.0,
+                 pace=None):
+        '''
+        @param plants Dictionary of joint number to DCMotorPlant
+        @param dispatch_us Virtual time used by each scheduler call [us]
+        @param sample_us Time between samples of the axes [us]
+        @param gains Optional (K_P, K_I, K_D) used for both motors instead
+        of the ones in motor_task.py
+        @param tolerance Optional arrival tolerance instead of the one in
+        main.py [ticks]
+        @param config Optional dictionary of main.py settings to change,
+        such as {'group_encoders': False}
+        @param servo_deg_per_s Slew rate of the simulated servo [deg/s]
+        @param servo_dead_ms Time before the servo starts to move [ms]
+        @param contact The pen touches the paper within this many degrees
+        of the down angle
+        @param pace Most simulated seconds per host second, None to run as
+        fast as possible. A host program talking to the firmware through
+        link_vcp() needs the simulated clock kept near its own.
+        '''
+        self.plants = plants or {0: DCMotorPlant(), 1: DCMotorPlant()}
+        self.dispatch_us = dispatch_us
+        self.sample_us = sample_us
+        self.gains = gains
+        self.tolerance = tolerance
+        self.config = config or {}
+        self.servo_deg_per_s = servo_deg_per_s
+        self.servo_dead_ms = servo_dead_ms
+        self.contact = contact
+        self.pace = pace
+
+
+    def setup(self, file):
+        '''
+        Creates the firmware tasks for a job the way main.py does, with the
+        calibration point already reached and the pen calibrated at 90
+        degrees.
+        @param file An open job file
+        @return The main module with its globals set up
+        '''
+        install()
+        for plant in self.plants.values():
+            plant.reset()
+        hw = reset(self.plants)
+        import importlib
+        import cotask
+        import servo
+        import main
+        # A fresh main module so settings of an earlier run don't carry over
+        main = importlib.reload(main)
+        self.hw = hw
+        cotask.task_list = cotask.TaskList()
+        self.task_list = cotask.task_list
+        for name, value in self.config.items():
+            setattr(main, name, value)
+        if self.tolerance is not None:
+            main.tolerance = self.tolerance
+
+        main.pen_servo = servo.Servo('PA5', prescaler=4.5, freq=25,
+                                     min_us=665, max_us=2360, angle=190)
+        main.down_angle = 90
+        main.up_angle = main.down_angle + main.lift
+        main.pen_servo.write_angle(main.up_angle)
+        main.file = file
+        main.end = False
+
+        # The plants start at the calibration point
+        self.plants[0].reset(800)
+        self.plants[1].reset(0)
+        main.make_motor_tasks()
+        tasks = (main.motor_1_task, main.motor_2_task)
+        if self.gains is not None:
+            for task in tasks:
+                task.control.set_gain(self.gains[0])
+                task.control.set_KI(self.gains[1])
+                task.control.set_KD(self.gains[2])
+        main.set_calibration_point()
+        main.make_job_tasks()
+        self.main = main
+        return main
+
+
+    def _servo_command(self):
+        '''
+        @return The angle last written to the pen servo [degrees]
+        '''
+        servo = self.main.pen_servo
+        pct = servo.ch2.pulse_width_percent()
+        period = 1e6/(servo.freq + servo.prescaler)
+        us = pct*period/100
+        return (us - servo.min_us)*servo.angle/(servo.max_us - servo.min_us)
+
+
+    def _move_servo(self, dt_us):
+        '''
+        Moves the simulated servo towards the angle written to it.
+        @param dt_us Time since the last move [us]
+        '''
+        command = self._servo_command()
+        now = self.hw.clock.now_us
+        if abs(command - self._servo_target) > 1e-6:
+            self._servo_target = command
+            self._servo_start = now + 1000*self.servo_dead_ms
+        if now < self._servo_start:
+            return
+        step = self.servo_deg_per_s*dt_us*1e-6
+        error = command - self.servo_position
+        if abs(error) <= step:
+            self.servo_position = command
+        else:
+            self.servo_position += step if error > 0 else -step
+
+
+    def _pen_down(self):
+        '''
+        @return True if the simulated servo has the pen on the paper
+        '''
+        return self.servo_position <= self.main.down_angle + self.contact
+
+
+    def _idle_skip(self):
+        '''
+        Jumps the clock to the next task period if no task is ready.
+        '''
+        next_run = None
+        for pri in self.task_list.pri_list:
+            for task in pri[2:]:
+                if task.go_flag:
+                    return
+                if task.period is not None:
+                    if next_run is None or task._next_run < next_run:
+                        next_run = task._next_run
+        clock = self.hw.clock
+        if next_run is not None and next_run >= clock.now_us:
+            clock.now_us = next_run + 1
+
+
+    def run(self, timeout_s=600):
+        '''
+        Runs the scheduler until the job ends, an exception stops it (as
+        the bare except in main.py would) or the timeout is reached.
+        @param timeout_s Virtual time limit [s]
+        @return Dictionary of results: plot_time [s], finished, overshoot
+        [ticks], path_error (RMS while the pen is down) [ticks], touchdowns,
+        bad_touchdowns (off the point), dispatches, host_time [s] and
+        underflows of the setpoint queue
+        '''
+        import time
+        main = self.main
+        clock = self.hw.clock
+        tasks = (main.motor_1_task, main.motor_2_task)
+        last_sp = [task.control.setpoint for task in tasks]
+        start_pos = [task.control.actual for task in tasks]
+        overshoot = 0.0
+        err_sq = 0.0
+        err_n = 0
+        self._servo_target = self._servo_command()
+        self._servo_start = clock.now_us
+        self.servo_position = self._servo_target
+        pen_was_down = self._pen_down()
+        touchdowns = 0
+        bad_touchdowns = 0
+        touch_tolerance = main.arrival.profiles['first'][0]
+        next_sample = clock.now_us + self.sample_us
+        limit = clock.now_us + int(timeout_s*1e6)
+        dispatches = 0
+        error = None
+        host_start = time.perf_counter()
+        start_us = clock.now_us
+        while not main.end and clock.now_us < limit:
+            try:
+                self.task_list.pri_sched()
+            except Exception as err:
+                error = repr(err)
+                break
+            dispatches += 1
+            clock.advance(self.dispatch_us)
+            self._idle_skip()
+            if self.pace:
+                # Waiting for the host clock when ahead of it by over 1 ms
+                ahead = (clock.now_us - start_us)/self.pace*1e-6 - (
+                    time.perf_counter() - host_start)
+                if ahead > 0.001:
+                    time.sleep(ahead)
+            if clock.now_us >= next_sample:
+                next_sample += self.sample_us
+                self._move_servo(self.sample_us)
+                pen = self._pen_down()
+                sq = 0.0
+                off = False
+                for n, task in enumerate(tasks):
+                    sp = task.control.setpoint
+                    pos = self.hw.joints[(8, 4)[n]].advance()
+                    off = off or abs(sp - pos) >= touch_tolerance
+                    if sp != last_sp[n]:
+                        start_pos[n] = last_sp[n]
+                        last_sp[n] = sp
+                    # Overshoot is travel past the setpoint in the direction
+                    # of the step
+                    if sp > start_pos[n]:
+                        overshoot = max(overshoot, pos - sp)
+                    elif sp < start_pos[n]:
+                        overshoot = max(overshoot, sp - pos)
+                    sq += (sp - pos)**2
+                if pen:
+                    err_sq += sq
+                    err_n += 1
+                if pen and not pen_was_down:
+                    touchdowns += 1
+                    if off:
+                        bad_touchdowns += 1
+                pen_was_down = pen
+        for task in tasks:
+            task.motor.set_duty_cycle(0)
+        return {'plot_time': clock.now_us*1e-6,
+                'finished': bool(main.end),
+                'error': error,
+                'overshoot': overshoot,
+                'path_error': (err_sq/err_n)**0.5 if err_n else 0.0,
+                'touchdowns': touchdowns,
+                'bad_touchdowns': bad_touchdowns,
+                'dispatches': dispatches,
+                'host_time': time.perf_counter() - host_start,
+                'underflows': main.fifo.underflows if main.fifo else 0}
+
+
+    def run_job(self, file_name, timeout_s=600):
+        '''
+        Sets up and runs a job file.
+        @param file_name The job text file made by parse_hpgl.py
+        @param timeout_s Virtual time limit [s]
+        @return The results dictionary from run()
+        '''
+        with open(file_name, 'rb') as file:
+            self.setup(file)
+            return self.run(timeout_s)
+
+
+def serve(link, plants=None, pace=10, telemetry_decimate=25, ring=4096,
+          config=None, timeout_s=1e9):
+    '''
+    Runs a simulated plotter for job_server.py or stream_job.py. The
+    firmware plots streamed jobs one after another (main.py with
+    stream_jobs = 0) and its USB VCP is a pseudo terminal, reached through
+    a symbolic link, with the simulated clock kept to pace times the host
+    clock. What the firmware prints is dropped.
+    @param link Path of the symbolic link made to the pseudo terminal
+    @param plants Dictionary of joint number to DCMotorPlant
+    @param pace Simulated seconds per host second
+    @param telemetry_decimate Control updates per telemetry record, 0 for
+    none
+    @param ring Bytes of a streamed job held on the board
+    @param config Optional dictionary of other main.py settings to change
+    @param timeout_s Virtual time limit [s]
+    @return The results dictionary from SimPlotter.run()
+    '''
+    import os
+    import pty
+    import tty
+    import contextlib
+    install()
+    import jobstream
+    settings = {'stream_jobs': 0, 'telemetry_decimate': telemetry_decimate}
+    settings.update(config or {})
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.ttyname(slave), link)
+    sim = SimPlotter(plants, pace = pace, config = settings)
+    try:
+        with open(os.devnull, 'w') as log, contextlib.redirect_stdout(log):
+            sim.setup(jobstream.JobStream(ring))
+            link_vcp(master)
+            return sim.run(timeout_s)
+    finally:
+        link_vcp(None)
+        os.remove(link)
+        os.close(master)
+        os.close(slave)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Run a simulated plotter on a pseudo terminal')
+    parser.add_argument('link', help='path of the link to the terminal')
+    parser.add_argument('--plants', help='plant json from sysid.py')
+    parser.add_argument('--pace', type=float, default=10,
+                        help='simulated seconds per host second')
+    parser.add_argument('--telemetry', type=int, default=25,
+                        help='control updates per telemetry record')
+    args = parser.parse_args()
+    try:
+        serve(args.link, load_plants(args.plants) if args.plants else None,
+              args.pace, args.telemetry)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,227 @@
+'''
+@file step_analysis.py
+@author Sam Lee
+Step response analysis file for the host computer. It loads response logs
+into NumPy arrays and computes the rise time, time constant, overshoot,
+settling time, steady-state error and the IAE and ITAE of each response
+without looping over the samples in Python.
+
+Logs can be the text printed by Controller.print_response (time [s],
+position, error), any csv whose first two columns are time and position,
+or the binary blocks sent by capture.ResponseCapture.export (.cap).
+
+A single file or a whole directory of runs can be analysed. Directories
+are processed in parallel and a comparison table is printed.
+
+@code
+python step_analysis.py response_2.csv
+python step_analysis.py runs/ --setpoint 4000 --band 0.02 --jobs 4
+@endcode
+'''
+
+import os
+import sys
+import argparse
+import multiprocessing
+import numpy
+
+import capture
+
+## The metrics in the order they are shown in the comparison table
+METRICS = ('rise', 'tau', 'overshoot', 'settling', 'ss_error', 'iae',
+           'itae')
+
+# numpy.trapz was renamed to numpy.trapezoid in NumPy 2.0
+_trapezoid = getattr(numpy, 'trapezoid', None) or numpy.trapz
+
+## Units of the metrics for the table header
+UNITS = {'rise': 's', 'tau': 's', 'overshoot': '%', 'settling': 's',
+         'ss_error': 'ticks', 'iae': 'tick*s', 'itae': 'tick*s^2'}
+
+
+def load_response(file_name, time_scale=1.0):
+    '''
+    Loads a response log into arrays. Text logs may have stray characters
+    around the numbers (such as the b'...' of printed bytes); rows that do
+    not hold at least a time and a position are dropped.
+    @param file_name A .csv/.txt text log or a .cap binary capture
+    @param time_scale Multiplier to convert the logged time to seconds
+    @return (t, y, setpoint) where setpoint is None if it can't be known
+    '''
+    if file_name.endswith('.cap'):
+        with open(file_name, 'rb') as file:
+            cap = capture.read_export(file)
+        t = numpy.asarray(cap['t'], dtype=float)*1e-6
+        y = numpy.asarray(cap['position'], dtype=float)
+        # Only the samples after the trigger belong to the step
+        trig = cap['trigger']
+        return t[trig:] - t[trig], y[trig:], float(cap['setpoint'])
+
+    with open(file_name, 'r') as file:
+        lines = [line.strip().lstrip("b'").rstrip("'") for line in file]
+    data = numpy.genfromtxt(lines, delimiter=',', invalid_raise=False,
+                            ndmin=2)
+    if data.size == 0 or data.shape[1] < 2:
+        raise ValueError(file_name + ' has no time and position columns')
+    data = data[~numpy.isnan(data[:, :2]).any(axis=1)]
+    t = (data[:, 0] - data[0, 0])*time_scale
+    y = data[:, 1]
+    setpoint = None
+    if data.shape[1] >= 3 and not numpy.isnan(data[-1, 2]):
+        # The third column is the error, so setpoint = position + error
+        setpoint = float(y[-1] + data[-1, 2])
+    return t, y, setpoint
+
+
+def _first_crossing(t, y, level, rising):
+    '''
+    Finds the time of the first crossing of a level, linearly interpolated
+    between samples.
+    @return The crossing time or nan if the level is never reached
+    '''
+    above = y >= level if rising else y <= level
+    if not above.any():
+        return numpy.nan
+    i = int(above.argmax())
+    if i == 0:
+        return float(t[0])
+    # Interpolating between the sample before and the crossing sample
+    y0, y1 = y[i-1], y[i]
+    frac = (level - y0)/(y1 - y0) if y1 != y0 else 0.0
+    return float(t[i-1] + frac*(t[i] - t[i-1]))
+
+
+def analyze(t, y, setpoint=None, band=0.02, tail=0.1):
+    '''
+    Computes the step response metrics of one response.
+    @param t Time array [s] starting at the step
+    @param y Position array
+    @param setpoint The commanded final value. If None the mean of the tail
+    of the response is used.
+    @param band Settling band as a fraction of the step size
+    @param tail Fraction of the samples at the end used as steady state
+    @return A dictionary of the metrics named in METRICS
+    '''
+    t = numpy.asarray(t, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    n_tail = max(1, int(len(y)*tail))
+    final = float(y[-n_tail:].mean())
+    if setpoint is None:
+        setpoint = final
+    y0 = float(y[0])
+    step = setpoint - y0
+    result = dict.fromkeys(METRICS, numpy.nan)
+    if step == 0 or len(y) < 2:
+        return result
+    rising = step > 0
+    # Normalised response, 0 at the start and 1 at the setpoint
+    norm = (y - y0)/step
+    t10 = _first_crossing(t, norm, 0.1, True)
+    t90 = _first_crossing(t, norm, 0.9, True)
+    result['rise'] = t90 - t10
+    result['tau'] = _first_crossing(t, y, y0 + 0.632*step, rising)
+    result['overshoot'] = max(0.0, float(norm.max()) - 1.0)*100
+    # Settling time is the time after the last sample outside the band
+    outside = numpy.abs(norm - 1.0) > band
+    if not outside.any():
+        result['settling'] = float(t[0])
+    elif outside[-1]:
+        result['settling'] = numpy.nan
+    else:
+        last = len(outside) - 1 - int(outside[::-1].argmax())
+        result['settling'] = float(t[last + 1])
+    result['ss_error'] = setpoint - final
+    error = numpy.abs(setpoint - y)
+    result['iae'] = float(_trapezoid(error, t))
+    result['itae'] = float(_trapezoid(t*error, t))
+    return result
+
+
+def analyze_file(args):
+    '''
+    Loads and analyses one log. Takes a single tuple so it can be used with
+    multiprocessing.Pool.map.
+    @param args (file_name, setpoint, band, time_scale)
+    @return (file_name, metrics) where metrics is None if loading failed
+    '''
+    file_name, setpoint, band, time_scale = args
+    try:
+        t, y, logged_setpoint = load_response(file_name, time_scale)
+    except (OSError, ValueError, EOFError) as err:
+        print('Skipping ' + file_name + ': ' + str(err), file=sys.stderr)
+        return file_name, None
+    if setpoint is None:
+        setpoint = logged_setpoint
+    return file_name, analyze(t, y, setpoint, band)
+
+
+def find_logs(path):
+    '''
+    Lists the response logs in a directory, or the path itself if it is a
+    file.
+    @param path A file or directory name
+    @return A sorted list of file names
+    '''
+    if os.path.isfile(path):
+        return [path]
+    names = sorted(os.listdir(path))
+    return [os.path.join(path, name) for name in names
+            if name.endswith(('.csv', '.txt', '.cap'))]
+
+
+def analyze_all(files, setpoint=None, band=0.02, time_scale=1.0, jobs=None):
+    '''
+    Analyses many logs in parallel.
+    @param files List of log file names
+    @param jobs Number of worker processes, by default one per CPU
+    @return List of (file_name, metrics) in the order of files
+    '''
+    work = [(name, setpoint, band, time_scale) for name in files]
+    if jobs == 1 or len(work) <= 1:
+        return [analyze_file(item) for item in work]
+    with multiprocessing.Pool(jobs) as pool:
+        return pool.map(analyze_file, work)
+
+
+def format_table(results):
+    '''
+    Makes a comparison table of the metrics of many runs.
+    @param results List of (file_name, metrics) from analyze_all
+    @return The table as a string
+    '''
+    width = max([len(os.path.basename(name)) for name, _ in results] + [4])
+    header = '{:<{w}s}'.format('RUN', w=width)
+    units = ' '*width
+    for key in METRICS:
+        header += '{:>12s}'.format(key.upper())
+        units += '{:>12s}'.format('[' + UNITS[key] + ']')
+    rows = [header, units]
+    for name, metrics in results:
+        row = '{:<{w}s}'.format(os.path.basename(name), w=width)
+        if metrics is None:
+            row += '{:>12s}'.format('failed')
+        else:
+            for key in METRICS:
+                row += '{:12.4g}'.format(metrics[key])
+        rows.append(row)
+    return '\n'.join(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare step responses')
+    parser.add_argument('paths', nargs='+', help='log files or directories')
+    parser.add_argument('--setpoint', type=float, default=None,
+                        help='commanded final position [ticks]')
+    parser.add_argument('--band', type=float, default=0.02,
+                        help='settling band as a fraction of the step')
+    parser.add_argument('--time-scale', type=float, default=1.0,
+                        help='multiplier to convert logged time to seconds')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='number of worker processes')
+    args = parser.parse_args()
+    files = []
+    for path in args.paths:
+        files.extend(find_logs(path))
+    results = analyze_all(files, args.setpoint, args.band, args.time_scale,
+                          args.jobs)
+    print(format_table(results))
@@ -0,0 +1,502 @@
+'''
+@file stream_job.py
+@authors Sam Lee and Dima Kyle
+Job streamer file for the host computer. It sends a job file to the pen
+plotter over the USB serial port while it plots, for the firmware's
+jobstream.JobStream (main.py with stream_job = True), so the job doesn't
+have to be copied to the flash first.
+
+The board grants credit: the offset in the job it has room for. The job is
+sent in data messages up to that offset and no further, so the ring on the
+board never overflows. If the port goes away (the cable is pulled or this
+program is stopped and started again) the streamer says hello again when
+it comes back and carries on from the offset the board has received up to.
+What else the board prints is passed on to the console.
+
+Every job has an id, by default the CRC32 of the job, which the board
+reports back in its credit messages, so a restarted streamer resumes the
+same job and doesn't start another one while the board is busy. The board
+plots one job at a time and sends a done message when it has plotted it;
+with --wait the streamer waits for it.
+
+@code
+python stream_job.py /dev/ttyACM0 drawing.txt --wait
+@endcode
+
+The throughput, the time spent waiting for credit and the number of times
+the job was resumed are printed at the end; the board prints its underruns
+(times the plot waited for the job) when the job ends. Plotting the same
+job again right after it has been plotted needs another --job-id, as the
+board answers the id it has just finished with the done message.
+'''
+
+import os
+import re
+import sys
+import time
+import zlib
+import asyncio
+import argparse
+import serial
+
+## Start of a data message
+DATA = b'\x01'
+## Start of the message giving the job the following messages are for
+JOB = b'\x02'
+## Start of the message giving the length of the job
+END = b'\x04'
+## Hello message
+HELLO = b'\x05'
+## Start of a credit message
+CREDIT = 0x06
+## Size of a credit message [bytes]
+CREDIT_SIZE = 28
+## Start of a done message
+DONE = 0x07
+## Size of a done message [bytes]
+DONE_SIZE = 10
+
+# The messages of the board
+_CREDIT = re.compile(rb'\x06([0-9a-f]{8}) ([0-9a-f]{8}) ([0-9a-f]{8})\n')
+_DONE = re.compile(rb'\x07([0-9a-f]{8})\n')
+
+
+def default_job_id(job):
+    '''
+    @param job The bytes of a job
+    @return The default id of the job, its CRC32 (never 0)
+    '''
+    return zlib.crc32(job) or 1
+
+
+class JobStreamer:
+    '''
+    Class which streams job files to one plotter, reconnecting and
+    resuming whenever the port goes away. With keep_open the port stays
+    open between jobs, so the output of the board keeps going to the
+    console, and set_job() gives the next job.
+    '''
+    def __init__(self, port, job=None, baudrate=115200, packet=512,
+                 retry_s=0.5, hello_s=1.0, console=None, job_id=None,
+                 wait_done=False, keep_open=False):
+        '''
+        @param port Name of the serial port
+        @param job The job file name, or its bytes, None to give it with
+        set_job()
+        @param baudrate Baud rate, which doesn't matter for the USB VCP
+        @param packet Most bytes of the job in one data message
+        @param retry_s Time between attempts to open the port [s]
+        @param hello_s Time to wait for credit before saying hello again [s]
+        @param console Binary file the other output of the board is written
+        to, None to drop it
+        @param job_id Id of the job, None for its CRC32
+        @param wait_done True to stream until the board has plotted the job
+        instead of until it has received it
+        @param keep_open True to leave the port open after the job
+        '''
+        ## Name of the serial port
+        self.port = port
+        ## Baud rate
+        self.baudrate = baudrate
+        ## Most bytes of the job in one data message
+        self.packet = min(packet, 0xFFFF)
+        ## Time between attempts to open the port [s]
+        self.retry_s = retry_s
+        ## Time to wait for credit before saying hello again [s]
+        self.hello_s = hello_s
+        ## Binary file the other output of the board is written to
+        self.console = console
+        ## True to stream until the board has plotted the job
+        self.wait_done = wait_done
+        ## True to leave the port open after the job
+        self.keep_open = keep_open
+        ## The job
+        self.job = None
+        ## Id of the job
+        self.job_id = 0
+        ## Id of the job the board last reported, 0 when it is idle, None
+        ## before it has reported one
+        self.board_job = None
+        ## True once the board has said it has plotted the job
+        self.plotted = False
+        ## True while the port is open
+        self.connected = False
+        ## Offset the board has received up to
+        self.received = 0
+        ## Offset the board may be sent up to
+        self.limit = 0
+        ## Offset of the next byte to send
+        self.sent = 0
+        ## Bytes written to the port, with the resent ones and headers
+        self.bytes = 0
+        ## Times the port was opened
+        self.opens = 0
+        ## Times the job carried on from an offset past its start
+        self.resumes = 0
+        ## Time spent with everything allowed sent, waiting for credit [s]
+        self.credit_wait_s = 0.0
+        ## Time the job took [s]
+        self.elapsed_s = 0.0
+        # Output of the board not yet parsed
+        self._input = bytearray()
+        # Bytes waiting to be written to the port
+        self._output = bytearray()
+        # Set when credit comes or the port can be written
+        self._event = asyncio.Event()
+        # True once the credit answering the hello has come
+        self._synced = False
+        # Error of the port found by a callback
+        self._error = None
+        # The open serial.Serial, None when closed
+        self._link = None
+        if job is not None:
+            self.set_job(job, job_id)
+
+
+    def set_job(self, job, job_id=None):
+        '''
+        Gives the job to stream next, with its statistics cleared.
+        @param job The job file name, or its bytes
+        @param job_id Id of the job, None for its CRC32
+        '''
+        if isinstance(job, str):
+            with open(job, 'rb') as file:
+                job = file.read()
+        self.job = job
+        self.job_id = default_job_id(job) if job_id is None else job_id
+        self.plotted = False
+        self.received = 0
+        self.limit = 0
+        self.sent = 0
+        self.bytes = 0
+        self.resumes = 0
+        self.credit_wait_s = 0.0
+        self.elapsed_s = 0.0
+
+
+    def done(self):
+        '''
+        @return True once the board has received the whole job, or plotted
+        it with wait_done
+        '''
+        if self.job is None:
+            return True
+        if self.wait_done:
+            return self.plotted
+        return self.received >= len(self.job)
+
+
+    async def run(self):
+        '''
+        Streams the job until the board has all of it, or has plotted it
+        with wait_done.
+        '''
+        start = time.monotonic()
+        while not self.done():
+            link = await self._open()
+            try:
+                await self._stream(link)
+            except (serial.SerialException, OSError):
+                # The board reset or was unplugged
+                self.close()
+            if not self.done():
+                await asyncio.sleep(self.retry_s)
+        if not self.keep_open:
+            self.close()
+        self.elapsed_s = time.monotonic() - start
+
+
+    async def probe(self):
+        '''
+        Opens the port if it isn't open and asks the board which job it
+        has, without giving it one.
+        @return The id of the job the board has, 0 when it is idle, or None
+        if the port or the board didn't answer
+        '''
+        try:
+            link = self._link
+            if link is None or self._error is not None:
+                self.close()
+                link = serial.Serial(self.port, self.baudrate, timeout=0)
+                self._start(link)
+            self.board_job = None
+            self._write(link, HELLO)
+            limit = time.monotonic() + self.hello_s
+            while self.board_job is None and self._error is None:
+                left = limit - time.monotonic()
+                if left <= 0:
+                    break
+                self._event.clear()
+                try:
+                    await asyncio.wait_for(self._event.wait(), left)
+                except asyncio.TimeoutError:
+                    pass
+        except (serial.SerialException, OSError):
+            self.close()
+            return None
+        if self._error is not None:
+            self.close()
+        return self.board_job
+
+
+    def close(self):
+        '''
+        Closes the port.
+        '''
+        link = self._link
+        if link is None:
+            return
+        loop = asyncio.get_running_loop()
+        loop.remove_reader(link.fileno())
+        loop.remove_writer(link.fileno())
+        link.close()
+        self._link = None
+        self.connected = False
+
+
+    async def _open(self):
+        '''
+        Opens the port, trying again until it is there, unless it is open
+        and working.
+        @return The open serial.Serial
+        '''
+        if self._link is not None and self._error is None:
+            return self._link
+        self.close()
+        while True:
+            try:
+                link = serial.Serial(self.port, self.baudrate, timeout=0)
+            except (serial.SerialException, OSError):
+                await asyncio.sleep(self.retry_s)
+                continue
+            self._start(link)
+            return link
+
+
+    def _start(self, link):
+        '''
+        Starts reading a port just opened.
+        @param link The open serial.Serial
+        '''
+        self._link = link
+        self.connected = True
+        self.opens += 1
+        self._input.clear()
+        self._output.clear()
+        self._error = None
+        asyncio.get_running_loop().add_reader(link.fileno(), self._read, link)
+
+
+    async def _stream(self, link):
+        '''
+        Says hello, then sends the job as credit comes, until the board has
+        all of it (or has plotted it) or the port fails.
+        @param link The open serial.Serial
+        '''
+        self._synced = False
+        self._hello(link)
+        asked = time.monotonic()
+        while not self.done():
+            if self._error is not None:
+                raise self._error
+            if not self._synced or self.sent == len(self.job):
+                if time.monotonic() - asked >= self.hello_s:
+                    # The hello or its answer was lost, or the credit of
+                    # the end of the job
+                    self._hello(link)
+                    asked = time.monotonic()
+            if self._synced:
+                self._send(link)
+            # Everything allowed is sent, so waiting for credit
+            starved = self._synced and not self._output and \
+                self.sent < len(self.job) and self.sent >= self.limit
+            waited = time.monotonic()
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), self.hello_s)
+            except asyncio.TimeoutError:
+                pass
+            if starved:
+                self.credit_wait_s += time.monotonic() - waited
+
+
+    def _hello(self, link):
+        '''
+        Says hello, with the id and length of the job so the board knows
+        which job it is and where it ends whatever was lost before.
+        @param link The open serial.Serial
+        '''
+        self._write(link, JOB + b'%08x' % self.job_id + END +
+                    b'%08x' % len(self.job) + HELLO)
+
+
+    def _send(self, link):
+        '''
+        Queues data messages up to the credit limit.
+        @param link The open serial.Serial
+        '''
+        end = min(self.limit, len(self.job))
+        if self.sent >= end or self._output:
+            return
+        message = bytearray()
+        while self.sent < end:
+            count = min(end - self.sent, self.packet)
+            message += DATA + b'%08x%04x' % (self.sent, count)
+            message += self.job[self.sent:self.sent + count]
+            self.sent += count
+        self._write(link, message)
+
+
+    def _write(self, link, data):
+        '''
+        Writes bytes to the port without blocking, keeping what doesn't go
+        for when the port can be written again.
+        @param link The open serial.Serial
+        @param data The bytes, None to carry on with those kept
+        '''
+        if data:
+            self._output += data
+        try:
+            # Straight to the file descriptor, as Serial.write spins while
+            # the port is full
+            count = os.write(link.fileno(), self._output)
+        except BlockingIOError:
+            count = 0
+        except OSError as error:
+            self._error = error
+            self._event.set()
+            return
+        self.bytes += count
+        del self._output[:count]
+        loop = asyncio.get_running_loop()
+        if self._output:
+            loop.add_writer(link.fileno(), self._write, link, None)
+        else:
+            loop.remove_writer(link.fileno())
+            self._event.set()
+
+
+    def _read(self, link):
+        '''
+        Reads the output of the board, taking the credit and done messages
+        out of it.
+        @param link The open serial.Serial
+        '''
+        try:
+            self._input += link.read(65536)
+        except (serial.SerialException, OSError) as error:
+            self._error = error
+            self._event.set()
+            asyncio.get_running_loop().remove_reader(link.fileno())
+            return
+        data = self._input
+        while True:
+            credit = data.find(CREDIT)
+            done = data.find(DONE)
+            at = credit if done < 0 or 0 <= credit < done else done
+            if at < 0:
+                self._print(data)
+                data.clear()
+                return
+            self._print(data[:at])
+            del data[:at]
+            size = CREDIT_SIZE if at == credit else DONE_SIZE
+            if len(data) < size:
+                # The rest of it is still coming
+                return
+            match = (_CREDIT if at == credit else _DONE).match(data)
+            if match is None:
+                # Not a message
+                self._print(data[:1])
+                del data[:1]
+                continue
+            numbers = [int(group, 16) for group in match.groups()]
+            del data[:size]
+            if at == credit:
+                self._credit(*numbers)
+            else:
+                self._done(*numbers)
+
+
+    def _credit(self, job, received, limit):
+        '''
+        Takes in a credit message.
+        @param job Id of the job the board has, 0 when it is idle
+        @param received Offset the board has received up to
+        @param limit Offset the board may be sent up to
+        '''
+        self.board_job = job
+        self._event.set()
+        if self.job is None or job != self.job_id:
+            # The board is busy with another job or hasn't taken this one
+            # yet, so it is asked again
+            self._synced = False
+            return
+        if not self._synced:
+            # Carrying on from where the board is
+            self._synced = True
+            if received > 0:
+                self.resumes += 1
+            self.sent = received
+        self.received = received
+        self.limit = limit
+
+
+    def _done(self, job):
+        '''
+        Takes in a done message.
+        @param job Id of the job the board has plotted
+        '''
+        if self.job is not None and job == self.job_id:
+            self.plotted = True
+            self.received = len(self.job)
+        self.board_job = 0
+        self._event.set()
+
+
+    def _print(self, data):
+        '''
+        Passes output of the board on to the console.
+        @param data The bytes
+        '''
+        if data and self.console is not None:
+            self.console.write(data)
+            self.console.flush()
+
+
+    def __repr__(self):
+        '''
+        @return The progress and throughput of the job
+        '''
+        rate = self.received/self.elapsed_s if self.elapsed_s else 0.0
+        return ('{:s}: job {:08x} {:d}/{:d} bytes{:s} in {:.1f} s ({:.1f} '
+                'kB/s), {:d} written, {:.1f} s waiting for credit, opened '
+                '{:d} times, resumed {:d} times'.format(
+                    self.port, self.job_id, self.received,
+                    len(self.job or b''), ', plotted' if self.plotted else '',
+                    self.elapsed_s, rate*1e-3, self.bytes,
+                    self.credit_wait_s, self.opens, self.resumes))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stream a job to a plotter')
+    parser.add_argument('port')
+    parser.add_argument('job')
+    parser.add_argument('--baudrate', type=int, default=115200)
+    parser.add_argument('--packet', type=int, default=512,
+                        help='most bytes of the job per data message')
+    parser.add_argument('--quiet', action='store_true',
+                        help="don't show the output of the board")
+    parser.add_argument('--wait', action='store_true',
+                        help='wait until the board has plotted the job')
+    parser.add_argument('--job-id', type=lambda text: int(text, 16),
+                        help='id of the job in hex, its CRC32 by default')
+    args = parser.parse_args()
+    streamer = JobStreamer(args.port, args.job, args.baudrate, args.packet,
+                           console=None if args.quiet else sys.stdout.buffer,
+                           job_id=args.job_id, wait_done=args.wait)
+    try:
+        asyncio.run(streamer.run())
+    except KeyboardInterrupt:
+        pass
+    print(streamer)
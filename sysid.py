@@ -0,0 +1,181 @@
+'''
+@file sysid.py
+@author Sam Lee
+System identification file for the host computer. It fits the discrete DC
+motor model of simulator.DCMotorPlant (gain, time constant, deadband and
+Coulomb friction) to logged (time, duty, position) traces of each joint by
+least squares, reports how well the model fits and saves the parameters in
+the json format read by simulator.load_plants.
+
+Traces can be csv files with time, duty [%] and position [ticks] columns,
+or binary captures sent by capture.ResponseCapture.export (.cap), which
+hold the time, actuation and position of a joint.
+
+@code
+python sysid.py --joint 0 m0_a.cap m0_b.cap --joint 1 m1.csv -o plant.json
+@endcode
+
+The fit works on the average velocity over each sample interval, w[k]. For
+a first order motor sampled every dt this obeys
+
+w[k+1] = a*w[k] + beta*(u[k] + u[k+1])/2 + gamma*sign(w[k])
+
+so a, beta and gamma are found by linear least squares over the samples
+where the motor is moving, and converted to tau = -dt/ln(a),
+gain = beta/(1-a) and coulomb = -gamma/beta. The deadband is taken from the
+duty cycles at which the motor stayed at rest or broke away from rest.
+'''
+
+import argparse
+import numpy
+
+import capture
+import simulator
+
+
+def load_trace(file_name, time_scale=1.0):
+    '''
+    Loads one trace.
+    @param file_name A csv (time, duty, position) or a .cap capture
+    @param time_scale Multiplier to convert csv time to seconds
+    @return (t [s], duty [%], position [ticks]) arrays
+    '''
+    if file_name.endswith('.cap'):
+        with open(file_name, 'rb') as file:
+            cap = capture.read_export(file)
+        t = numpy.asarray(cap['t'], dtype=float)*1e-6
+        duty = numpy.asarray(cap['actuation'], dtype=float)/100
+        position = numpy.asarray(cap['position'], dtype=float)
+        return t, duty, position
+    data = numpy.genfromtxt(file_name, delimiter=',', invalid_raise=False,
+                            ndmin=2)
+    data = data[~numpy.isnan(data[:, :3]).any(axis=1)]
+    return data[:, 0]*time_scale, data[:, 1], data[:, 2]
+
+
+def _regressors(t, duty, position):
+    '''
+    Builds the interval velocities of one trace. With trapezoidal
+    integration the interval velocity w[k+1] is driven by the average of
+    the duty cycles of the two intervals.
+    @return (w_now, w_next, w_after, u_mean, u_next) arrays, one entry per
+    usable set of three intervals
+    '''
+    dt = numpy.diff(t)
+    w = numpy.diff(position)/dt
+    return (w[:-2], w[1:-1], w[2:], 0.5*(duty[:-3] + duty[1:-2]),
+            duty[1:-2])
+
+
+def fit_joint(traces, cpr=3200, rest_ticks=2):
+    '''
+    Fits the plant model of one joint to one or more traces.
+    @param traces List of (t, duty, position) arrays
+    @param cpr Encoder counts per output revolution, stored with the fit
+    @param rest_ticks An interval moving no more than this many ticks counts
+    as being at rest when finding the deadband
+    @return (plant, quality) where plant is a simulator.DCMotorPlant and
+    quality is a dictionary of fit statistics
+    '''
+    columns = ([], [], [], [], [])
+    dts = []
+    for t, duty, position in traces:
+        for column, values in zip(columns, _regressors(t, duty, position)):
+            column.append(values)
+        dts.append(numpy.diff(t))
+    w0, w1, w2, u, u_next = [numpy.concatenate(column) for column in columns]
+    dt = float(numpy.median(numpy.concatenate(dts)))
+
+    # Moving samples keep their direction over the interval and the next
+    # one, so friction never stopped the motor inside the fitted interval
+    moving = ((w0 != 0) & (numpy.sign(w0) == numpy.sign(w1))
+              & (numpy.sign(w1) == numpy.sign(w2)))
+    if moving.sum() < 3:
+        raise ValueError('Not enough moving samples to fit')
+    A = numpy.column_stack((w0[moving], u[moving], numpy.sign(w0[moving])))
+    (a, beta, gamma), _, _, _ = numpy.linalg.lstsq(A, w1[moving], rcond=None)
+    a = float(numpy.clip(a, 1e-6, 1 - 1e-9))
+    tau = -dt/numpy.log(a)
+    gain = beta/(1 - a)
+    coulomb = max(0.0, -gamma/beta) if beta != 0 else 0.0
+
+    # Deadband from the duty cycles that did or did not break away
+    rest_speed = rest_ticks/dt
+    at_rest = numpy.abs(w0) <= rest_speed
+    still = numpy.abs(w1) <= rest_speed
+    stuck = numpy.abs(u_next[at_rest & still])
+    breakaway = numpy.abs(u_next[at_rest & ~still])
+    deadband = 0.0
+    if stuck.size:
+        deadband = float(numpy.percentile(stuck, 95))
+    if breakaway.size:
+        deadband = min(deadband, float(numpy.percentile(breakaway, 5)))
+    deadband = max(deadband, coulomb)
+
+    plant = simulator.DCMotorPlant(gain, tau, deadband, coulomb, cpr)
+
+    # One step velocity prediction quality
+    pred = A @ numpy.array([a, beta, gamma])
+    resid = w1[moving] - pred
+    ss_tot = float(((w1[moving] - w1[moving].mean())**2).sum())
+    r2 = 1 - float((resid**2).sum())/ss_tot if ss_tot > 0 else numpy.nan
+
+    # Free running simulation of every trace with the logged duty cycles
+    sq_err = 0.0
+    count = 0
+    for t, duty, position in traces:
+        sim = simulate(plant, t, duty, position[0])
+        sq_err += float(((sim - position)**2).sum())
+        count += len(position)
+    quality = {'r2_velocity': r2, 'rmse_position': (sq_err/count)**0.5,
+               'samples': int(moving.sum()), 'dt': dt}
+    return plant, quality
+
+
+def simulate(plant, t, duty, position_0=0.0):
+    '''
+    Runs a plant over a logged duty cycle sequence.
+    @param plant A simulator.DCMotorPlant
+    @param t Time array [s]
+    @param duty Duty cycle array [%], duty[k] acts from t[k] to t[k+1]
+    @param position_0 Starting position [ticks]
+    @return Array of simulated positions at the times t
+    '''
+    plant.reset(position_0)
+    out = numpy.empty(len(t))
+    out[0] = position_0
+    for k in range(1, len(t)):
+        out[k] = plant.step(duty[k-1], t[k] - t[k-1])
+    plant.reset()
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit joint plant models')
+    parser.add_argument('--joint', nargs='+', action='append', required=True,
+                        metavar=('NUMBER', 'TRACE'),
+                        help='joint number followed by its trace files')
+    parser.add_argument('--cpr', type=int, default=3200,
+                        help='encoder counts per output revolution')
+    parser.add_argument('--time-scale', type=float, default=1.0,
+                        help='multiplier to convert csv time to seconds')
+    parser.add_argument('-o', '--output', default='plant.json',
+                        help='json file for the simulator')
+    args = parser.parse_args()
+
+    plants = {}
+    qualities = {}
+    for entry in args.joint:
+        joint = int(entry[0])
+        traces = [load_trace(name, args.time_scale) for name in entry[1:]]
+        plant, quality = fit_joint(traces, args.cpr)
+        plants[joint] = plant
+        qualities[joint] = {'fit': quality}
+        print('Joint {:d}: gain {:.1f} ticks/s/%, tau {:.4f} s, deadband '
+              '{:.2f} %, coulomb {:.2f} %'.format(joint, plant.gain,
+              plant.tau, plant.deadband, plant.coulomb))
+        print('         R^2 (velocity) {:.4f}, position RMSE {:.2f} ticks '
+              'over {:d} samples'.format(quality['r2_velocity'],
+              quality['rmse_position'], quality['samples']))
+    simulator.save_plants(plants, args.output, qualities)
+    print('Plant models saved in ' + args.output)
@@ -9,7 +9,9 @@
 
 import array
 import gc
+import struct
 import pyb
+import utime
 import micropython
 
 
@@ -17,6 +19,13 @@ import micropython
 #  used to create diagnostic printouts. 
 share_list = []
 
+## Format of a queue's statistics snapshot: size, items, high-water mark,
+#  puts, gets, drops, overwrites and time blocked [us]
+QUEUE_STATS = '<HHHIIIII'
+
+## Size of a queue's statistics snapshot [bytes]
+QUEUE_STATS_SIZE = struct.calcsize (QUEUE_STATS)
+
 
 def show_all ():
     """ Create a string holding a diagnostic printout showing the status of
@@ -27,18 +36,49 @@ def show_all ():
     return '\n'.join (gen)
 
 
+def snapshot_all ():
+    """ Create a binary snapshot of the statistics of every queue in the 
+    system, one @c QUEUE_STATS record per queue in the order of 
+    @c share_list, to be sent to the host or saved after a run. 
+    @return A bytearray of the records """
+
+    queues = [item for item in share_list if isinstance (item, Queue)]
+    buffer = bytearray (QUEUE_STATS_SIZE * len (queues))
+    for n, queue in enumerate (queues):
+        queue.snapshot (buffer, n * QUEUE_STATS_SIZE)
+    return buffer
+
+
 class Queue:
     """ This class implements a queue which is used to transfer data from one
     task to another. If parameter 'thread_protect' is @c True, the transfer 
     will be protected from corruption in the case that one thread might 
     interrupt another due to threading or due to one thread being run as an 
-    interrupt service routine. """
+    interrupt service routine. 
+
+    Each queue counts its puts and gets, the most items it has held (its
+    high-water mark), the items dropped by an ISR finding it full, the 
+    items overwritten, and the time spent waiting in @c put() and 
+    @c get(). They are shown by @c __repr__() and packed by 
+    @c snapshot(), so queues can be sized from real runs. 
+
+    If parameter 'spsc' is @c True, the queue has a single producer and a
+    single consumer (one of which may be an ISR) and needs no protection:
+    the producer only moves the write index and the consumer only the read
+    index, each after the data is copied, and one slot of the buffer is 
+    always left empty so full and empty can be told apart from the indices
+    alone. Interrupts are never disabled in this mode.
+
+    Tasks of a cooperative scheduler should use the non-blocking 
+    @c try_put() and @c try_get(), or the bulk @c put_many() and 
+    @c get_many(), since a task busy-waiting in @c put() or @c get() never
+    lets the task on the other end run. """
 
     ## A counter used to give serial numbers to queues for diagnostic use.
     ser_num = 0
 
     def __init__ (self, type_code, size, thread_protect = True, 
-                  overwrite = False, name = None):
+                  overwrite = False, name = None, spsc = False):
         """ Initialize a queue by allocating memory for the contents and 
         setting up the components in an empty configuration. The data type 
         code is given as for the Python 'array' type, which can be any of
@@ -54,11 +94,18 @@ class Queue:
         @param overwrite If @c True, oldest data will be overwritten with new
             data if the queue becomes full 
         @param name A short name for the queue, default @c QueueN where @c N
-            is a serial number for the queue """
+            is a serial number for the queue 
+        @param spsc If @c True, the queue is lock-free for a single producer
+            and a single consumer; it can't overwrite """
 
+        if spsc and overwrite:
+            raise ValueError ('A single producer queue cannot overwrite')
         self._size = size
-        self._thread_protect = thread_protect
+        self._thread_protect = thread_protect and not spsc
         self._overwrite = overwrite
+        self._spsc = spsc
+        # An SPSC queue has a spare slot which is never filled
+        self._length = size + 1 if spsc else size
         Queue.ser_num += 1
 
         self._name = str (name) if name != None \
@@ -66,7 +113,7 @@ class Queue:
 
         # Allocate memory in which the queue's data will be stored
         try:
-            self._buffer = array.array (type_code, size * [0])
+            self._buffer = array.array (type_code, self._length * [0])
         except MemoryError:
             self._buffer = None
             raise
@@ -86,6 +133,30 @@ class Queue:
         self._wr_idx = 0
         self._num_items = 0
 
+        # A view of the buffer for copying many items at a time
+        self._view = memoryview (self._buffer)
+
+        # Statistics, see reset_stats()
+        self.reset_stats ()
+
+
+    def reset_stats (self):
+        """ Zero the statistics of the queue. The high-water mark starts
+        from the items now in the queue. """
+
+        ## Most items that have been in the queue
+        self.max_items = self.num_in ()
+        ## Items put into the queue, wrapping at 30 bits
+        self.puts = 0
+        ## Items read from the queue, wrapping at 30 bits
+        self.gets = 0
+        ## Items thrown away by an ISR finding the queue full
+        self.drops = 0
+        ## Old items overwritten by new ones
+        self.overwrites = 0
+        ## Time spent waiting in put() and get() [us], wrapping at 30 bits
+        self.blocked_us = 0
+
 
     @micropython.native
     def put (self, item, in_ISR = False):
@@ -98,16 +169,30 @@ class Queue:
         @param item The item to be placed into the queue
         @param in_ISR Set this to @c True if calling from within an ISR """
 
+        if self._spsc:
+            if not self.try_put (item):
+                if in_ISR:
+                    self.drops += 1
+                    return
+                start = utime.ticks_us ()
+                while not self.try_put (item):
+                    pass
+                self._blocked (start)
+            return
+
         # If we're in an ISR and the queue is full and we're not allowed to
-        # overwrite data, we have to give up and exit
-        if self.full ():
+        # overwrite data, we have to give up and exit. Interrupts are off in
+        # an ISR, so overwriting the oldest item there is safe.
+        if self.full () and not self._overwrite:
             if in_ISR:
+                self.drops += 1
                 return
 
-            # Wait (if needed) until there's room in the buffer for the data
-            if not self._overwrite:
-                while self.full ():
-                    pass
+            # Wait until there's room in the buffer for the data
+            start = utime.ticks_us ()
+            while self.full ():
+                pass
+            self._blocked (start)
 
         # Prevent data corruption by blocking interrupts during data transfer
         if self._thread_protect and not in_ISR:
@@ -116,11 +201,20 @@ class Queue:
         # Write the data and advance the counts and pointers
         self._buffer[self._wr_idx] = item
         self._wr_idx += 1
-        if self._wr_idx >= self._size:
+        if self._wr_idx >= self._length:
             self._wr_idx = 0
         self._num_items += 1
         if self._num_items >= self._size:
-            self._num_items = self._size
+            if self._num_items > self._size:
+                # The oldest item was overwritten, so the next oldest is
+                # the one to read next
+                self._num_items = self._size
+                self._rd_idx = self._wr_idx
+                self.overwrites += 1
+            self.max_items = self._size
+        elif self._num_items > self.max_items:
+            self.max_items = self._num_items
+        self.puts = (self.puts + 1) & 0x3FFFFFFF
 
         # Re-enable interrupts
         if self._thread_protect and not in_ISR:
@@ -136,8 +230,14 @@ class Queue:
         @param in_ISR Set this to @c True if calling from within an ISR """
 
         # Wait until there's something in the queue to be returned
-        while self.empty ():
-            pass
+        if self.empty ():
+            start = utime.ticks_us ()
+            while self.empty ():
+                pass
+            self._blocked (start)
+
+        if self._spsc:
+            return self.try_get ()
 
         # Prevent data corruption by blocking interrupts during data transfer
         if self._thread_protect and not in_ISR:
@@ -148,11 +248,12 @@ class Queue:
 
         # Move the read pointer and adjust the number of items in the queue
         self._rd_idx += 1
-        if self._rd_idx >= self._size:
+        if self._rd_idx >= self._length:
             self._rd_idx = 0
         self._num_items -= 1
         if self._num_items < 0:
             self._num_items = 0
+        self.gets = (self.gets + 1) & 0x3FFFFFFF
 
         # Re-enable interrupts
         if self._thread_protect and not in_ISR:
@@ -167,6 +268,8 @@ class Queue:
         if the queue is empty.
         @return @c True if items are in the queue, @c False if not """
 
+        if self._spsc:
+            return self._wr_idx != self._rd_idx
         return (self._num_items > 0)
 
 
@@ -176,6 +279,8 @@ class Queue:
         there are any items therein.
         @return @c True if queue is empty, @c False if it's not empty """
 
+        if self._spsc:
+            return self._wr_idx == self._rd_idx
         return (self._num_items <= 0)
 
 
@@ -185,6 +290,8 @@ class Queue:
         is no room for more data without overwriting existing data. 
         @return @c True if the queue is full """
 
+        if self._spsc:
+            return self.num_in () >= self._size
         return (self._num_items >= self._size)
 
 
@@ -194,15 +301,193 @@ class Queue:
         queue.
         @return The number of items in the queue """
 
+        if self._spsc:
+            num = self._wr_idx - self._rd_idx
+            if num < 0:
+                num += self._length
+            return num
         return (self._num_items)
 
 
+    @micropython.native
+    def try_put (self, item, in_ISR = False):
+        """ Put an item into the queue if there is room for it, without 
+        waiting. A queue which may overwrite always has room.
+        @param item The item to be placed into the queue
+        @param in_ISR Set this to @c True if calling from within an ISR 
+        @return @c True if the item was put, @c False if the queue is full """
+
+        if self._spsc:
+            wr_idx = self._wr_idx + 1
+            if wr_idx >= self._length:
+                wr_idx = 0
+            if wr_idx == self._rd_idx:
+                return False
+            # The data is written before the index which publishes it
+            self._buffer[self._wr_idx] = item
+            self._wr_idx = wr_idx
+            self.puts = (self.puts + 1) & 0x3FFFFFFF
+            num = wr_idx - self._rd_idx
+            if num < 0:
+                num += self._length
+            if num > self.max_items:
+                self.max_items = num
+            return True
+
+        if self._num_items >= self._size and not self._overwrite:
+            return False
+        self.put (item, in_ISR)
+        return True
+
+
+    @micropython.native
+    def try_get (self, in_ISR = False):
+        """ Read an item from the queue if there is one, without waiting.
+        @param in_ISR Set this to @c True if calling from within an ISR 
+        @return The item, or @c None if the queue is empty """
+
+        if self._spsc:
+            rd_idx = self._rd_idx
+            if rd_idx == self._wr_idx:
+                return None
+            # The data is read before the index which frees its slot
+            to_return = self._buffer[rd_idx]
+            rd_idx += 1
+            if rd_idx >= self._length:
+                rd_idx = 0
+            self._rd_idx = rd_idx
+            self.gets = (self.gets + 1) & 0x3FFFFFFF
+            return to_return
+
+        if self._num_items <= 0:
+            return None
+        return self.get (in_ISR)
+
+
+    @micropython.native
+    def put_many (self, items, count = None):
+        """ Put as many items from an array as there is room for, without
+        waiting. The items are copied with at most two memoryview slice 
+        copies. Overwriting queues don't overwrite in bulk. For tasks only:
+        the slices allocate, so this can't be called from an ISR.
+        @param items An array (or memoryview) of the queue's type code
+        @param count Number of items from the start of @c items to put, 
+            default all of them
+        @return The number of items put """
+
+        if count is None:
+            count = len (items)
+
+        if self._thread_protect:
+            irq_state = pyb.disable_irq ()
+
+        room = self._size - self.num_in ()
+        if count > room:
+            count = room
+        if count > 0:
+            source = memoryview (items)
+            wr_idx = self._wr_idx
+            first = self._length - wr_idx
+            if first > count:
+                first = count
+            self._view[wr_idx:wr_idx + first] = source[:first]
+            if count > first:
+                self._view[:count - first] = source[first:count]
+            wr_idx += count
+            if wr_idx >= self._length:
+                wr_idx -= self._length
+            # Publishing the items after they are copied
+            self._wr_idx = wr_idx
+            if not self._spsc:
+                self._num_items += count
+            self.puts = (self.puts + count) & 0x3FFFFFFF
+            num = self.num_in ()
+            if num > self.max_items:
+                self.max_items = num
+
+        if self._thread_protect:
+            pyb.enable_irq (irq_state)
+
+        return count
+
+
+    @micropython.native
+    def get_many (self, items, count = None):
+        """ Read as many items as are in the queue, up to a count, into an 
+        array without waiting. The items are copied with at most two 
+        memoryview slice copies. For tasks only, like @c put_many().
+        @param items An array (or memoryview) of the queue's type code which
+            is filled from the start
+        @param count Most items to read, default the length of @c items
+        @return The number of items read """
+
+        if count is None:
+            count = len (items)
+
+        if self._thread_protect:
+            irq_state = pyb.disable_irq ()
+
+        num = self.num_in ()
+        if count > num:
+            count = num
+        if count > 0:
+            dest = memoryview (items)
+            rd_idx = self._rd_idx
+            first = self._length - rd_idx
+            if first > count:
+                first = count
+            dest[:first] = self._view[rd_idx:rd_idx + first]
+            if count > first:
+                dest[first:count] = self._view[:count - first]
+            rd_idx += count
+            if rd_idx >= self._length:
+                rd_idx -= self._length
+            # Freeing the slots after the items are copied
+            self._rd_idx = rd_idx
+            if not self._spsc:
+                self._num_items -= count
+            self.gets = (self.gets + count) & 0x3FFFFFFF
+
+        if self._thread_protect:
+            pyb.enable_irq (irq_state)
+
+        return count
+
+
+    def _blocked (self, start):
+        """ Add the time since a wait started to the time blocked.
+        @param start The time the wait started from @c utime.ticks_us() """
+
+        self.blocked_us = (self.blocked_us 
+            + utime.ticks_diff (utime.ticks_us (), start)) & 0x3FFFFFFF
+
+
+    def snapshot (self, buffer = None, offset = 0):
+        """ Pack the statistics of the queue into a @c QUEUE_STATS record.
+        With a buffer given nothing is allocated.
+        @param buffer A bytearray to pack the record into, or @c None for a
+            new one
+        @param offset Where the record starts in the buffer [bytes]
+        @return The buffer """
+
+        if buffer is None:
+            buffer = bytearray (QUEUE_STATS_SIZE)
+        struct.pack_into (QUEUE_STATS, buffer, offset, self._size, 
+                          self.num_in (), self.max_items, self.puts, 
+                          self.gets, self.drops, self.overwrites, 
+                          self.blocked_us)
+        return buffer
+
+
     def __repr__ (self):
         """ This method puts diagnostic information about the queue into a 
         string. """
 
-        return ('{:<12s} Queue {: 8d} R:{:d} W:{:d}'.format (self._name, 
-                len (self._buffer), self._rd_idx, self._wr_idx))
+        return ('{:<12s} Queue {: 8d} R:{:d} W:{:d} N:{:d} max:{:d} '
+                'put:{:d} get:{:d} drop:{:d} over:{:d} blocked:{:d}us'.format (
+                self._name, self._size, self._rd_idx, self._wr_idx, 
+                self.num_in (), self.max_items, self.puts, self.gets, 
+                self.drops, self.overwrites, self.blocked_us))
 
 
 # ============================================================================
@@ -287,3 +572,258 @@ class Share:
 
         return ('{:<12s} Share'.format (self._name))
 
+
+# ============================================================================
+
+class StructShare:
+    """ This class implements a shared record of several data items of one
+    type, such as the position, velocity and time of both axes, which is
+    always read as a whole. The items are kept in one preallocated array 
+    and guarded by a sequence counter (a seqlock): the writer makes the
+    counter odd, writes the items and makes it even again, and a reader 
+    copies the items and tries again if the counter was odd or changed 
+    while it copied. Readers never disable interrupts.
+
+    There must be only one writer. If it is a task and the record is also
+    read from an ISR, the writer (with @c thread_protect) disables 
+    interrupts just for the copy of the items, since an ISR can't wait for
+    the task to finish writing. The items are copied one at a time, so 
+    @c put() and @c get_into() allocate nothing and can be called from a
+    hard ISR, with the heap locked.
+
+    @code
+    state = task_share.StructShare ('i', 3, name = 'Axes')
+    state.put (axes.snapshot)                  # Writer
+    copy = array.array ('i', [0, 0, 0])
+    state.get_into (copy)                      # Reader, no allocation
+    @endcode """
+
+    ## A counter used to give serial numbers to shares for diagnostic use.
+    ser_num = 0
+
+    def __init__ (self, type_code, size, thread_protect = True, name = None):
+        """ Allocate memory for the items of the record, given as for the 
+        Python 'array' type (see @c Share). A type code of @c B makes it a
+        record of bytes.
+        @param type_code The type of the data items in the record
+        @param size The number of items in the record
+        @param thread_protect @c True if a writer which is not an ISR
+            disables interrupts while it copies the items
+        @param name A short name for the share, default @c StructShareN 
+            where @c N is a serial number for the share """
+
+        StructShare.ser_num += 1
+        self._buffer = array.array (type_code, size * [0])
+        self._size = size
+        self._thread_protect = thread_protect
+
+        # Sequence counter, odd while the items are being written. It wraps
+        # at 30 bits so it stays a small integer.
+        self._seq = 0
+
+        ## Number of reads which had to be tried again
+        self.retries = 0
+
+        self._name = str (name) if name != None \
+            else 'StructShare' + str (StructShare.ser_num)
+
+        # Add this share to the global share and queue list
+        share_list.append (self)
+
+
+    @micropython.native
+    def begin (self):
+        """ Start writing items one at a time with @c set(). Readers try
+        again until @c commit() is called, so keep the writes short. """
+
+        self._seq = (self._seq + 1) & 0x3FFFFFFF
+
+
+    @micropython.native
+    def set (self, index, data):
+        """ Write one item of the record between @c begin() and 
+        @c commit().
+        @param index The index of the item
+        @param data The data to be put into the item """
+
+        self._buffer[index] = data
+
+
+    @micropython.native
+    def commit (self):
+        """ Finish writing items, making the new record visible. """
+
+        self._seq = (self._seq + 1) & 0x3FFFFFFF
+
+
+    @micropython.native
+    def put (self, data, in_ISR = False):
+        """ Write all the items of the record from an array.
+        @param data An array of the share's type code with at least as many
+            items as the record
+        @param in_ISR Set this to True if calling from within an ISR """
+
+        buffer = self._buffer
+        if self._thread_protect and not in_ISR:
+            irq_state = pyb.disable_irq ()
+
+        self._seq = (self._seq + 1) & 0x3FFFFFFF
+        for index in range (self._size):
+            buffer[index] = data[index]
+        self._seq = (self._seq + 1) & 0x3FFFFFFF
+
+        if self._thread_protect and not in_ISR:
+            pyb.enable_irq (irq_state)
+
+
+    @micropython.native
+    def get_into (self, data, in_ISR = False):
+        """ Copy all the items of the record into an array, trying again if
+        the record was written during the copy. An ISR which finds the 
+        record being written gives up instead of waiting for the writer it
+        interrupted.
+        @param data An array of the share's type code with room for the
+            record
+        @param in_ISR Set this to True if calling from within an ISR
+        @return @c True if @c data holds a whole record, @c False if an ISR
+            gave up """
+
+        buffer = self._buffer
+        size = self._size
+        while True:
+            seq = self._seq
+            if not seq & 1:
+                for index in range (size):
+                    data[index] = buffer[index]
+                if self._seq == seq:
+                    return True
+            if in_ISR:
+                return False
+            self.retries += 1
+
+
+    @micropython.native
+    def get (self, index):
+        """ Read one item of the record. A single item is never torn.
+        @param index The index of the item
+        @return The item """
+
+        return self._buffer[index]
+
+
+    def __repr__ (self):
+        """ This method puts diagnostic information about the share into a 
+        string. """
+
+        return ('{:<12s} StructShare {: 3d} S:{:d} retries:{:d}'.format (
+                self._name, self._size, self._seq, self.retries))
+
+
+# ============================================================================
+
+class ByteRing:
+    """ This class implements a ring buffer of bytes in one @c bytearray,
+    for one producer and one consumer. Like a single producer 
+    @c task_share.Queue it keeps a spare slot so it needs no protection from
+    interrupts, and bytes are copied in and out with @c memoryview slices.
+    Bytes which don't fit are dropped and counted. """
+
+    def __init__ (self, size):
+        """ Allocate the buffer.
+        @param size The most bytes the ring can hold """
+
+        self._length = size + 1
+        self._buffer = bytearray (self._length)
+        self._view = memoryview (self._buffer)
+        self._rd_idx = 0
+        self._wr_idx = 0
+
+        ## Bytes put into the ring
+        self.puts = 0
+
+        ## Bytes taken out of the ring
+        self.gets = 0
+
+        ## Bytes dropped because the ring was full
+        self.dropped = 0
+
+
+    @micropython.native
+    def num_in (self):
+        """ @return The number of bytes in the ring """
+
+        num = self._wr_idx - self._rd_idx
+        if num < 0:
+            num += self._length
+        return num
+
+
+    @micropython.native
+    def room (self):
+        """ @return The number of bytes that fit in the ring """
+
+        return self._length - 1 - self.num_in ()
+
+
+    @micropython.native
+    def any (self):
+        """ @return @c True if there are any bytes in the ring """
+
+        return self._wr_idx != self._rd_idx
+
+
+    @micropython.native
+    def put (self, data):
+        """ Copy as many bytes as fit into the ring, dropping the rest.
+        @param data A @c bytes, @c bytearray or @c memoryview
+        @return The number of bytes put """
+
+        count = len (data)
+        room = self._length - 1 - self.num_in ()
+        if count > room:
+            self.dropped += count - room
+            count = room
+        if count > 0:
+            source = memoryview (data)
+            wr_idx = self._wr_idx
+            first = self._length - wr_idx
+            if first > count:
+                first = count
+            self._view[wr_idx:wr_idx + first] = source[:first]
+            if count > first:
+                self._view[:count - first] = source[first:count]
+            wr_idx += count
+            if wr_idx >= self._length:
+                wr_idx -= self._length
+            # Publishing the bytes after they are copied
+            self._wr_idx = wr_idx
+            self.puts += count
+        return count
+
+
+    @micropython.native
+    def peek (self, most):
+        """ Look at the oldest bytes in the ring without taking them out. 
+        Only bytes up to the end of the buffer are returned, so the ring may
+        hold more than this.
+        @param most The most bytes to return
+        @return A @c memoryview of the bytes """
+
+        rd_idx = self._rd_idx
+        wr_idx = self._wr_idx
+        end = wr_idx if wr_idx >= rd_idx else self._length
+        if end - rd_idx > most:
+            end = rd_idx + most
+        return self._view[rd_idx:end]
+
+
+    @micropython.native
+    def consume (self, count):
+        """ Take bytes out of the ring after they have been sent.
+        @param count The number of bytes to take out """
+
+        rd_idx = self._rd_idx + count
+        if rd_idx >= self._length:
+            rd_idx -= self._length
+        self._rd_idx = rd_idx
+        self.gets += count
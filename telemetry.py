@@ -0,0 +1,406 @@
+'''
+@file telemetry.py
+@authors Sam Lee and Dima Kyle
+Telemetry file. It has the class Telemetry which sends the state of both
+axes as fixed layout binary records over the USB VCP instead of printing
+text, and the functions to decode them on the host computer.
+
+Every decimate control updates a record is packed: the positions,
+setpoints and actuation of both axes, how late the motor task ran and how
+far into the job file the command task is. A CRC16 (CCITT, initial value
+0xFFFF) is added and the packet is COBS encoded, so it has no zero bytes,
+and ends with a zero byte. Records under 254 bytes always make frames of
+the same size, so everything is preallocated. The frames go into a
+task_share.ByteRing which a low priority task sends without blocking;
+frames that don't fit are dropped and counted.
+
+On the board:
+@code
+stream = telemetry.Telemetry(motor_1_task, motor_2_task, decimate = 4)
+pair.set_telemetry(stream)
+stream.set_task(motors)
+stream.set_job(reader)
+writer = cotask.Task(stream.run, name = 'Telemetry', priority = 0)
+stream.set_writer(writer)
+cotask.task_list.append(writer)
+@endcode
+
+On the host, from the bytes read from the serial port:
+@code
+python telemetry.py capture.bin telemetry.npz
+@endcode
+'''
+
+import array
+import struct
+
+try:
+    import micropython
+    import utime
+except ImportError:
+    # On the host computer only the decoder is used
+    import types
+    micropython = types.SimpleNamespace(native = lambda function: function)
+    utime = None
+
+## Record kind of a sample of both axes
+SAMPLE = 1
+## Layout of a sample record
+RECORD = '<BBHIiiiihhHI'
+## Names of the fields of a sample record
+FIELDS = ('kind', 'flags', 'seq', 't_us', 'position_0', 'position_1',
+          'setpoint_0', 'setpoint_1', 'actuation_0', 'actuation_1',
+          'late_us', 'job_offset')
+## Size of a sample record [bytes]
+RECORD_SIZE = struct.calcsize(RECORD)
+## Size of a frame: the record and CRC, one byte of COBS overhead and the
+## zero delimiter [bytes]
+FRAME_SIZE = RECORD_SIZE + 4
+## Flag bit set while the axes are at the arrival target
+FLAG_ARRIVED = 1
+## Flag bit set while the setpoint queue is running a stroke
+FLAG_STROKE = 2
+
+
+def _crc_table():
+    '''
+    @return Table of the CRC16 (polynomial 0x1021) of every byte
+    '''
+    table = array.array('H', [0]*256)
+    for n in range(256):
+        crc = n << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xFFFF
+        table[n] = crc
+    return table
+
+
+## CRC16 of every byte
+CRC_TABLE = _crc_table()
+
+
+@micropython.native
+def crc16(data, count):
+    '''
+    Finds the CRC16 (CCITT, initial value 0xFFFF) of the start of a buffer.
+    @param data The bytes
+    @param count Number of bytes from the start of data
+    @return The CRC
+    '''
+    table = CRC_TABLE
+    crc = 0xFFFF
+    for n in range(count):
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ data[n]]
+    return crc
+
+
+class Telemetry:
+    '''
+    Class which samples both motor tasks every decimate control updates
+    and queues the samples as COBS framed binary records for a writer task
+    to send. The motor task (AxisPair or motor 2's task) calls sample()
+    after every control update.
+    '''
+    def __init__(self, task_0, task_1, decimate=1, ring_size=1024,
+                 bytes_per_run=256):
+        '''
+        Creates the telemetry stream and its buffers.
+        @param task_0 The Motor_control_task of joint 0
+        @param task_1 The Motor_control_task of joint 1
+        @param decimate Control updates per record
+        @param ring_size Bytes of frames kept for the writer
+        @param bytes_per_run Most bytes the writer sends per run
+        '''
+        global utime
+        if utime is None:
+            # Imported on the host before the simulator was installed
+            import utime
+        import task_share
+        ## Motor task of joint 0
+        self.task_0 = task_0
+        ## Motor task of joint 1
+        self.task_1 = task_1
+        ## Control updates per record
+        self.decimate = decimate
+        ## Most bytes the writer sends per run
+        self.bytes_per_run = bytes_per_run
+        ## Frames waiting to be sent
+        self.ring = task_share.ByteRing(ring_size)
+        ## The cotask.Task of the motors, for its lateness
+        self.task = None
+        ## The jobreader.JobReader of the job, for its offset
+        self.job = None
+        ## The ArrivalSignal, for the flags
+        self.arrival = None
+        ## The cotask.Task which sends the frames
+        self.writer = None
+        ## Records made
+        self.count = 0
+        ## Records dropped because the ring was full
+        self.drops = 0
+        # Control updates until the next record
+        self._skip = 0
+        # The record and its CRC
+        self._packet = bytearray(RECORD_SIZE + 2)
+        # The COBS encoded frame
+        self._frame = bytearray(FRAME_SIZE)
+
+
+    def set_task(self, task):
+        '''
+        @param task The cotask.Task running the control loops
+        '''
+        self.task = task
+
+
+    def set_job(self, job):
+        '''
+        @param job The jobreader.JobReader of the job
+        '''
+        self.job = job
+
+
+    def set_arrival(self, arrival):
+        '''
+        @param arrival The ArrivalSignal of both motor tasks
+        '''
+        self.arrival = arrival
+
+
+    def set_writer(self, writer):
+        '''
+        @param writer The cotask.Task running run(), woken for every frame
+        '''
+        self.writer = writer
+
+
+    def sample(self):
+        '''
+        Counts a control update and every decimate updates packs a record
+        and queues its frame. Called by the motor task.
+        '''
+        if self._skip > 0:
+            self._skip -= 1
+            return
+        self._skip = self.decimate - 1
+        now = utime.ticks_us()
+        late = 0
+        task = self.task
+        if task is not None and task.period is not None:
+            # The task was due one period before its next run
+            late = utime.ticks_diff(now, utime.ticks_add(task._next_run,
+                                                         -task.period))
+            if late < 0:
+                late = 0
+            elif late > 0xFFFF:
+                late = 0xFFFF
+        flags = 0
+        arrival = self.arrival
+        if arrival is not None:
+            if arrival.settled >= arrival.dwell:
+                flags |= FLAG_ARRIVED
+            if arrival.fifo is not None and arrival.fifo.active:
+                flags |= FLAG_STROKE
+        task_0 = self.task_0
+        task_1 = self.task_1
+        struct.pack_into(RECORD, self._packet, 0, SAMPLE, flags,
+                         self.count & 0xFFFF, now & 0x3FFFFFFF,
+                         task_0.position, task_1.position,
+                         task_0.control.setpoint, task_1.control.setpoint,
+                         int(task_0.actuation), int(task_1.actuation), late,
+                         self.job.offset() if self.job is not None else 0)
+        self.count += 1
+        if self.ring.room() < FRAME_SIZE:
+            self.drops += 1
+            return
+        self._encode()
+        self.ring.put(self._frame)
+        if self.writer is not None:
+            self.writer.go()
+
+
+    @micropython.native
+    def _encode(self):
+        '''
+        Adds the CRC to the packet and COBS encodes it into the frame.
+        '''
+        packet = self._packet
+        crc = crc16(packet, RECORD_SIZE)
+        packet[RECORD_SIZE] = crc & 0xFF
+        packet[RECORD_SIZE + 1] = crc >> 8
+        frame = self._frame
+        # Index of the code byte of the block being encoded
+        code_at = 0
+        code = 1
+        out = 1
+        for n in range(RECORD_SIZE + 2):
+            byte = packet[n]
+            if byte == 0:
+                frame[code_at] = code
+                code_at = out
+                code = 1
+            else:
+                frame[out] = byte
+                code += 1
+            out += 1
+        frame[code_at] = code
+        frame[out] = 0
+
+
+    def run(self):
+        '''
+        Writer task function. Sends frames from the ring to the USB VCP
+        without waiting, up to bytes_per_run bytes per run, and runs again
+        while frames are left.
+        '''
+        import pyb
+        vcp = pyb.USB_VCP()
+        ring = self.ring
+        while True:
+            budget = self.bytes_per_run
+            while budget > 0 and ring.any():
+                sent = vcp.send(ring.peek(budget), timeout = 0)
+                if not sent:
+                    # The VCP is full, so try again on the next run
+                    break
+                ring.consume(sent)
+                budget -= sent
+            if ring.any() and self.writer is not None:
+                self.writer.go()
+            yield(0)
+
+
+    def __repr__(self):
+        '''
+        @return The records made and dropped
+        '''
+        return 'Telemetry {:d} records {:d} dropped'.format(self.count,
+                                                            self.drops)
+
+
+def cobs_decode(frame):
+    '''
+    Decodes a COBS frame, without its zero delimiter. This is meant for
+    the host side.
+    @param frame The encoded bytes
+    @return The decoded bytes, or None if the frame is malformed
+    '''
+    out = bytearray()
+    n = 0
+    while n < len(frame):
+        code = frame[n]
+        if code == 0 or n + code > len(frame):
+            return None
+        out += frame[n + 1:n + code]
+        n += code
+        if code < 0xFF and n < len(frame):
+            out.append(0)
+    return bytes(out)
+
+
+def decode(data):
+    '''
+    Splits a byte stream into frames and decodes the sample records, with
+    the CRC checked. Anything between frames that isn't a record (such as
+    printed text) is skipped. This is meant for the host side.
+    @param data The bytes received
+    @return A list of record tuples in the order of FIELDS, the number of
+    bad frames, and the bytes after the last delimiter (the start of a
+    frame still coming)
+    '''
+    records = []
+    bad = 0
+    frames = bytes(data).split(b'\x00')
+    rest = frames.pop()
+    for frame in frames:
+        if not frame:
+            continue
+        packet = cobs_decode(frame)
+        if (packet is None or len(packet) != RECORD_SIZE + 2
+                or packet[0] != SAMPLE
+                or crc16(packet, RECORD_SIZE)
+                != packet[RECORD_SIZE] | packet[RECORD_SIZE + 1] << 8):
+            bad += 1
+            continue
+        records.append(struct.unpack(RECORD, packet[:RECORD_SIZE]))
+    return records, bad, rest
+
+
+def dtype():
+    '''
+    Makes the NumPy structured type of a sample record, packed the same way
+    as RECORD. This is meant for the host side.
+    @return The numpy.dtype
+    '''
+    import numpy
+    kinds = {'B': '<u1', 'H': '<u2', 'I': '<u4', 'h': '<i2', 'i': '<i4'}
+    return numpy.dtype([(name, kinds[code])
+                        for name, code in zip(FIELDS, RECORD[1:])])
+
+
+def decode_numpy(data):
+    '''
+    Does what decode() does with NumPy, working on every frame of the data
+    at once, so a host can keep up with a stream of several MB/s. Frames
+    that aren't FRAME_SIZE long are bad. This is meant for the host side.
+    @param data The bytes received
+    @return A structured array of the records (see dtype()), the number of
+    bad frames, and the bytes after the last delimiter
+    '''
+    import numpy
+    buf = numpy.frombuffer(data, numpy.uint8)
+    ends = numpy.flatnonzero(buf == 0)
+    if len(ends) == 0:
+        return numpy.empty(0, dtype()), 0, bytes(data)
+    rest = bytes(data[ends[-1] + 1:])
+    starts = numpy.concatenate(([0], ends[:-1] + 1))
+    lengths = ends - starts
+    whole = lengths == FRAME_SIZE - 1
+    bad = int(numpy.count_nonzero((lengths > 0) & ~whole))
+    # One row per frame, without its delimiter
+    frames = buf[starts[whole, None] + numpy.arange(FRAME_SIZE - 1)]
+    packets = frames[:, 1:].copy()
+    # Following the chain of code bytes, each one after the first stands
+    # for a zero in the packet
+    at = frames[:, 0].astype(numpy.intp)
+    rows = numpy.flatnonzero(at < FRAME_SIZE - 1)
+    while len(rows):
+        packets[rows, at[rows] - 1] = 0
+        at[rows] += frames[rows, at[rows]]
+        rows = rows[at[rows] < FRAME_SIZE - 1]
+    good = at == FRAME_SIZE - 1
+    table = numpy.array(CRC_TABLE, numpy.uint32)
+    crc = numpy.full(len(packets), 0xFFFF, numpy.uint32)
+    for n in range(RECORD_SIZE):
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ packets[:, n]]
+    good &= crc == (packets[:, RECORD_SIZE]
+                    | packets[:, RECORD_SIZE + 1].astype(numpy.uint32) << 8)
+    good &= packets[:, 0] == SAMPLE
+    bad += int(numpy.count_nonzero(~good))
+    records = packets[good, :RECORD_SIZE].copy().view(dtype()).ravel()
+    return records, bad, rest
+
+
+def to_numpy(records):
+    '''
+    Makes one NumPy array per field from decoded records. This is meant for
+    the host side.
+    @param records The records from decode()
+    @return Dictionary of field name to array
+    '''
+    import numpy
+    columns = list(zip(*records)) if records else [()]*len(FIELDS)
+    return {name: numpy.array(column, dtype = numpy.int64)
+            for name, column in zip(FIELDS, columns)}
+
+
+if __name__ == '__main__':
+    import sys
+    import numpy
+    with open(sys.argv[1], 'rb') as file:
+        records, bad, rest = decode(file.read())
+    arrays = to_numpy(records)
+    numpy.savez(sys.argv[2] if len(sys.argv) > 2 else 'telemetry.npz',
+                **arrays)
+    print('{:d} records, {:d} bad frames, {:d} bytes left over'.format(
+          len(records), bad, len(rest)))